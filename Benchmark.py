@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+""" Benchmarks for the lexer, the parsers and the evaluation engines
+
+	Every workload generates formulas of growing size. Each stage is timed per size,
+	and the results are written as JSON, including the scaling exponent between
+	consecutive sizes (1 means linear, 2 quadratic), so runs of different commits
+	can be compared.
+"""
+
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+import timeit
+
+from Bytecode import SymbolTable, assemble
+from Compiler import Compiler
+from Evaluator import EvaluationContext
+from FormulaStructure import Sum, evaluate_iterative
+from Lexer import Lexer
+from Parser import Parser, parse
+
+def measure(function, number=1000, repeat=5):
+	""" Returns the best time per call in seconds """
+	return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+def measure_adaptive(function, minimum_time=0.05, repeat=3):
+	""" Returns the best time per call in seconds, choosing the number of calls automatically """
+	number = 1
+	while True:
+		elapsed = timeit.timeit(function, number=number)
+		if elapsed >= minimum_time:
+			break
+		number *= 2 if elapsed == 0 else max(2, min(10, int(minimum_time / elapsed) + 1))
+	return min([elapsed] + timeit.repeat(function, number=number, repeat=repeat - 1)) / number
+
+WORKLOADS = {
+	"flat_sum":		lambda n: " + ".join("x" if k % 2 else str(k) for k in range(n)),
+	"flat_product":	lambda n: " * ".join("x" if k % 2 else "1.0001" for k in range(n)),
+	"nested_parentheses":	lambda n: "(" * n + "x" + " + 1)" * n,
+	"power_chain":	lambda n: "x" + " ^ 1" * n,
+	"functions":	lambda n: " + ".join(("sin(x)", "cos(x) * y", "max(x, y, 1)", "sqrt(x ^ 2 + y ^ 2)", "atan2(y, x)")[k % 5] for k in range(n)),
+	"complex":		lambda n: " + ".join(("(x + i * y)", "(1 - i) * x", "conj(x + i)", "i ^ 2")[k % 4] for k in range(n)),
+}
+
+def stages():
+	""" Returns the benchmarked stages: name -> function(formula, lexemes, tree, compiled, context) """
+	lexer = Lexer()
+	parser = Parser()
+	return {
+		"lex":			lambda formula, lexemes, tree, compiled, context: lexer.lexe(formula),
+		"parse":		lambda formula, lexemes, tree, compiled, context: parser.parse(lexemes),
+		"parse_recursive":	lambda formula, lexemes, tree, compiled, context: Sum.parse(list(lexemes)),
+		"evaluate":		lambda formula, lexemes, tree, compiled, context: tree.evaluate(context),
+		"evaluate_iterative":	lambda formula, lexemes, tree, compiled, context: evaluate_iterative(tree, context),
+		"compile":		lambda formula, lexemes, tree, compiled, context: Compiler().compile(tree),
+		"evaluate_compiled":	lambda formula, lexemes, tree, compiled, context: compiled.evaluate(context),
+		"end_to_end":	lambda formula, lexemes, tree, compiled, context: parser.parse(lexer.lexe_iter(formula)).evaluate(context),
+	}
+
+def benchmark_workload(name, sizes, selected=None, minimum_time=0.05):
+	""" Times every stage of a workload for every size """
+	context = EvaluationContext()
+	context.set_variable("x", 0.5)
+	context.set_variable("y", 2.0)
+	lexer = Lexer()
+	
+	results = dict()
+	for stage, function in stages().items():
+		if selected is not None and stage not in selected:
+			continue
+		
+		curve = list()
+		for size in sizes:
+			formula = WORKLOADS[name](size)
+			point = {"size": size, "characters": len(formula)}
+			try:
+				lexemes = lexer.lexe(formula)
+				point["lexemes"] = len(lexemes)
+				tree = Parser().parse(lexemes) if stage not in ("lex", "parse", "parse_recursive") else None
+				compiled = Compiler().compile(tree) if stage == "evaluate_compiled" else None
+				point["seconds"] = measure_adaptive(lambda: function(formula, lexemes, tree, compiled, context), minimum_time)
+			except (RecursionError, MemoryError, SyntaxError) as e:
+				#e.g. recursion limit of the recursive parser and evaluator, or of compile()
+				point["seconds"] = None
+				point["error"] = "{}: {}".format(e.__class__.__name__, e)
+			curve.append(point)
+		
+		results[stage] = {"curve": curve, "exponents": _exponents(curve)}
+	return results
+
+def _exponents(curve):
+	""" Scaling exponents between consecutive points, log(t2 / t1) / log(n2 / n1) """
+	exponents = list()
+	for a, b in zip(curve, curve[1:]):
+		if a["seconds"] and b["seconds"] and b["size"] != a["size"]:
+			exponents.append(round(math.log(b["seconds"] / a["seconds"]) / math.log(b["size"] / a["size"]), 3))
+		else:
+			exponents.append(None)
+	return exponents
+
+def benchmark_compiler(number=10000):
+	""" Compares repeated tree walking evaluation with compiled evaluation """
+	context = EvaluationContext()
+	context.set_variable("x", 1.5)
+	context.set_variable("y", 2.0)
+	
+	formulas = [	"3 * x * y + x / y - 2 * x + 1",
+					"+".join("x * {}".format(n) for n in range(50)),
+					"sqrt(x^2 + y^2) * 2 * pi / 360 + sin(x) * cos(y) - 3 * x * y + 1",
+					"((x + 1) * (y - 1) / (x + y)) ^ 2 % 7 \\ 2",
+				]
+	
+	results = list()
+	compiler = Compiler()
+	for formula in formulas:
+		tree = parse(formula)
+		compiled = compiler.compile(tree)
+		
+		tree_time = measure(lambda: tree.evaluate(context), number)
+		compiled_time = measure(lambda: compiled.evaluate(context), number)
+		results.append({	"formula":	formula,
+							"tree":		tree_time,
+							"compiled":	compiled_time,
+							"speedup":	tree_time / compiled_time,
+						})
+	return results
+
+def object_size(root):
+	""" Returns the deep size in bytes of an object graph, counting shared objects once """
+	seen = set()
+	size = 0
+	pending = [root]
+	while pending:
+		current = pending.pop()
+		if id(current) in seen or current is None or isinstance(current, type):
+			continue
+		seen.add(id(current))
+		size += sys.getsizeof(current)
+		if isinstance(current, (list, tuple)):
+			pending.extend(current)
+		elif isinstance(current, dict):
+			pending.extend(current.keys())
+			pending.extend(current.values())
+		elif hasattr(current, "__dict__"):
+			pending.append(current.__dict__)
+	return size
+
+def benchmark_bytecode(number=2000):
+	""" Compares memory per formula and evaluation time of trees and bytecode """
+	context = EvaluationContext()
+	context.set_variable("x", 1.5)
+	context.set_variable("y", 2.0)
+	table = SymbolTable()
+	
+	results = list()
+	for name, workload in sorted(WORKLOADS.items()):
+		tree = parse(workload(20))
+		bytecode = assemble(tree, table)
+		results.append({	"workload":			name,
+							"tree_bytes":		object_size(tree),
+							"bytecode_bytes":	sys.getsizeof(bytecode) + sys.getsizeof(bytecode.opcodes) + sys.getsizeof(bytecode.operands),
+							"tree_seconds":		measure(lambda: tree.evaluate(context), number),
+							"bytecode_seconds":	measure(lambda: bytecode.evaluate(context), number),
+						})
+	#the symbol table is shared by all formulas assembled into it
+	results.append({"workload": "shared symbol table", "bytecode_bytes": object_size(table)})
+	return results
+
+def run(workloads, sizes, selected=None, minimum_time=0.05):
+	""" Runs the benchmark suite, returns a JSON serializable dictionary """
+	return {
+		"timestamp":	time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python":		platform.python_version(),
+		"platform":		platform.platform(),
+		"sizes":		sizes,
+		"workloads":	{name: benchmark_workload(name, sizes, selected, minimum_time) for name in workloads},
+		"compiler":		benchmark_compiler(),
+		"bytecode":		benchmark_bytecode(),
+	}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmarks lexer, parsers and evaluators")
+	parser.add_argument("--workloads", nargs="+", choices=sorted(WORKLOADS), default=sorted(WORKLOADS))
+	parser.add_argument("--stages", nargs="+", choices=sorted(stages()), default=None)
+	parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000, 10000])
+	parser.add_argument("--minimum-time", type=float, default=0.05, help="minimum seconds per measurement")
+	parser.add_argument("--output", help="JSON output file (default: stdout)")
+	arguments = parser.parse_args()
+	
+	results = run(arguments.workloads, arguments.sizes, arguments.stages, arguments.minimum_time)
+	
+	if arguments.output:
+		with open(arguments.output, "w") as output:
+			json.dump(results, output, indent=1)
+	else:
+		json.dump(results, sys.stdout, indent=1)
+		print()
@@ -0,0 +1,395 @@
+""" Resolves formula elements against an EvaluationContext once, ahead of evaluation
+	
+	Binding turns a syntax tree into a tree of closures. Function names are resolved and
+	their arity validated at bind time, the closures call the captured callables directly.
+	Every distinct variable gets an integer slot: evaluation loads the values of all slots
+	into a flat list once and the closures only index into it.
+	
+	A binding stays valid until the context's generation changes, which happens when
+	functions are registered, unregistered or memoized, statistics are toggled or a new
+	variable is created. BoundFormula.evaluate rebinds automatically in that case.
+	Errors found while binding (unknown names, wrong arity) are raised when the offending
+	node is evaluated, in the same order as element.evaluate(context) would raise them.
+	
+	Calls of user defined functions (see UserFunction) are inlined: the arguments are
+	stored in slots of their own and the function's body is bound in place of the call,
+	so a call costs as much as evaluating the body directly.
+"""
+
+from Evaluator import EvaluationError, EvaluationContext, EvaluationFunction
+from FormulaStructure import (ParserError, Function, Sum, Product, Power, Toplevel, Decimal,
+								Variable, Constant, AdditionalElement, Definition, children, BINARY_OPERATORS)
+
+_UNBOUND = object() #value of slots not holding a variable (yet)
+
+#bound nodes of inlined function bodies per binding, calls beyond this are not inlined
+INLINE_LIMIT = 10000
+
+class BoundFormula:
+	""" Formula element bound to an EvaluationContext """
+	
+	def __init__(self, element, context, parameters=()):
+		self.element = element
+		self.context = context
+		self.parameters = parameters #names bound to the first slots, see evaluate_arguments
+		self.bindings = 0
+		self.bind()
+	
+	def bind(self):
+		""" (Re)resolves the formula against the current state of the context """
+		binder = _Binder(self.context, self.parameters)
+		self.function = binder.bind(self.element)
+		self.slots = binder.slots		#slot index -> variable name
+		self.readable = binder.readable	#slot index -> variable exists (or is computed by get_variable)
+		self.generation = self.context.generation
+		self.bindings += 1
+		#contexts overriding get_variable (like ReactiveContext) compute some values on read
+		self.direct = type(self.context).get_variable is EvaluationContext.get_variable
+	
+	def is_valid(self):
+		return self.generation == self.context.generation
+	
+	def load(self):
+		""" Returns the flat list of slot values for the current variables of the context """
+		if self.direct:
+			variables = self.context.variables
+			try:
+				return [variables[name] if readable else _UNBOUND
+						for name, readable in zip(self.slots, self.readable)]
+			except KeyError:
+				pass #variable deleted behind the context's back, get_variable reports it
+		
+		get_variable = self.context.get_variable
+		return [get_variable(name) if readable else _UNBOUND
+				for name, readable in zip(self.slots, self.readable)]
+	
+	def evaluate(self, context=None):
+		""" Evaluates the formula like element.evaluate(context), rebinding first if needed """
+		if context is not None and context is not self.context:
+			self.context = context
+			self.bind()
+		elif self.generation != self.context.generation:
+			self.bind()
+		return self.function(self.load())
+	
+	def evaluate_arguments(self, arguments):
+		""" Evaluates the formula with its parameters bound to arguments """
+		if self.generation != self.context.generation:
+			self.bind()
+		values = self.load()
+		values[:len(arguments)] = arguments
+		return self.function(values)
+	
+	def evaluate_slots(self, values):
+		""" Evaluates the formula with a caller provided list of slot values (see slots),
+			without looking at the context's variables. Assignments still go to the context. """
+		return self.function(values)
+	
+	def __str__(self):
+		return "[{}: {}]".format(self.__class__.__name__, self.element)
+	
+	def __repr__(self):
+		return "[{}: {}]".format(self.__class__.__name__, self.element)
+
+def bind(element, context):
+	""" Binds a formula element to an EvaluationContext """
+	return BoundFormula(element, context)
+
+def _raise(error, message):
+	def raising(values):
+		raise error(message)
+	return raising
+
+class UserFunction(EvaluationFunction):
+	""" Function defined at runtime by a formula like f(x, y) = x^2 + y.
+		Parameters are local to the body, other variables are read from the context
+		the function is bound to when it is called. """
+	
+	def __init__(self, name, parameters, body, context):
+		self.name = name
+		self.parameters = parameters
+		self.body = body
+		self.bound = BoundFormula(body, context, parameters)
+		
+		super().__init__(len(parameters), self.call, "user defined function", pure=self._is_pure(context))
+	
+	def call(self, *arguments):
+		return self.bound.evaluate_arguments(arguments)
+	
+	def _is_pure(self, context):
+		""" Pure if the body only reads parameters and calls pure functions, without assignments """
+		pending = [self.body]
+		while pending:
+			element = pending.pop()
+			if isinstance(element, Variable) and element.value not in self.parameters:
+				return False
+			if isinstance(element, Toplevel) and isinstance(element.additional, AdditionalElement) and \
+					element.additional.operator == '=':
+				return False
+			if isinstance(element, Function):
+				function = context.functions.get(element.name)
+				if function is None or not function.pure:
+					return False
+			pending.extend(children(element))
+		return True
+	
+	def bound_to(self, context):
+		""" Returns this function bound to another context, e.g. a fork or a DualContext """
+		return UserFunction(self.name, self.parameters, self.body, context)
+	
+	def calls(self):
+		""" Returns the names of the functions the body calls """
+		names = set()
+		pending = [self.body]
+		while pending:
+			element = pending.pop()
+			if isinstance(element, Function):
+				names.add(element.name)
+			pending.extend(children(element))
+		return names
+
+def define_function(context, name, parameters, body):
+	""" Defines or redefines a UserFunction in context, see EvaluationContext.define_function """
+	existing = context.functions.get(name)
+	if existing is not None and not isinstance(existing, UserFunction):
+		raise EvaluationError("Function '{}' already registered.".format(name))
+	
+	function = UserFunction(name, list(parameters), body, context)
+	
+	#a cycle has to go through the new definition, follow the calls starting from its body
+	paths = [[name, called] for called in function.calls()]
+	visited = set()
+	while paths:
+		path = paths.pop()
+		if path[-1] == name:
+			raise EvaluationError("Recursive definition: {}".format(" -> ".join(path)))
+		if path[-1] in visited:
+			continue
+		visited.add(path[-1])
+		called = context.functions.get(path[-1])
+		if isinstance(called, UserFunction):
+			paths.extend(path + [next] for next in called.calls())
+	
+	return function
+
+class _Binder:
+	""" Builds the closures of one binding """
+	
+	def __init__(self, context, parameters=()):
+		self.context = context
+		self.slots = list()
+		self.readable = list()
+		self.indices = dict()	#variable name -> slot index
+		self.computed = type(context).get_variable is not EvaluationContext.get_variable
+		self.scopes = list()	#parameter name -> slot index, of the (inlined) body being bound
+		self.inlining = list()	#names of the functions being inlined
+		self.inlined = 0		#nodes bound for inlined bodies
+		if parameters:
+			self.scopes.append({name: self.local(name) for name in parameters})
+	
+	def local(self, name):
+		""" Returns a new slot for a parameter, which is never loaded from the context """
+		self.slots.append(name)
+		self.readable.append(False)
+		return len(self.slots) - 1
+	
+	def slot(self, name):
+		if name not in self.indices:
+			self.indices[name] = len(self.slots)
+			self.slots.append(name)
+			self.readable.append(self.computed or name in self.context.variables)
+		return self.indices[name]
+	
+	def bind(self, element):
+		if isinstance(element, (Sum, Product)):
+			return self.bind_chain(element)
+		
+		if isinstance(element, Power):
+			base = self.bind(element.value)
+			if element.exponent is None:
+				return base
+			exponent = self.bind(element.exponent)
+			return lambda values: base(values) ** exponent(values)
+		
+		if isinstance(element, Toplevel):
+			if not isinstance(element.additional, AdditionalElement):
+				return self.bind(element.value)
+			if element.additional.operator == '-':
+				operand = self.bind(element.additional.value)
+				return lambda values: - operand(values)
+			if element.additional.operator == '=':
+				return self.bind_assignment(element.value.value, self.bind(element.additional.value))
+			return _raise(ParserError, "Expected operator '-' or '=', but found '{}'".format(element.additional.operator))
+		
+		if isinstance(element, Decimal):
+			try:
+				value = float(element.value)
+			except ValueError:
+				literal = element.value
+				return lambda values: float(literal) #raises the ValueError on evaluation
+			return lambda values: value
+		
+		if isinstance(element, Constant):
+			value = element.value
+			return lambda values: value
+		
+		if isinstance(element, Variable):
+			return self.bind_variable(element.value)
+		
+		if isinstance(element, Function):
+			return self.bind_function(element)
+		
+		if isinstance(element, Definition):
+			#definitions inside function bodies are not supported
+			if self.scopes:
+				return _raise(EvaluationError, "Function '{}' cannot be defined inside a function".format(element.name))
+		
+		#unknown elements evaluate themselves
+		context = self.context
+		return lambda values: element.evaluate(context)
+	
+	def bind_chain(self, element):
+		first = self.bind(element.value)
+		operations = list()
+		for add in element.additional:
+			if add.operator not in BINARY_OPERATORS:
+				operations.append((None, _raise(ParserError, "Unexpected operator '{}'".format(add.operator))))
+			else:
+				operations.append((BINARY_OPERATORS[add.operator], self.bind(add.value)))
+		
+		if len(operations) == 1 and operations[0][0] is not None:
+			operation, second = operations[0]
+			return lambda values: operation(first(values), second(values))
+		
+		def chain(values):
+			value = first(values)
+			for operation, operand in operations:
+				value = operation(value, operand(values))
+			return value
+		return chain
+	
+	def bind_variable(self, name):
+		if self.scopes and name in self.scopes[-1]:
+			index = self.scopes[-1][name]
+			return lambda values: values[index]
+		
+		index = self.slot(name)
+		if self.readable[index]:
+			return lambda values: values[index]
+		
+		#unknown at bind time, may be assigned earlier in the same formula
+		message = "Unknown variable '{}'".format(name)
+		def read(values):
+			value = values[index]
+			if value is _UNBOUND:
+				raise EvaluationError(message)
+			return value
+		return read
+	
+	def bind_assignment(self, name, operand):
+		if self.scopes and name in self.scopes[-1]:
+			#parameters are local to the function's body
+			index = self.scopes[-1][name]
+			def assign_parameter(values):
+				value = values[index] = operand(values)
+				return value
+			return assign_parameter
+		
+		index = self.slot(name)
+		set_variable = self.context.set_variable
+		def assign(values):
+			value = set_variable(name, operand(values))
+			values[index] = value
+			return value
+		return assign
+	
+	def bind_function(self, element):
+		arguments = [self.bind(argument) for argument in element.arguments]
+		name = element.name
+		context = self.context
+		
+		if "call_function" in vars(context) or type(context).call_function is not EvaluationContext.call_function:
+			#call_function is instrumented or overridden, keep going through it
+			call_function = context.call_function
+			return lambda values: call_function(name, [argument(values) for argument in arguments])
+		
+		function = context.functions.get(name)
+		count = len(arguments)
+		if function is None:
+			error = "Function '{}' not found.".format(name)
+		elif not ((function.arity < 0 and abs(function.arity) - 1 <= count) or function.arity == count):
+			arity = function.arity if function.arity >= 0 else abs(function.arity) - 1
+			error = "Function '{}' has arity {}, but got {} arguments.".format(name, arity, count)
+		else:
+			error = None
+		
+		if error is not None:
+			#arguments are still evaluated first, their errors take precedence
+			def failing(values):
+				for argument in arguments:
+					argument(values)
+				raise EvaluationError(error)
+			return failing
+		
+		if isinstance(function, UserFunction) and name not in self.inlining and self.inlined < INLINE_LIMIT:
+			return self.bind_inlined(function, arguments)
+		
+		callable = function.as_callable()
+		if count == 0:
+			return lambda values: callable()
+		if count == 1:
+			argument = arguments[0]
+			return lambda values: callable(argument(values))
+		if count == 2:
+			first, second = arguments
+			return lambda values: callable(first(values), second(values))
+		return lambda values: callable(*[argument(values) for argument in arguments])
+	
+	def bind_inlined(self, function, arguments):
+		""" Binds the body of a UserFunction in place of its call """
+		slots = [self.local("{}.{}".format(function.name, parameter)) for parameter in function.parameters]
+		
+		self.scopes.append(dict(zip(function.parameters, slots)))
+		self.inlining.append(function.name)
+		try:
+			body = self.bind(function.body)
+		finally:
+			self.inlining.pop()
+			self.scopes.pop()
+		self.inlined += _size(function.body)
+		
+		if len(arguments) == 0:
+			return body
+		if len(arguments) == 1:
+			slot, = slots
+			argument, = arguments
+			def inlined(values):
+				values[slot] = argument(values)
+				return body(values)
+			return inlined
+		
+		if len(arguments) == 2:
+			first_slot, second_slot = slots
+			first, second = arguments
+			def inlined(values):
+				first_value = first(values)
+				values[second_slot] = second(values)
+				values[first_slot] = first_value
+				return body(values)
+			return inlined
+		
+		def inlined(values):
+			#all arguments are evaluated before the body, like a call
+			evaluated = [argument(values) for argument in arguments]
+			for slot, value in zip(slots, evaluated):
+				values[slot] = value
+			return body(values)
+		return inlined
+
+def _size(element):
+	count = 0
+	pending = [element]
+	while pending:
+		count += 1
+		pending.extend(children(pending.pop()))
+	return count
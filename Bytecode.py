@@ -0,0 +1,229 @@
+""" Compact postfix bytecode representation of formulas
+
+	A BytecodeFormula stores its instructions in two arrays (one byte per opcode and
+	one unsigned integer per operand) instead of a web of FormulaElement objects.
+	Literal values and variable / function names live in a SymbolTable that can be
+	shared by any number of formulas. A small stack machine evaluates the instructions.
+	
+	Instructions (operand in parentheses):
+	DECIMAL (literal index)		push the value of a decimal literal
+	CONST (constant index)		push a precomputed Constant value
+	LOAD (name index)			push a variable
+	STORE (name index)			assign the value on top of the stack to a variable
+	NEG							negate the value on top of the stack
+	ADD, SUB, MUL, DIV, MOD, FLOORDIV (chain flag), POW
+								combine the two values on top of the stack
+	CALL (name index), ARGC (argument count)
+								call a function with the topmost argument count values
+								(always emitted as a pair, the call happens at ARGC)
+	
+	The chain flag is only used to convert back to trees: 1 means the operator continues
+	the Sum or Product of its left operand (like 'a + b - c'), 0 means it starts a new
+	one (like '(a + b) - c'), so conversion to bytecode and back is lossless.
+"""
+
+import operator
+from array import array
+
+from FormulaStructure import (ParserError, AdditionalElement, Function, Sum, Product, Power,
+								Toplevel, Decimal, Variable, Constant)
+
+DECIMAL, CONST, LOAD, STORE, NEG, ADD, SUB, MUL, DIV, MOD, FLOORDIV, POW, CALL, ARGC = range(14)
+
+_SYMBOLS = {ADD: '+', SUB: '-', MUL: '*', DIV: '/', MOD: '%', FLOORDIV: '\\'}
+_OPCODES = {symbol: opcode for opcode, symbol in _SYMBOLS.items()}
+_FUNCTIONS = {ADD: operator.add, SUB: operator.sub, MUL: operator.mul, DIV: operator.truediv,
+				MOD: operator.mod, FLOORDIV: operator.floordiv, POW: operator.pow}
+
+class SymbolTable:
+	""" Literals, constants and names shared by BytecodeFormulas """
+	
+	def __init__(self):
+		self.literals = list()		#decimal literal strings
+		self.values = list()		#their float values, None for invalid literals
+		self.constants = list()		#values of Constant elements
+		self.names = list()			#variable and function names
+		self.indices = dict()		#(kind, key) -> index
+	
+	def literal(self, text):
+		key = ('literal', text)
+		if key not in self.indices:
+			try:
+				value = float(text)
+			except ValueError:
+				value = None #raises on evaluation, like Decimal.evaluate
+			self.indices[key] = len(self.literals)
+			self.literals.append(text)
+			self.values.append(value)
+		return self.indices[key]
+	
+	def constant(self, value):
+		key = ('constant', type(value), repr(value)) #repr keeps -0.0 and 0.0 apart
+		if key not in self.indices:
+			self.indices[key] = len(self.constants)
+			self.constants.append(value)
+		return self.indices[key]
+	
+	def name(self, name):
+		key = ('name', name)
+		if key not in self.indices:
+			self.indices[key] = len(self.names)
+			self.names.append(name)
+		return self.indices[key]
+
+default_table = SymbolTable()
+
+class BytecodeFormula:
+	""" Formula as postfix instructions over a SymbolTable """
+	
+	__slots__ = ("opcodes", "operands", "table")
+	
+	def __init__(self, opcodes, operands, table):
+		self.opcodes = opcodes
+		self.operands = operands
+		self.table = table
+	
+	def evaluate(self, context):
+		""" Evaluates the instructions in a given EvaluationContext """
+		values = self.table.values
+		names = self.table.names
+		functions = _FUNCTIONS
+		get_variable = context.get_variable
+		stack = list()
+		push = stack.append
+		pop = stack.pop
+		name = None
+		
+		for opcode, argument in zip(self.opcodes, self.operands):
+			if opcode >= ADD:
+				if opcode <= POW:
+					right = pop()
+					stack[-1] = functions[opcode](stack[-1], right)
+				elif opcode == CALL:
+					name = names[argument]
+				elif argument: #ARGC, performs the call
+					evaluated = stack[-argument:]
+					del stack[-argument:]
+					push(context.call_function(name, evaluated))
+				else:
+					push(context.call_function(name, []))
+			elif opcode == DECIMAL:
+				value = values[argument]
+				push(value if value is not None else float(self.table.literals[argument]))
+			elif opcode == LOAD:
+				push(get_variable(names[argument]))
+			elif opcode == CONST:
+				push(self.table.constants[argument])
+			elif opcode == NEG:
+				stack[-1] = - stack[-1]
+			elif opcode == STORE:
+				stack[-1] = context.set_variable(names[argument], stack[-1])
+			else:
+				raise ParserError("Unknown opcode {}".format(opcode))
+		
+		return stack[-1]
+	
+	def to_tree(self):
+		""" Converts the instructions back to the FormulaElement tree they were assembled from """
+		opcodes = self.opcodes
+		operands = self.operands
+		table = self.table
+		stack = list()
+		
+		pc = 0
+		while pc < len(opcodes):
+			opcode = opcodes[pc]
+			argument = operands[pc]
+			pc += 1
+			
+			if opcode == DECIMAL:
+				stack.append(Decimal(table.literals[argument]))
+			elif opcode == CONST:
+				stack.append(Constant(table.constants[argument]))
+			elif opcode == LOAD:
+				stack.append(Variable(table.names[argument]))
+			elif opcode == STORE:
+				stack[-1] = Toplevel(Variable(table.names[argument]), AdditionalElement('=', stack[-1]))
+			elif opcode == NEG:
+				stack[-1] = Toplevel("", AdditionalElement('-', stack[-1]))
+			elif opcode == POW:
+				exponent = stack.pop()
+				stack[-1] = Power(stack[-1], exponent)
+			elif opcode in _SYMBOLS:
+				right = AdditionalElement(_SYMBOLS[opcode], stack.pop())
+				if argument:
+					stack[-1].additional.append(right)
+				else:
+					element = Sum if opcode in (ADD, SUB) else Product
+					stack[-1] = element(stack[-1], [right])
+			elif opcode == CALL:
+				arguments = operands[pc]
+				pc += 1
+				evaluated = stack[len(stack) - arguments:]
+				del stack[len(stack) - arguments:]
+				stack.append(Function(table.names[argument], evaluated))
+			else:
+				raise ParserError("Unknown opcode {}".format(opcode))
+		
+		return stack[-1]
+	
+	def __len__(self):
+		return len(self.opcodes)
+	
+	def __str__(self):
+		return "[{}: {} instructions]".format(self.__class__.__name__, len(self.opcodes))
+	
+	def __repr__(self):
+		return str(self)
+
+def assemble(element, table=None):
+	""" Converts a FormulaElement tree into a BytecodeFormula (without recursion) """
+	table = table if table is not None else default_table
+	opcodes = array('B')
+	operands = array('I')
+	
+	def emit(opcode, operand=0):
+		opcodes.append(opcode)
+		operands.append(operand)
+	
+	#pending holds elements to visit and instructions to emit after their operands
+	pending = [element]
+	while pending:
+		current = pending.pop()
+		
+		if isinstance(current, tuple):
+			emit(*current)
+		elif isinstance(current, Decimal):
+			emit(DECIMAL, table.literal(current.value))
+		elif isinstance(current, Constant):
+			emit(CONST, table.constant(current.value))
+		elif isinstance(current, Variable):
+			emit(LOAD, table.name(current.value))
+		elif isinstance(current, (Sum, Product)):
+			steps = [current.value]
+			for index, add in enumerate(current.additional):
+				if add.operator not in _OPCODES:
+					raise ParserError("Unexpected operator '{}'".format(add.operator))
+				steps.extend((add.value, (_OPCODES[add.operator], 1 if index > 0 else 0)))
+			pending.extend(reversed(steps))
+		elif isinstance(current, Power):
+			if current.exponent is None:
+				pending.append(current.value)
+			else:
+				pending.extend(((POW, 0), current.exponent, current.value))
+		elif isinstance(current, Toplevel):
+			if not isinstance(current.additional, AdditionalElement):
+				pending.append(current.value)
+			elif current.additional.operator == '=':
+				pending.extend(((STORE, table.name(current.value.value)), current.additional.value))
+			elif current.additional.operator == '-':
+				pending.extend(((NEG, 0), current.additional.value))
+			else:
+				raise ParserError("Expected operator '-' or '=', but found '{}'".format(current.additional.operator))
+		elif isinstance(current, Function):
+			pending.extend(((ARGC, len(current.arguments)), (CALL, table.name(current.name))))
+			pending.extend(reversed(current.arguments))
+		else:
+			raise ParserError("Cannot assemble '{}'".format(current))
+	
+	return BytecodeFormula(opcodes, operands, table)
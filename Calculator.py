@@ -2,18 +2,27 @@
 
 """ Calculator class """
 
+import argparse
+import sys
+import time
+import weakref
+
 from Evaluator import EvaluationError, EvaluationFunction, EvaluationContext
-from FormulaStructure import ParserError, FormulaElement, Sum
-from Lexer import LexerLexeme, LexerParenthesis, LexerSymbol, LexerName, LexerValue, LexerError, Lexer
+from FormulaStructure import ParserError, FormulaElement, depth, evaluate_iterative
+from Lexer import LexerLexeme, LexerParenthesis, LexerSymbol, LexerName, LexerValue, LexerError
+from Parser import default_cache
+from Tiering import TieredEvaluator
 
 class Calculator:
 	""" Very cool calculator class using all the other cool classes """
 	
 	def __init__(self):
-		self.lexer = Lexer()
+		self.parse_cache = default_cache
 		self.context = EvaluationContext()
-		self.builtins = ["exit", "debug", "help", "vars", "functions"]
+		self.builtins = ["exit", "debug", "help", "vars", "functions", "stats"]
 		self.debug = False
+		self.deep_formulas = weakref.WeakKeyDictionary() #parsed formula -> needs evaluate_iterative
+		self.tiered = TieredEvaluator(self.context) #promotes formulas evaluated again and again
 	
 	def main(self):
 		""" Main function. Who would have expected this? """
@@ -22,8 +31,7 @@ class Calculator:
 		print()
 		print("Note: Not every function will work with complex numbers.")
 		print("Note: use debug command to toggle debug mode (syntax tree output).")
-		print("Note: this version does not (yet?) support function definitions at runtime.")
-		#TODO: some mechanism to insert lambda function definitions at runtime?
+		print("Note: functions can be defined at runtime, e.g. f(x, y) = x^2 + y")
 		print()
 		self.handle_builtin("help")
 		
@@ -36,17 +44,16 @@ class Calculator:
 					self.handle_builtin(formula)
 					continue
 				
-				lexemes = self.lexer.lexe(formula)
-				parsed = Sum.parse(lexemes)
-				if len(lexemes) != 0:
-					raise ParserError("Formula did not parse completely," +
-										"remaining lexemes are: {}".format(lexemes))
+				parsed = self.parse_cache.parse(formula, stats=self.context.stats)
 				
 				if (self.debug):
 					print("Input was parsed as this simplified syntax tree:")
 					self.pretty_print(str(parsed))
 				
-				result = parsed.evaluate(self.context)
+				result = self.evaluate(parsed)
+				if isinstance(result, EvaluationFunction):
+					print("Defined {}".format(self.format_signature(result)))
+					continue
 				self.context.set_variable("ans", result)
 				
 				print(self.format_result(result))
@@ -64,6 +71,59 @@ class Calculator:
 				print("Exiting.")
 				break	
 	
+	def batch(self, lines, output):
+		""" Non-interactive mode: evaluates one formula per line and writes one result
+			or error per line to output. Lines are consumed lazily, so memory use does
+			not depend on the input size. Returns the number of evaluated formulas. """
+		count = 0
+		for result in self.evaluate_lines(line.strip() for line in lines):
+			output.write(result)
+			output.write("\n")
+			count += 1
+		return count
+	
+	def evaluate_lines(self, formulas):
+		""" Yields formatted results or errors, sharing this calculator's context (and ans) """
+		for formula in formulas:
+			if not formula:
+				continue
+			
+			try:
+				result = self.evaluate(self.parse_cache.parse(formula, stats=self.context.stats))
+				if isinstance(result, EvaluationFunction):
+					yield "Defined {}".format(self.format_signature(result))
+					continue
+				self.context.set_variable("ans", result)
+				yield self.format_result(result)
+			except ParserError as e:
+				yield "ParserError: {}".format(e)
+			except LexerError as e:
+				yield "LexerError: {}".format(e)
+			except (EvaluationError, ValueError, TypeError, ArithmeticError) as e:
+				yield "EvaluationError: {}".format(e)
+	
+	def evaluate(self, parsed):
+		""" Evaluates a parsed formula, timed if statistics are enabled """
+		stats = self.context.stats
+		if stats is None:
+			return self._evaluate(parsed)
+		
+		with stats.time("evaluate"):
+			result = self._evaluate(parsed)
+		stats.record_evaluation(parsed)
+		return result
+	
+	def _evaluate(self, parsed):
+		""" Uses the faster recursive (and tiered) evaluation unless the formula is too deeply nested for it """
+		deep = self.deep_formulas.get(parsed)
+		if deep is None:
+			deep = depth(parsed) > sys.getrecursionlimit() // 4
+			self.deep_formulas[parsed] = deep
+		
+		if deep:
+			return evaluate_iterative(parsed, self.context)
+		return self.tiered.evaluate(parsed)
+	
 	def pretty_print(self, tree, indent=4):
 		""" Very, very, very bad pretty print function.
 			I couldn't imagine a clean way to pretty print these syntax tree strings... """
@@ -116,29 +176,49 @@ class Calculator:
 			
 			print("There are currently {} supported functions:".format(len(functions)))
 			for key in functions:
-				string = "{}(".format(key)
-				
-				function = self.context.functions[key]
-				maximum = function.arity if function.arity >= 0 else abs(function.arity) - 1
-				
-				for i in range(maximum):
-					if i != 0:
-						string += ", "
-					
-					string += chr(ord("a") + i)
-				
-				if function.arity < -1:
-					string += ", *"
-				elif function.arity == -1:
-					string += "*"
-				
-				string += ") => {}".format(self.context.functions[key].description)
+				string = self.format_signature(self.context.functions[key], key)
+				string += " => {}".format(self.context.functions[key].description)
 				print(string)
 		
+		elif builtin == "stats":
+			if self.context.stats is None:
+				self.context.enable_stats()
+				print("Statistics turned on, use stats again to show and turn them off")
+			else:
+				print(self.context.stats.report())
+				print(self.tiered)
+				self.context.disable_stats()
+				print("Statistics turned off")
+		
 		elif builtin == "debug":
 			self.debug = not self.debug
 			print("Debug mode turned {}".format("on" if self.debug else "off"))
 	
+	def format_signature(self, function, name=None):
+		""" Returns e.g. f(x, y) for user defined functions and log(a, b) for others """
+		if name is None:
+			name = function.name
+		
+		parameters = getattr(function, "parameters", None)
+		if parameters is not None:
+			return "{}({})".format(name, ", ".join(parameters))
+		
+		string = "{}(".format(name)
+		maximum = function.arity if function.arity >= 0 else abs(function.arity) - 1
+		
+		for i in range(maximum):
+			if i != 0:
+				string += ", "
+			
+			string += chr(ord("a") + i)
+		
+		if function.arity < -1:
+			string += ", *"
+		elif function.arity == -1:
+			string += "*"
+		
+		return string + ")"
+	
 	def format_result(self, result):
 		if isinstance(result, complex):
 			string = str(result)
@@ -150,4 +230,19 @@ class Calculator:
 			return '{}'.format(result)
 
 if __name__ == '__main__':
-	Calculator().main()
+	parser = argparse.ArgumentParser(description="Mathematical formula calculator")
+	parser.add_argument("--batch", nargs="?", const="-", metavar="FILE",
+						help="evaluate one formula per line of FILE (or stdin) instead of running interactively")
+	arguments = parser.parse_args()
+	
+	if arguments.batch is None:
+		Calculator().main()
+	else:
+		source = sys.stdin if arguments.batch == "-" else open(arguments.batch)
+		start = time.perf_counter()
+		with source:
+			count = Calculator().batch(source, sys.stdout)
+		sys.stdout.flush()
+		elapsed = time.perf_counter() - start
+		print("Evaluated {} formulas in {:.3f}s ({:.0f} formulas/s)".format(count, elapsed,
+				count / elapsed if elapsed > 0 else 0), file=sys.stderr)
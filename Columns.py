@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+""" Chunked streaming evaluation over columnar data files
+	
+	A ColumnStream maps the variables of a formula to the columns of a source and
+	evaluates the formula for every row, one chunk of rows at a time, writing each
+	chunk of results to an output before the next one is read. Memory is bounded by
+	the chunk size, not by the size of the files.
+	
+	Sources are CSV files with a header row (CSVColumns) and raw binary column files,
+	one file of native machine values per column (BinaryColumns), which are memory
+	mapped. Rows raising an EvaluationError, ValueError or ArithmeticError, values
+	that are not numbers and complex results with an imaginary part result in nan.
+	The errors of a ChunkReport count the rows resulting in nan, whatever the reason.
+	
+	python3 Columns.py "x * y + z" input.csv output.csv --map z=offset evaluates from
+	the command line and reports the throughput of every chunk.
+"""
+
+import argparse
+import csv
+import math
+import mmap
+import sys
+import time
+from array import array
+
+from Compiler import Compiler
+from Evaluator import EvaluationError, EvaluationContext
+from FormulaStructure import has_assignment, free_variables
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+class ColumnError(RuntimeError):
+	pass
+
+class CSVColumns:
+	""" CSV file whose first row names the columns """
+	
+	def __init__(self, path, delimiter=','):
+		self.path = path
+		self.delimiter = delimiter
+		with open(path, newline='') as file:
+			self.names = next(csv.reader(file, delimiter=delimiter), [])
+	
+	def chunks(self, columns, size):
+		""" Yields dictionaries of column name -> list of at most size values """
+		indices = list()
+		for name in columns:
+			if name not in self.names:
+				raise ColumnError("Unknown column '{}' in {}".format(name, self.path))
+			indices.append(self.names.index(name))
+		
+		with open(self.path, newline='') as file:
+			reader = csv.reader(file, delimiter=self.delimiter)
+			next(reader, None)
+			
+			while True:
+				values = [list() for name in columns]
+				for row in reader:
+					if not row:
+						continue
+					for column, index in zip(values, indices):
+						column.append(_number(row[index]) if index < len(row) else math.nan)
+					if len(values[0]) == size:
+						break
+				
+				if not values[0]:
+					return
+				yield dict(zip(columns, values))
+
+def _number(text):
+	try:
+		return float(text)
+	except ValueError:
+		return math.nan
+
+class BinaryColumns:
+	""" Raw binary columns, one file per column holding values of an array typecode
+		(native byte order), e.g. 'd' for doubles. The files are memory mapped. """
+	
+	def __init__(self, paths, typecode='d'):
+		self.paths = dict(paths)
+		self.typecode = typecode
+		self.names = list(self.paths)
+	
+	def chunks(self, columns, size):
+		""" Yields dictionaries of column name -> memoryview of at most size values """
+		itemsize = array(self.typecode).itemsize
+		files = list()
+		views = dict()
+		try:
+			for name in columns:
+				if name not in self.paths:
+					raise ColumnError("Unknown column '{}'".format(name))
+				file = open(self.paths[name], 'rb')
+				files.append(file)
+				length = file.seek(0, 2)
+				if length % itemsize:
+					raise ColumnError("Size of {} is not a multiple of {} bytes".format(self.paths[name], itemsize))
+				if length:
+					mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+					files.append(mapped)
+					views[name] = memoryview(mapped).cast(self.typecode)
+				else:
+					views[name] = memoryview(array(self.typecode))
+			
+			rows = {len(view) for view in views.values()}
+			if len(rows) > 1:
+				raise ColumnError("Columns have different numbers of rows: {}".format(sorted(rows)))
+			
+			total = rows.pop() if rows else 0
+			for start in range(0, total, size):
+				chunk = {name: view[start:start + size] for name, view in views.items()}
+				try:
+					yield chunk
+				finally:
+					#views have to be released before the maps can be closed
+					for view in chunk.values():
+						view.release()
+		finally:
+			for view in views.values():
+				view.release()
+			for file in reversed(files):
+				file.close()
+
+class CSVOutput:
+	""" Writes results as a CSV file with one column """
+	
+	def __init__(self, path, name="result"):
+		self.file = open(path, 'w', newline='')
+		self.writer = csv.writer(self.file)
+		self.writer.writerow([name])
+	
+	def write(self, values):
+		self.writer.writerows((repr(value),) for value in values)
+	
+	def close(self):
+		self.file.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exception):
+		self.close()
+
+class BinaryOutput:
+	""" Writes results as a raw binary column of an array typecode """
+	
+	def __init__(self, path, typecode='d'):
+		self.file = open(path, 'wb')
+		self.typecode = typecode
+	
+	def write(self, values):
+		array(self.typecode, values).tofile(self.file)
+	
+	def close(self):
+		self.file.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exception):
+		self.close()
+
+class ChunkReport:
+	""" Rows, errors (rows resulting in nan) and evaluation time of one chunk """
+	
+	def __init__(self, index, rows, errors, seconds):
+		self.index = index
+		self.rows = rows
+		self.errors = errors
+		self.seconds = seconds
+	
+	def rows_per_second(self):
+		return self.rows / self.seconds if self.seconds > 0 else 0.0
+	
+	def __str__(self):
+		return "chunk {}: {} rows, {} errors, {:.3f}s ({:.0f} rows/s)".format(self.index, self.rows,
+					self.errors, self.seconds, self.rows_per_second())
+
+class ColumnStream:
+	""" Evaluates a parsed formula for every row of a column source.
+		mapping maps variable names to column names, variables of the formula that are not
+		mapped are read from the column of the same name if the source has one.
+		With vectorized set, chunks are evaluated as NumPy arrays (see Vectorizer). """
+	
+	def __init__(self, element, context=None, mapping=None, chunksize=65536, vectorized=False):
+		if vectorized and numpy is None:
+			raise EvaluationError("Vectorized evaluation requires NumPy")
+		
+		self.element = element
+		#a fork, assignments of the formula do not leak into the given context
+		self.context = (context if context is not None else EvaluationContext()).fork()
+		self.mapping = dict(mapping) if mapping is not None else dict()
+		self.chunksize = chunksize
+		self.vectorized = vectorized
+	
+	def columns(self, source):
+		""" Returns the mapping of variable names to columns of source used by run """
+		mapping = dict(self.mapping)
+		for name in free_variables(self.element):
+			if name not in mapping and name in source.names:
+				mapping[name] = name
+		for name in mapping:
+			if name in self.context.constants:
+				raise EvaluationError("Assignment to constant '{}' not allowed".format(name))
+		if not mapping:
+			raise ColumnError("Formula does not read any column")
+		return mapping
+	
+	def run(self, source, output, report=None):
+		""" Evaluates all rows of source, writing each chunk of results to output.
+			report(ChunkReport) is called after every chunk, its time includes reading and
+			writing the chunk. Returns the list of reports. """
+		mapping = self.columns(source)
+		names = list(mapping)
+		columns = [mapping[name] for name in names]
+		evaluate = self._vectorized if self.vectorized else self._rows()
+		
+		reports = list()
+		start = time.perf_counter()
+		for index, chunk in enumerate(source.chunks(sorted(set(columns)), self.chunksize)):
+			values, errors = evaluate(names, [chunk[column] for column in columns])
+			output.write(values)
+			
+			end = time.perf_counter()
+			reports.append(ChunkReport(index, len(values), errors, end - start))
+			if report is not None:
+				report(reports[-1])
+			start = end
+		return reports
+	
+	def _rows(self):
+		""" Returns a function evaluating the compiled formula row by row """
+		context = self.context
+		compiled = Compiler(context).compile(self.element).evaluate
+		#formulas with assignments see the same variables in every row
+		base = dict(context.variables) if has_assignment(self.element) else None
+		
+		def evaluate(names, columns):
+			values = list()
+			variables = context.variables
+			for row in zip(*columns):
+				if base is not None:
+					variables = context.variables = dict(base)
+				variables.update(zip(names, row))
+				try:
+					result = compiled(context)
+					if isinstance(result, complex):
+						result = result.real if result.imag == 0 else math.nan
+					values.append(float(result))
+				except (EvaluationError, ValueError, TypeError, ArithmeticError, RecursionError):
+					values.append(math.nan)
+			return values, sum(1 for value in values if value != value) #nan
+		return evaluate
+	
+	def _vectorized(self, names, columns):
+		from Vectorizer import evaluate_vectorized
+		
+		#copies, arrays must not keep the memory maps of BinaryColumns alive
+		arrays = {name: numpy.array(column, dtype=float) for name, column in zip(names, columns)}
+		with numpy.errstate(all='ignore'):
+			result = evaluate_vectorized(self.element, self.context, True, **arrays)
+		result = numpy.broadcast_to(result, (len(columns[0]) if columns else 0,))
+		if numpy.iscomplexobj(result):
+			result = numpy.where(result.imag == 0, result.real, math.nan)
+		result = result.astype(float)
+		return result, int(numpy.count_nonzero(numpy.isnan(result)))
+
+def _mapping(text):
+	variable, separator, column = text.partition("=")
+	if not separator:
+		raise argparse.ArgumentTypeError("Expected variable=column, got '{}'".format(text))
+	return variable, column
+
+if __name__ == '__main__':
+	from Parser import default_cache
+	
+	parser = argparse.ArgumentParser(description="Evaluates a formula for every row of a CSV file or binary columns")
+	parser.add_argument("formula")
+	parser.add_argument("input", help="CSV file, or column=path,... for binary columns")
+	parser.add_argument("output", help="CSV file if it ends with .csv, raw binary column otherwise")
+	parser.add_argument("--map", type=_mapping, action="append", default=[], metavar="variable=column")
+	parser.add_argument("--typecode", default='d', help="array typecode of binary columns")
+	parser.add_argument("--chunksize", type=int, default=65536)
+	parser.add_argument("--vectorized", action="store_true", help="evaluate chunks with NumPy")
+	arguments = parser.parse_args()
+	
+	if arguments.input.endswith(".csv"):
+		source = CSVColumns(arguments.input)
+	else:
+		source = BinaryColumns(dict(_mapping(column) for column in arguments.input.split(",")), arguments.typecode)
+	
+	if arguments.output.endswith(".csv"):
+		output = CSVOutput(arguments.output)
+	else:
+		output = BinaryOutput(arguments.output)
+	
+	stream = ColumnStream(default_cache.parse(arguments.formula), mapping=dict(arguments.map),
+							chunksize=arguments.chunksize, vectorized=arguments.vectorized)
+	with output:
+		reports = stream.run(source, output, lambda report: print(report, file=sys.stderr))
+	
+	rows = sum(report.rows for report in reports)
+	seconds = sum(report.seconds for report in reports)
+	print("{} rows in {} chunks, {} errors, {:.0f} rows/s".format(rows, len(reports),
+			sum(report.errors for report in reports), rows / seconds if seconds > 0 else 0.0))
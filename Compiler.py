@@ -0,0 +1,394 @@
+""" Compiles formula elements into native Python functions
+
+	The generated function evaluates every node of the syntax tree into a local
+	variable (one line per Sum, Product, Power, negation, assignment or function call),
+	so evaluation costs a few bytecodes per node instead of a method call.
+	Variables that are not assigned inside the formula and all functions are looked up
+	once per evaluation and kept in fast locals. Unknown variables and functions are
+	therefore reported before the formula's assignments take place.
+	
+	Calls of user defined functions (see Binder.UserFunction) known to the Compiler's
+	context are inlined. The generated function checks that these functions are still
+	the same objects and falls back to evaluating the syntax tree otherwise.
+"""
+
+import math
+
+from Binder import UserFunction, INLINE_LIMIT
+from Evaluator import EvaluationError, EvaluationContext
+from FormulaStructure import (ParserError, AdditionalElement, Function, Sum, Product, Power,
+								Toplevel, Decimal, Variable, Constant, Definition, children as _children)
+
+def _load(variables, name):
+	if name in variables:
+		return variables[name]
+	else:
+		raise EvaluationError("Unknown variable '{}'".format(name))
+
+def _store(variables, constants, name, value):
+	if name in constants:
+		raise EvaluationError("Assignment to constant '{}' not allowed".format(name))
+	variables[name] = value
+	return value
+
+def _accepts(function, count):
+	return (function.arity < 0 and abs(function.arity) - 1 <= count) or function.arity == count
+
+def _resolve(functions, name, count):
+	""" Looks up a function and validates its arity for count arguments """
+	if name in functions:
+		function = functions[name]
+		if _accepts(function, count):
+			return function.as_callable()
+		else:
+			arity = function.arity if function.arity >= 0 else abs(function.arity) - 1
+			raise EvaluationError("Function '{}' has arity {}, but got {} arguments.".format(name, arity, count))
+	else:
+		raise EvaluationError("Function '{}' not found.".format(name))
+
+def _define(context, name, parameters, body):
+	if not hasattr(context, "define_function"):
+		raise EvaluationError("Function '{}' can only be defined in an EvaluationContext".format(name))
+	return context.define_function(name, parameters, body)
+
+class BatchStatistics:
+	""" Node counts of a CompiledBatch """
+	
+	def __init__(self, formulas, nodes, distinct):
+		self.formulas = formulas
+		self.nodes = nodes			#nodes of all syntax trees
+		self.distinct = distinct	#nodes evaluated per call after sharing equal subtrees
+		self.deduplicated = nodes - distinct
+	
+	def __str__(self):
+		return "{} formulas, {} nodes, {} distinct, {} deduplicated".format(self.formulas,
+					self.nodes, self.distinct, self.deduplicated)
+
+class _Bindings:
+	""" Minimal stand-in for an EvaluationContext, used for calls with keyword bindings """
+	
+	def __init__(self, variables, functions, constants):
+		self.variables = variables
+		self.functions = functions
+		self.constants = constants
+
+class CompiledFormula:
+	""" Python function compiled from a formula element.
+		Call with an EvaluationContext or with variable bindings as keyword arguments. """
+	
+	def __init__(self, element, source, function, defaults):
+		self.element = element
+		self.source = source
+		self.function = function
+		self.defaults = defaults
+		#evaluate(context) is the generated function itself, without any wrapper
+		self.evaluate = function
+	
+	def __call__(self, context=None, **bindings):
+		if context is not None and not bindings:
+			return self.function(context)
+		
+		if context is not None:
+			raise TypeError("Bindings can only be used without an EvaluationContext")
+		
+		#bindings are evaluated on a copy, assignments do not leak into the default context
+		context = self.defaults
+		variables = dict(context.variables)
+		for name, value in bindings.items():
+			_store(variables, context.constants, name, value)
+		return self.function(_Bindings(variables, context.functions, context.constants))
+	
+	def __str__(self):
+		return "[{}: {}]".format(self.__class__.__name__, self.element)
+	
+	def __repr__(self):
+		return "[{}: {}]".format(self.__class__.__name__, self.element)
+
+class CompiledBatch(CompiledFormula):
+	""" Many formulas compiled into one function, which returns the list of their results """
+	
+	def __init__(self, elements, source, function, defaults, statistics):
+		super().__init__(elements, source, function, defaults)
+		self.elements = elements
+		self.statistics = statistics
+
+class _CodeGenerator:
+	""" Emits one line of Python source per inner node of a syntax tree """
+	
+	def __init__(self, inline=None):
+		self.inline = inline		#functions of the compile time context, user defined ones are inlined
+		self.guards = dict()		#name -> constant holding the inlined UserFunction
+		self.scopes = list()		#parameter name -> expression, of the inlined body being generated
+		self.inlining = list()		#names of the functions being inlined
+		self.inlined = 0			#nodes of inlined bodies
+		self.lookups = list()		#fast dictionary lookups of variables and functions
+		self.prologue = list()		#slow path for lookups, raises the appropriate EvaluationError
+		self.unwrap = list()		#arity checks, replaces EvaluationFunctions by their callables
+		self.body = list()
+		self.variables = dict()		#name -> local holding the preloaded value
+		self.functions = dict()		#(name, argument count) -> local holding the callable
+		self.assigned = set()		#variables assigned inside the formula, never preloaded
+		self.constants = list()		#values without a literal representation, bound as globals k0, k1, ...
+		self.temporaries = 0
+	
+	def temporary(self, expression):
+		name = "t{}".format(self.temporaries)
+		self.temporaries += 1
+		self.body.append("{} = {}".format(name, expression))
+		return name
+	
+	def literal(self, value):
+		""" Returns a Python literal for value, or a global name bound to it """
+		if type(value) in (int, float) and math.isfinite(value):
+			literal = repr(value)
+			return "({})".format(literal) if literal.startswith('-') else literal
+		name = "k{}".format(len(self.constants))
+		self.constants.append(value)
+		return name
+	
+	def collect_assignments(self, element):
+		if isinstance(element, Toplevel) and element.additional.operator == '=':
+			self.assigned.add(element.value.value)
+		for child in _children(element):
+			self.collect_assignments(child)
+	
+	def generate(self, element):
+		""" Emits code for element and returns a Python expression (a local or literal) holding its value """
+		if isinstance(element, Decimal):
+			try:
+				value = float(element.value)
+			except ValueError:
+				#keep the ValueError at evaluation time, like Decimal.evaluate
+				return self.temporary("float({!r})".format(element.value))
+			return self.literal(value)
+		
+		if isinstance(element, Constant):
+			return self.literal(element.value)
+		
+		if isinstance(element, Variable):
+			if self.scopes and element.value in self.scopes[-1]:
+				return self.scopes[-1][element.value]
+			if element.value in self.assigned:
+				return self.temporary("_load(_variables, {!r})".format(element.value))
+			if element.value not in self.variables:
+				local = "v{}".format(len(self.variables))
+				self.lookups.append("{} = _variables[{!r}]".format(local, element.value))
+				self.prologue.append("{} = _load(_variables, {!r})".format(local, element.value))
+				self.variables[element.value] = local
+			return self.variables[element.value]
+		
+		if isinstance(element, Function):
+			arguments = [self.generate(argument) for argument in element.arguments]
+			function = self.inlineable(element)
+			if function is not None:
+				return self.generate_inlined(function, arguments)
+			
+			key = (element.name, len(arguments))
+			if key not in self.functions:
+				local = "f{}".format(len(self.functions))
+				resolve = "_resolve(_functions, {!r}, {})".format(element.name, len(arguments))
+				self.lookups.append("{} = _functions[{!r}]".format(local, element.name))
+				self.prologue.append("{} = {}".format(local, resolve))
+				known = self.inline.get(element.name) if self.inline is not None else None
+				if known is not None and _accepts(known, len(arguments)):
+					#the function seen at compile time is unwrapped once, others on every call
+					self.unwrap.append("{0} = {1} if {0} is {2} else {3}".format(local,
+										self.literal(known.as_callable()), self.literal(known), resolve))
+				else:
+					self.unwrap.append("{0} = {0}.as_callable() if {0}.arity == {1} else {2}".format(local, len(arguments), resolve))
+				self.functions[key] = local
+			return self.temporary("{}({})".format(self.functions[key], ", ".join(arguments)))
+		
+		if isinstance(element, (Sum, Product)):
+			#one line per operator keeps the tree's order of evaluation (and of errors)
+			value = self.generate(element.value)
+			for add in element.additional:
+				operand = self.generate(add.value)
+				value = self.temporary("{} {} {}".format(value, _OPERATORS[add.operator], operand))
+			return value
+		
+		if isinstance(element, Power):
+			base = self.generate(element.value)
+			if element.exponent is None:
+				return base
+			return self.temporary("{} ** {}".format(base, self.generate(element.exponent)))
+		
+		if isinstance(element, Toplevel):
+			if not isinstance(element.additional, AdditionalElement):
+				return self.generate(element.value)
+			value = self.generate(element.additional.value)
+			if element.additional.operator == '=':
+				return self.temporary("_store(_variables, _constants, {!r}, {})".format(element.value.value, value))
+			if element.additional.operator == '-':
+				return self.temporary("-{}".format(value))
+			raise ParserError("Expected operator '-' or '=', but found '{}'".format(element.additional.operator))
+		
+		if isinstance(element, Definition):
+			return self.temporary("_define(_context, {!r}, {!r}, {})".format(element.name,
+									element.parameters, self.literal(element.body)))
+		
+		raise ParserError("Cannot compile '{}'".format(element))
+	
+	def inlineable(self, element):
+		""" Returns the UserFunction to inline in place of a call, or None """
+		if self.inline is None or self.inlined >= INLINE_LIMIT:
+			return None
+		function = self.inline.get(element.name)
+		if (not isinstance(function, UserFunction) or function.arity != len(element.arguments)
+				or element.name in self.inlining):
+			return None
+		
+		#assignments and definitions in the body are left to the function itself
+		pending = [function.body]
+		while pending:
+			current = pending.pop()
+			if isinstance(current, Definition) or (isinstance(current, Toplevel) and
+					isinstance(current.additional, AdditionalElement) and current.additional.operator == '='):
+				return None
+			pending.extend(_children(current))
+		return function
+	
+	def generate_inlined(self, function, arguments):
+		if function.name not in self.guards:
+			self.guards[function.name] = self.literal(function)
+		
+		self.scopes.append(dict(zip(function.parameters, arguments)))
+		self.inlining.append(function.name)
+		try:
+			result = self.generate(function.body)
+		finally:
+			self.inlining.pop()
+			self.scopes.pop()
+		self.inlined += _count(function.body)
+		return result
+	
+	def source(self, result):
+		lines = ["def _compiled(_context):"]
+		for name in ("_variables", "_functions", "_constants"):
+			if any(name in line for line in self.prologue + self.unwrap + self.body) or (name == "_functions" and self.guards):
+				lines.append("\t{} = _context.{}".format(name, name[1:]))
+		for name, constant in self.guards.items():
+			lines.append("\tif _functions.get({!r}) is not {}:".format(name, constant))
+			lines.append("\t\treturn _fallback(_context)")
+		if self.lookups:
+			lines.append("\ttry:")
+			lines.extend("\t\t" + line for line in self.lookups)
+			lines.append("\texcept KeyError:")
+			lines.extend("\t\t" + line for line in self.prologue)
+		lines.extend("\t" + line for line in self.unwrap + self.body)
+		lines.append("\treturn {}".format(result))
+		return "\n".join(lines) + "\n"
+
+class _SharingCodeGenerator(_CodeGenerator):
+	""" Code generator that evaluates structurally equal subtrees only once (hash consing).
+		Calls of impure functions and assignments are never shared. """
+	
+	def __init__(self, functions):
+		super().__init__()
+		self.purity = functions		#functions used to decide whether a call may be shared
+		self.structures = dict()	#structure tuple -> structure id
+		self.identities = dict()	#id(element) -> structure id or None if not shareable
+		self.shared = dict()		#structure id -> expression holding its value
+		self.distinct = 0
+	
+	def generate(self, element):
+		structure = self.structure(element)
+		if structure is not None and structure in self.shared:
+			return self.shared[structure]
+		
+		expression = super().generate(element)
+		self.distinct += 1
+		if structure is not None:
+			self.shared[structure] = expression
+		return expression
+	
+	def structure(self, element):
+		""" Returns an integer identifying the structure of element, equal for equal subtrees """
+		identity = id(element)
+		if identity in self.identities:
+			return self.identities[identity]
+		
+		structure = self._describe(element)
+		if structure is not None:
+			structure = self.structures.setdefault(structure, len(self.structures))
+		self.identities[identity] = structure
+		return structure
+	
+	def _describe(self, element):
+		if isinstance(element, Decimal):
+			try:
+				value = float(element.value)
+			except ValueError:
+				return ('literal', element.value)
+			return ('constant', float, repr(value))
+		if isinstance(element, Constant):
+			return ('constant', type(element.value), repr(element.value))
+		if isinstance(element, Variable):
+			return ('variable', element.value)
+		if isinstance(element, Definition):
+			return None
+		if isinstance(element, Toplevel) and isinstance(element.additional, AdditionalElement):
+			if element.additional.operator != '-':
+				return None
+			description = ('-',)
+		elif isinstance(element, Function):
+			function = self.purity.get(element.name)
+			if function is None or not function.pure:
+				return None
+			description = ('function', element.name)
+		elif isinstance(element, (Sum, Product)):
+			description = (element.__class__.__name__,) + tuple(add.operator for add in element.additional)
+		else:
+			description = (element.__class__.__name__,)
+		
+		children = tuple(self.structure(child) for child in _children(element))
+		if None in children:
+			return None
+		return description + children
+
+_OPERATORS = {'+': '+', '-': '-', '*': '*', '/': '/', '%': '%', '\\': '//'}
+
+def _count(element):
+	""" Returns the number of nodes of a syntax tree """
+	count = 0
+	pending = [element]
+	while pending:
+		count += 1
+		pending.extend(_children(pending.pop()))
+	return count
+
+class Compiler:
+	""" Compiles parsed formulas into CompiledFormula instances """
+	
+	def __init__(self, context=None):
+		#context providing variables, constants and functions for calls with keyword bindings
+		self.context = context if context is not None else EvaluationContext()
+	
+	def compile(self, element):
+		generator = _CodeGenerator(self.context.functions)
+		generator.collect_assignments(element)
+		source = generator.source(generator.generate(element))
+		return CompiledFormula(element, source, self._build(source, generator, element), self.context)
+	
+	def compile_batch(self, elements):
+		""" Compiles many formulas into one function returning the list of their results.
+			Structurally equal subtrees are evaluated once for the whole batch. """
+		elements = list(elements)
+		generator = _SharingCodeGenerator(self.context.functions)
+		for element in elements:
+			generator.collect_assignments(element)
+		if generator.assigned:
+			raise EvaluationError("Assignments are not supported in batch programs")
+		
+		results = [generator.generate(element) for element in elements]
+		source = generator.source("[{}]".format(", ".join(results)))
+		
+		statistics = BatchStatistics(len(elements), sum(_count(element) for element in elements), generator.distinct)
+		return CompiledBatch(elements, source, self._build(source, generator), self.context, statistics)
+	
+	def _build(self, source, generator, element=None):
+		namespace = {"_load": _load, "_store": _store, "_resolve": _resolve, "_define": _define,
+						"_fallback": element.evaluate if element is not None else None}
+		namespace.update(("k{}".format(index), value) for index, value in enumerate(generator.constants))
+		exec(compile(source, "<formula>", "exec"), namespace)
+		return namespace["_compiled"]
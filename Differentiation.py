@@ -0,0 +1,295 @@
+""" Forward mode automatic differentiation with dual numbers
+	
+	A Dual carries a value and its gradient with respect to the chosen variables.
+	Sum, Product and Power only use Python's operators, which Dual implements, so
+	evaluating a formula with Duals bound to the chosen variables yields the value and
+	the full gradient in a single pass. Functions of a DualContext are wrapped to
+	apply the chain rule: builtins use the derivatives below, functions registered with
+	a derivative (a callable returning the partial derivatives for the given arguments)
+	use that one. Compiled formulas work with Duals as well, see CompiledGradient.
+	
+	NOTE: '\\' (floor division), floor and ceil are treated as having derivative 0 and
+	'%' as a - b * floor(a / b), which is correct everywhere except at their jumps.
+"""
+
+import cmath
+import math
+
+import Evaluator
+from Binder import UserFunction
+from Evaluator import EvaluationError, EvaluationFunction, EvaluationContext
+
+class Dual:
+	""" Number with gradient: value + sum(gradient[k] * epsilon_k), epsilon_k^2 = 0 """
+	
+	__slots__ = ("value", "gradient")
+	
+	def __init__(self, value, gradient):
+		self.value = value
+		self.gradient = gradient
+	
+	def __add__(self, other):
+		if isinstance(other, Dual):
+			return Dual(self.value + other.value, [a + b for a, b in zip(self.gradient, other.gradient)])
+		return Dual(self.value + other, self.gradient)
+	
+	def __radd__(self, other):
+		return Dual(other + self.value, self.gradient)
+	
+	def __sub__(self, other):
+		if isinstance(other, Dual):
+			return Dual(self.value - other.value, [a - b for a, b in zip(self.gradient, other.gradient)])
+		return Dual(self.value - other, self.gradient)
+	
+	def __rsub__(self, other):
+		return Dual(other - self.value, [-a for a in self.gradient])
+	
+	def __neg__(self):
+		return Dual(-self.value, [-a for a in self.gradient])
+	
+	def __pos__(self):
+		return self
+	
+	def __mul__(self, other):
+		if isinstance(other, Dual):
+			a, b = self.value, other.value
+			return Dual(a * b, [a * db + b * da for da, db in zip(self.gradient, other.gradient)])
+		return Dual(self.value * other, [da * other for da in self.gradient])
+	
+	def __rmul__(self, other):
+		return Dual(other * self.value, [other * da for da in self.gradient])
+	
+	def __truediv__(self, other):
+		if isinstance(other, Dual):
+			a, b = self.value, other.value
+			value = a / b
+			return Dual(value, [(da - value * db) / b for da, db in zip(self.gradient, other.gradient)])
+		return Dual(self.value / other, [da / other for da in self.gradient])
+	
+	def __rtruediv__(self, other):
+		b = self.value
+		value = other / b
+		return Dual(value, [-value * db / b for db in self.gradient])
+	
+	def __mod__(self, other):
+		if isinstance(other, Dual):
+			quotient = math.floor(self.value / other.value)
+			return Dual(self.value % other.value,
+						[da - quotient * db for da, db in zip(self.gradient, other.gradient)])
+		return Dual(self.value % other, self.gradient)
+	
+	def __rmod__(self, other):
+		quotient = math.floor(other / self.value)
+		return Dual(other % self.value, [-quotient * db for db in self.gradient])
+	
+	def __floordiv__(self, other):
+		value = self.value // (other.value if isinstance(other, Dual) else other)
+		return Dual(value, [0.0] * len(self.gradient))
+	
+	def __rfloordiv__(self, other):
+		return Dual(other // self.value, [0.0] * len(self.gradient))
+	
+	def __pow__(self, other):
+		if isinstance(other, Dual):
+			value = self.value ** other.value
+			partial_base = _power_base_partial(self.value, other.value)
+			partial_exponent = value * _log(self.value)
+			return Dual(value, [partial_base * da + partial_exponent * db
+								for da, db in zip(self.gradient, other.gradient)])
+		partial = _power_base_partial(self.value, other)
+		return Dual(self.value ** other, [partial * da for da in self.gradient])
+	
+	def __rpow__(self, other):
+		value = other ** self.value
+		partial = value * _log(other)
+		return Dual(value, [partial * db for db in self.gradient])
+	
+	#comparisons use the value, so min and max pick the Dual of the chosen argument
+	def __lt__(self, other):
+		return self.value < (other.value if isinstance(other, Dual) else other)
+	
+	def __le__(self, other):
+		return self.value <= (other.value if isinstance(other, Dual) else other)
+	
+	def __gt__(self, other):
+		return self.value > (other.value if isinstance(other, Dual) else other)
+	
+	def __ge__(self, other):
+		return self.value >= (other.value if isinstance(other, Dual) else other)
+	
+	def __str__(self):
+		return "[{}: {} {}]".format(self.__class__.__name__, self.value, self.gradient)
+	
+	def __repr__(self):
+		return "[{}: {} {}]".format(self.__class__.__name__, self.value, self.gradient)
+
+def _power_base_partial(base, exponent):
+	""" d/dbase base^exponent, also for base 0 and integral exponents """
+	if exponent == 0:
+		return 0.0
+	return exponent * base ** (exponent - 1)
+
+def _log(value):
+	""" Logarithm matching Python's power: complex for negative values, d/dy 0^y taken as 0 """
+	if value == 0:
+		return 0.0
+	if isinstance(value, complex) or value < 0:
+		return cmath.log(value)
+	return math.log(value)
+
+def _log_partials(a, base=None):
+	if base is None:
+		return (1 / a,)
+	return (1 / (a * math.log(base)), -math.log(a) / (base * math.log(base) ** 2))
+
+def _pow_partials(a, b):
+	return (_power_base_partial(a, b), math.pow(a, b) * math.log(a) if a > 0 else (0.0 if a == 0 else math.nan))
+
+def _atan2_partials(y, x):
+	square = x * x + y * y
+	if square == 0:
+		return (math.nan, math.nan)
+	return (x / square, -y / square)
+
+def _derivative_builtins():
+	""" Maps the scalar builtins of EvaluationContext to their partial derivatives """
+	return {	math.fabs:		lambda a: (math.copysign(1.0, a),),
+				math.exp:		lambda a: (math.exp(a),),
+				math.log:		_log_partials,
+				math.log10:		lambda a: (1 / (a * math.log(10)),),
+				math.log2:		lambda a: (1 / (a * math.log(2)),),
+				math.sqrt:		lambda a: (0.5 / math.sqrt(a),),
+				math.pow:		_pow_partials,
+				math.sin:		lambda a: (math.cos(a),),
+				math.cos:		lambda a: (-math.sin(a),),
+				math.tan:		lambda a: (1 / math.cos(a) ** 2,),
+				math.asin:		lambda a: (1 / math.sqrt(1 - a * a),),
+				math.acos:		lambda a: (-1 / math.sqrt(1 - a * a),),
+				math.atan:		lambda a: (1 / (1 + a * a),),
+				math.atan2:		_atan2_partials,
+				math.floor:		lambda a: (0.0,),
+				math.ceil:		lambda a: (0.0,),
+			}
+
+#linear builtins are applied to the value and every gradient component
+_LINEAR_BUILTINS = (math.degrees, math.radians, Evaluator.conjugate, Evaluator.real, Evaluator.imag)
+
+#builtins choosing one of their arguments, which works on Duals as they are
+_SELECTING_BUILTINS = (min, max)
+
+class DualContext(EvaluationContext):
+	""" EvaluationContext whose functions accept Duals """
+	
+	def __init__(self, context=None):
+		super().__init__()
+		self.builtins = _derivative_builtins()
+		
+		if context is not None:
+			self.variables = dict(context.variables)
+			self.constants = list(context.constants)
+			functions = context.functions
+		else:
+			functions = self.functions
+		
+		self.functions = {name: self.differentiate_function(name, function) for name, function in functions.items()}
+		self.generation += 1 #user defined functions were bound before the functions were replaced
+	
+	def differentiate_function(self, name, function):
+		""" Returns an EvaluationFunction applying the chain rule to Dual arguments """
+		if isinstance(function, UserFunction) and function.derivative is None:
+			#the body is differentiated like the rest of the formula
+			return function.bound_to(self)
+		
+		inner = function.function
+		if inner in _SELECTING_BUILTINS:
+			wrapped = inner
+		elif inner in _LINEAR_BUILTINS:
+			wrapped = _linear(inner)
+		else:
+			derivative = function.derivative
+			if derivative is None:
+				derivative = self.builtins.get(inner)
+			wrapped = _chain_rule(name, inner, derivative)
+		
+		return EvaluationFunction(function.arity, wrapped, function.description, None, function.pure, function.derivative)
+	
+	def register_function(self, name, arity, function, description, vectorized=None, pure=False, derivative=None):
+		super().register_function(name, arity, function, description, vectorized, pure, derivative)
+		self.functions[name] = self.differentiate_function(name, self.functions[name])
+	
+	def seed(self, variables):
+		""" Replaces the values of variables by Duals with unit gradients, in this order """
+		count = len(variables)
+		for index, name in enumerate(variables):
+			gradient = [0.0] * count
+			gradient[index] = 1.0
+			value = self.get_variable(name)
+			self.variables[name] = Dual(value.value if isinstance(value, Dual) else value, gradient)
+
+def _linear(function):
+	def linear(*arguments):
+		argument = arguments[0]
+		if isinstance(argument, Dual):
+			return Dual(function(argument.value), [function(da) for da in argument.gradient])
+		return function(*arguments)
+	return linear
+
+def _chain_rule(name, function, derivative):
+	def chain_rule(*arguments):
+		duals = [argument for argument in arguments if isinstance(argument, Dual)]
+		if not duals:
+			return function(*arguments)
+		if derivative is None:
+			raise EvaluationError("Function '{}' has no derivative.".format(name))
+		
+		values = [argument.value if isinstance(argument, Dual) else argument for argument in arguments]
+		partials = derivative(*values)
+		if not isinstance(partials, (tuple, list)):
+			partials = (partials,)
+		
+		gradient = [0.0] * len(duals[0].gradient)
+		for partial, argument in zip(partials, arguments):
+			if isinstance(argument, Dual):
+				gradient = [g + partial * da for g, da in zip(gradient, argument.gradient)]
+		return Dual(function(*values), gradient)
+	return chain_rule
+
+def _split(result, count):
+	""" Returns value and gradient of an evaluation result, constants have gradient 0 """
+	if isinstance(result, Dual):
+		return result.value, result.gradient
+	return result, [0.0] * count
+
+def gradient(element, variables, context=None):
+	""" Evaluates a formula element and its partial derivatives with respect to variables
+		in one pass. Returns the value and the list of partial derivatives. """
+	dual = DualContext(context)
+	dual.seed(variables)
+	return _split(element.evaluate(dual), len(variables))
+
+def derivative(element, variable, context=None):
+	""" Returns the derivative of a formula element with respect to one variable """
+	return gradient(element, [variable], context)[1][0]
+
+class CompiledGradient:
+	""" Formula compiled once (see Compiler) for repeated value and gradient evaluations,
+		e.g. in Newton iterations. Call with variable bindings as keyword arguments. """
+	
+	def __init__(self, element, variables, context=None):
+		from Compiler import Compiler
+		
+		self.variables = list(variables)
+		self.context = DualContext(context)
+		self.compiled = Compiler(self.context).compile(element)
+	
+	def __call__(self, **bindings):
+		context = self.context
+		saved = context.variables
+		context.variables = dict(saved)
+		try:
+			for name, value in bindings.items():
+				context.set_variable(name, value)
+			context.seed(self.variables)
+			return _split(self.compiled.evaluate(context), len(self.variables))
+		finally:
+			context.variables = saved
@@ -1,20 +1,144 @@
 """ Evaluator classes """
 
 import math
+import time
+from collections import OrderedDict
 
 class EvaluationError(RuntimeError):
 	pass
 
+def conjugate(x):
+	return complex.conjugate(complex(x))
+
+def real(x):
+	return complex(x).real
+
+def imag(x):
+	return complex(x).imag
+
 class EvaluationFunction:
 	""" Function wrapper that can be used by EvaluationContext """
 	
-	def __init__(self, arity, function, description):
+	def __init__(self, arity, function, description, vectorized=None, pure=False, derivative=None):
 		self.arity = arity
 		self.function = function
 		self.description = description
+		self.vectorized = vectorized #NumPy version of function, see Vectorizer
+		self.pure = pure #result depends on arguments only, calls may be folded or cached
+		self.derivative = derivative #partial derivatives for given arguments, see Differentiation
 	
 	def __call__(self, arguments):
 		return self.function(*arguments)
+	
+	def as_callable(self):
+		""" Returns a callable taking the arguments directly, used by compiled formulas """
+		return self.function
+
+class MemoizedFunction(EvaluationFunction):
+	""" Pure EvaluationFunction caching its results in a bounded LRU cache """
+	
+	def __init__(self, function, maxsize=128):
+		super().__init__(function.arity, function.function, function.description, function.vectorized,
+							function.pure, function.derivative)
+		self.maxsize = _check_maxsize(maxsize)
+		self.cache = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def __call__(self, arguments):
+		key = _memo_key(arguments)
+		if key is None: #not cacheable, e.g. nan
+			self.misses += 1
+			return self.function(*arguments)
+		
+		cache = self.cache
+		if key in cache:
+			self.hits += 1
+			cache.move_to_end(key)
+			return cache[key]
+		
+		self.misses += 1
+		value = self.function(*arguments)
+		cache[key] = value
+		while len(cache) > self.maxsize:
+			cache.popitem(last=False)
+			self.evictions += 1
+		return value
+	
+	def resize(self, maxsize):
+		""" Changes the bound of the cache, evicting the least recently used entries """
+		self.maxsize = _check_maxsize(maxsize)
+		while len(self.cache) > maxsize:
+			self.cache.popitem(last=False)
+			self.evictions += 1
+	
+	def as_callable(self):
+		return lambda *arguments: self(arguments)
+	
+	def clear(self):
+		self.cache.clear()
+	
+	def hit_rate(self):
+		calls = self.hits + self.misses
+		return self.hits / calls if calls > 0 else 0.0
+
+def _check_maxsize(maxsize):
+	if not isinstance(maxsize, int) or isinstance(maxsize, bool) or maxsize < 0:
+		raise ValueError("Cache size has to be a non-negative integer, got {!r}".format(maxsize))
+	return maxsize
+
+def _memo_key(arguments):
+	""" Returns a cache key distinguishing argument types and signed zeros, None if not cacheable """
+	key = list()
+	for argument in arguments:
+		if isinstance(argument, float):
+			if argument != argument:
+				return None
+			key.append((float, argument, math.copysign(1.0, argument)))
+		elif isinstance(argument, complex):
+			if argument != argument:
+				return None
+			key.append((complex, argument, math.copysign(1.0, argument.real), math.copysign(1.0, argument.imag)))
+		else:
+			try:
+				hash(argument)
+			except TypeError:
+				return None
+			key.append((type(argument), argument))
+	return tuple(key)
+
+#builtin functions, shared by all contexts: compiled formulas (see Compiler) recognize them
+#by identity, also when they run in another context than the one they were compiled in
+#negative arity means variable argument count:
+#arity of -1 means: 0 or more arguments
+#arity of -2 means: 1 or more arguments
+#arity of -n means: n-1 or more arguments
+_BUILTINS = {	"abs":		EvaluationFunction(1, math.fabs, "absolute value", pure=True),
+				"exp":		EvaluationFunction(1, math.exp, "e^a", pure=True),
+				"ln":		EvaluationFunction(1, math.log, "logarithmus naturalis", pure=True),
+				"log":		EvaluationFunction(2, math.log, "logarithm to base b", pure=True),
+				"log10":	EvaluationFunction(1, math.log10, "logarithmus decadis", pure=True),
+				"ld":		EvaluationFunction(1, math.log2, "logarithmus dualis", pure=True),
+				"sqrt":		EvaluationFunction(1, math.sqrt, "square root", pure=True),
+				"pow":		EvaluationFunction(2, math.pow, "a^b", pure=True),
+				"sin":		EvaluationFunction(1, math.sin, "sine", pure=True),
+				"cos":		EvaluationFunction(1, math.cos, "cosine", pure=True),
+				"tan":		EvaluationFunction(1, math.tan, "tangent", pure=True),
+				"asin":		EvaluationFunction(1, math.asin, "arcsine", pure=True),
+				"acos":		EvaluationFunction(1, math.acos, "arccosine", pure=True),
+				"atan":		EvaluationFunction(1, math.atan, "arctangent", pure=True),
+				"atan2":	EvaluationFunction(2, math.atan2, "arctangent(a/b)", pure=True),
+				"degrees":	EvaluationFunction(1, math.degrees, "radians to degrees", pure=True),
+				"radians":	EvaluationFunction(1, math.radians, "degrees to radians", pure=True),
+				"min":		EvaluationFunction(-3, min, "minimum of arguments", pure=True),
+				"max":		EvaluationFunction(-3, max, "maximum of arguments", pure=True),
+				"floor":	EvaluationFunction(1, math.floor, "floor", pure=True),
+				"ceil":		EvaluationFunction(1, math.ceil, "ceil", pure=True),
+				"conj":		EvaluationFunction(1, conjugate, "complex conjugate", pure=True),
+				"real":		EvaluationFunction(1, real, "real part of complex number", pure=True),
+				"imag":		EvaluationFunction(1, imag, "imaginary part of complex number", pure=True),
+				 }
 
 class EvaluationContext:
 	""" EvaluationContext stores variables and functions to be used to evaluate formulas """
@@ -27,38 +151,15 @@ class EvaluationContext:
 							"answer":	42,
 						 }
 		self.constants = ["pi", "e", "i", "answer"]
-		
-		#negative arity means variable argument count:
-		#arity of -1 means: 0 or more arguments
-		#arity of -2 means: 1 or more arguments
-		#arity of -n means: n-1 or more arguments
-		self.functions = {	"abs":		EvaluationFunction(1, math.fabs, "absolute value"),
-							"exp":		EvaluationFunction(1, math.exp, "e^a"),
-							"ln":		EvaluationFunction(1, math.log, "logarithmus naturalis"),
-							"log":		EvaluationFunction(2, math.log, "logarithm to base b"),
-							"log10":	EvaluationFunction(1, math.log10, "logarithmus decadis"),
-							"ld":		EvaluationFunction(1, math.log2, "logarithmus dualis"),
-							"sqrt":		EvaluationFunction(1, math.sqrt, "square root"),
-							"pow":		EvaluationFunction(2, math.pow, "a^b"),
-							"sin":		EvaluationFunction(1, math.sin, "sine"),
-							"cos":		EvaluationFunction(1, math.cos, "cosine"),
-							"tan":		EvaluationFunction(1, math.tan, "tangent"),
-							"asin":		EvaluationFunction(1, math.asin, "arcsine"),
-							"acos":		EvaluationFunction(1, math.acos, "arccosine"),
-							"atan":		EvaluationFunction(1, math.atan, "arctangent"),
-							"atan2":	EvaluationFunction(2, math.atan2, "arctangent(a/b)"),
-							"degrees":	EvaluationFunction(1, math.degrees, "radians to degrees"),
-							"radians":	EvaluationFunction(1, math.radians, "degrees to radians"),
-							"min":		EvaluationFunction(-3, min, "minimum of arguments"),
-							"max":		EvaluationFunction(-3, max, "maximum of arguments"),
-							"floor":	EvaluationFunction(1, math.floor, "floor"),
-							"ceil":		EvaluationFunction(1, math.ceil, "ceil"),
-							"conj":		EvaluationFunction(1, lambda x : complex.conjugate(complex(x)), "complex conjugate"),
-							"real":		EvaluationFunction(1, lambda x : complex(x).real, "real part of complex number"),
-							"imag":		EvaluationFunction(1, lambda x : complex(x).imag, "imaginary part of complex number"),
-						 }
+		self.functions = dict(_BUILTINS)
 		
 		#self.register_function("answertolife", 0, lambda : 42, "answer to life, the universe and everything")
+		
+		self.stats = None #EvaluationStats, see enable_stats
+		
+		#bumped whenever functions or constants change or variables are added,
+		#invalidates bound formulas (see Binder) and optimized forms (see Tiering)
+		self.generation = 0
 	
 	def get_variable(self, name):
 		if name in self.variables:
@@ -69,7 +170,17 @@ class EvaluationContext:
 	def set_variable(self, name, value):
 		if name in self.constants:
 			raise EvaluationError("Assignment to constant '{}' not allowed".format(name))
+		if name not in self.variables:
+			self.generation += 1
+		self.variables[name] = value
+		return value
+	
+	def set_constant(self, name, value):
+		""" Defines a constant or changes its value. Formulas folding it become stale. """
+		if name not in self.constants:
+			self.constants.append(name)
 		self.variables[name] = value
+		self.generation += 1
 		return value
 	
 	def is_variable_constant(self, name):
@@ -81,14 +192,53 @@ class EvaluationContext:
 	def unregister_function(self, name):
 		if name in self.functions:
 			del(self.functions[name])
+			self.generation += 1
 		else:
 			raise EvaluationError("Function '{}' not currently registered.")
 	
-	def register_function(self, name, arity, function, description):
+	def memoize(self, name, maxsize=128):
+		""" Caches the results of a pure function. Re-registering or unregistering the
+			function drops its cache. """
+		_check_maxsize(maxsize)
+		if name not in self.functions:
+			raise EvaluationError("Function '{}' not found.".format(name))
+		function = self.functions[name]
+		if not function.pure:
+			raise EvaluationError("Function '{}' is not pure and cannot be memoized.".format(name))
+		if isinstance(function, MemoizedFunction):
+			function.resize(maxsize)
+		else:
+			self.functions[name] = MemoizedFunction(function, maxsize)
+			self.generation += 1
+		return self.functions[name]
+	
+	def clear_memo_caches(self, name=None):
+		""" Clears the cache of one or all memoized functions """
+		for key, function in self.functions.items():
+			if isinstance(function, MemoizedFunction) and (name is None or key == name):
+				function.clear()
+	
+	def memo_stats(self):
+		""" Returns name -> (hits, misses, evictions, cached results) of all memoized functions """
+		return {name: (function.hits, function.misses, function.evictions, len(function.cache))
+				for name, function in self.functions.items() if isinstance(function, MemoizedFunction)}
+	
+	def register_function(self, name, arity, function, description, vectorized=None, pure=False, derivative=None):
 		if name in self.functions:
 			raise EvaluationError("Function '{}' already registered.")
 		
-		self.functions[name] = EvaluationFunction(arity, function, description)
+		self.functions[name] = EvaluationFunction(arity, function, description, vectorized, pure, derivative)
+		self.generation += 1
+	
+	def define_function(self, name, parameters, body):
+		""" Defines (or redefines) a function from a parsed body, like f(x, y) = x^2 + y.
+			Builtin and registered functions cannot be redefined, recursion is rejected. """
+		from Binder import define_function
+		
+		function = define_function(self, name, parameters, body)
+		self.functions[name] = function
+		self.generation += 1
+		return function
 	
 	def call_function(self, name, arguments):
 		if name in self.functions:
@@ -100,4 +250,37 @@ class EvaluationContext:
 				arity = function.arity if function.arity >= 0 else abs(function.arity) - 1
 				raise EvaluationError("Function '{}' has arity {}, but got {} arguments.".format(name, arity, len(arguments)))
 		else:
-			raise EvaluationError("Function '{}' not found.".format(name))
\ No newline at end of file
+			raise EvaluationError("Function '{}' not found.".format(name))
+	
+	def snapshot(self):
+		""" Returns an immutable copy of this context (see Snapshot) """
+		from Snapshot import snapshot
+		return snapshot(self)
+	
+	def fork(self):
+		""" Returns a copy-on-write context starting from the current state (see Snapshot) """
+		return self.snapshot().fork()
+	
+	def enable_stats(self):
+		""" Starts collecting statistics in self.stats (see Instrumentation) """
+		from Instrumentation import EvaluationStats
+		
+		if self.stats is None:
+			self.stats = EvaluationStats()
+			#shadows call_function only while enabled, no overhead otherwise
+			self.call_function = self._instrumented_call_function
+			self.generation += 1
+		return self.stats
+	
+	def disable_stats(self):
+		if self.stats is not None:
+			self.stats = None
+			del self.call_function
+			self.generation += 1
+	
+	def _instrumented_call_function(self, name, arguments):
+		start = time.perf_counter()
+		try:
+			return EvaluationContext.call_function(self, name, arguments)
+		finally:
+			self.stats.record_function(name, time.perf_counter() - start)
@@ -0,0 +1,292 @@
+""" Versioned binary files of assembled formulas, loaded through mmap
+
+	File layout (little endian):
+	header		magic 'MPFL', version (H), reserved (H), formula count (I),
+				symbols offset (Q), index offset (Q)
+	symbols		literals, names and constants of the shared SymbolTable,
+				referenced variables and functions (with their argument counts)
+	formulas	per formula: opcodes (one byte each), padding to 4 bytes, operands (I each)
+	index		per formula: name, opcode offset, operand offset, instruction count
+	
+	Loading only decodes the header, the symbols and the index. Opcodes and operands
+	of a formula are accessed in place through memoryviews of the mapping when the
+	formula is first used.
+	Every read is checked against the size of the file: truncated or corrupt files raise
+	a LibraryError while loading, and formulas with invalid instructions when they are
+	first used. Referenced functions are checked when a context is given.
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+
+from Bytecode import BytecodeFormula, SymbolTable, assemble, DECIMAL, CONST, LOAD, STORE, CALL, ARGC
+from Evaluator import EvaluationError
+
+MAGIC = b"MPFL"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sHHIQQ")
+_COUNT = struct.Struct("<I")
+_ENTRY = struct.Struct("<QQI")
+_DOUBLE = struct.Struct("<d")
+_INTEGER = struct.Struct("<q")
+
+#operands can be used in place if the platform's unsigned int matches the file format
+_NATIVE_OPERANDS = sys.byteorder == "little" and array('I').itemsize == 4
+
+class LibraryError(RuntimeError):
+	pass
+
+def write_library(path, formulas):
+	""" Writes a dictionary of name -> FormulaElement (or BytecodeFormula) to path """
+	table = SymbolTable()
+	assembled = dict()
+	for name, formula in formulas.items():
+		if isinstance(formula, BytecodeFormula):
+			formula = formula.to_tree()
+		assembled[name] = assemble(formula, table)
+	
+	variables, functions = _references(assembled.values(), table)
+	
+	body = bytearray(_HEADER.size)
+	symbols_offset = len(body)
+	_write_strings(body, table.literals)
+	_write_strings(body, table.names)
+	_write_constants(body, table.constants)
+	_write_strings(body, variables)
+	_write_strings(body, sorted(functions))
+	for name in sorted(functions):
+		_write_counts(body, sorted(functions[name]))
+	
+	entries = list()
+	for name, formula in assembled.items():
+		opcodes_offset = len(body)
+		body += formula.opcodes.tobytes()
+		body += bytes(-len(body) % 4)
+		operands_offset = len(body)
+		body += struct.pack("<{}I".format(len(formula.operands)), *formula.operands)
+		entries.append((name, opcodes_offset, operands_offset, len(formula.opcodes)))
+	
+	index_offset = len(body)
+	_write_strings(body, [entry[0] for entry in entries])
+	for name, opcodes_offset, operands_offset, count in entries:
+		body += _ENTRY.pack(opcodes_offset, operands_offset, count)
+	
+	_HEADER.pack_into(body, 0, MAGIC, VERSION, 0, len(entries), symbols_offset, index_offset)
+	with open(path, "wb") as output:
+		output.write(body)
+
+class FormulaLibrary:
+	""" Read-only view of a formula library file. Formulas are decoded on first use. """
+	
+	def __init__(self, path, context=None):
+		with open(path, "rb") as source:
+			try:
+				self.mapping = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError: #empty file
+				raise LibraryError("File too short for a formula library header")
+		self.view = memoryview(self.mapping)
+		self.formulas = dict()
+		
+		try:
+			magic, version, reserved, count, symbols_offset, index_offset = _HEADER.unpack_from(self.mapping, 0)
+		except struct.error:
+			raise LibraryError("File too short for a formula library header")
+		if magic != MAGIC:
+			raise LibraryError("Not a formula library file")
+		if version != VERSION:
+			raise LibraryError("Unsupported formula library version {}".format(version))
+		if not _HEADER.size <= symbols_offset <= index_offset <= len(self.mapping):
+			raise LibraryError("Corrupt formula library header")
+		
+		self.table = SymbolTable()
+		offset = symbols_offset
+		literals, offset = _read_strings(self.mapping, offset)
+		for literal in literals:
+			self.table.literal(literal)
+		self.table.names, offset = _read_strings(self.mapping, offset)
+		self.table.constants, offset = _read_constants(self.mapping, offset)
+		self.variables, offset = _read_strings(self.mapping, offset)
+		
+		names, offset = _read_strings(self.mapping, offset)
+		self.functions = dict() #function name -> argument counts used by the formulas
+		for name in names:
+			self.functions[name], offset = _read_counts(self.mapping, offset)
+		
+		if offset > index_offset:
+			raise LibraryError("Corrupt formula library symbols")
+		
+		names, offset = _read_strings(self.mapping, index_offset)
+		if len(names) != count or offset + count * _ENTRY.size > len(self.mapping):
+			raise LibraryError("Corrupt formula library index")
+		self.index = dict()
+		for name in names:
+			opcodes_offset, operands_offset, length = entry = _ENTRY.unpack_from(self.mapping, offset)
+			#instructions lie between the symbols and the index
+			if (opcodes_offset < symbols_offset or opcodes_offset + length > index_offset or
+					operands_offset < symbols_offset or operands_offset + 4 * length > index_offset):
+				raise LibraryError("Corrupt formula library index entry of '{}'".format(name))
+			self.index[name] = entry
+			offset += _ENTRY.size
+		
+		if context is not None:
+			self.validate(context)
+	
+	def validate(self, context):
+		""" Checks that every referenced function exists in context and accepts the used argument counts """
+		for name, counts in self.functions.items():
+			if name not in context.functions:
+				raise EvaluationError("Function '{}' not found.".format(name))
+			function = context.functions[name]
+			for count in counts:
+				if not ((function.arity < 0 and abs(function.arity) - 1 <= count) or function.arity == count):
+					arity = function.arity if function.arity >= 0 else abs(function.arity) - 1
+					raise EvaluationError("Function '{}' has arity {}, but got {} arguments.".format(name, arity, count))
+	
+	def __getitem__(self, name):
+		formula = self.formulas.get(name)
+		if formula is None:
+			if name not in self.index:
+				raise KeyError(name)
+			opcodes_offset, operands_offset, count = self.index[name]
+			opcodes = self.view[opcodes_offset:opcodes_offset + count]
+			if _NATIVE_OPERANDS:
+				operands = self.view[operands_offset:operands_offset + 4 * count].cast('I')
+			else:
+				operands = array('I', struct.unpack_from("<{}I".format(count), self.mapping, operands_offset))
+			try:
+				_check_instructions(name, opcodes, operands, self.table)
+			except LibraryError:
+				#views must not keep the mapping from being closed
+				if isinstance(operands, memoryview):
+					operands.release()
+				opcodes.release()
+				raise
+			formula = BytecodeFormula(opcodes, operands, self.table)
+			self.formulas[name] = formula
+		return formula
+	
+	def __contains__(self, name):
+		return name in self.index
+	
+	def __len__(self):
+		return len(self.index)
+	
+	def __iter__(self):
+		return iter(self.index)
+	
+	def close(self):
+		""" Releases the mapping, formulas of this library cannot be evaluated afterwards """
+		for formula in self.formulas.values():
+			if isinstance(formula.operands, memoryview):
+				formula.operands.release()
+			formula.opcodes.release()
+		self.formulas.clear()
+		self.view.release()
+		self.mapping.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exception):
+		self.close()
+
+def _references(formulas, table):
+	""" Returns the referenced variables and function name -> argument counts """
+	variables = set()
+	functions = dict()
+	for formula in formulas:
+		name = None
+		for opcode, operand in zip(formula.opcodes, formula.operands):
+			if opcode == LOAD or opcode == STORE:
+				variables.add(table.names[operand])
+			elif opcode == CALL:
+				name = table.names[operand]
+			elif opcode == ARGC:
+				functions.setdefault(name, set()).add(operand)
+	return sorted(variables), functions
+
+def _check_instructions(name, opcodes, operands, table):
+	""" Raises a LibraryError if an instruction is unknown or refers to a missing symbol """
+	limits = {DECIMAL: len(table.literals), CONST: len(table.constants), LOAD: len(table.names),
+				STORE: len(table.names), CALL: len(table.names)}
+	for opcode, operand in zip(opcodes, operands):
+		if opcode > ARGC or operand >= limits.get(opcode, operand + 1):
+			raise LibraryError("Corrupt instructions of formula '{}'".format(name))
+
+def _write_strings(body, strings):
+	body += _COUNT.pack(len(strings))
+	for string in strings:
+		encoded = string.encode("utf-8")
+		body += _COUNT.pack(len(encoded))
+		body += encoded
+
+def _read_strings(buffer, offset):
+	try:
+		count, = _COUNT.unpack_from(buffer, offset)
+		offset += _COUNT.size
+		strings = list()
+		for i in range(count):
+			length, = _COUNT.unpack_from(buffer, offset)
+			offset += _COUNT.size
+			if offset + length > len(buffer):
+				raise LibraryError("Corrupt formula library")
+			strings.append(bytes(buffer[offset:offset + length]).decode("utf-8"))
+			offset += length
+	except (struct.error, UnicodeDecodeError):
+		raise LibraryError("Corrupt formula library")
+	return strings, offset
+
+def _write_counts(body, counts):
+	body += _COUNT.pack(len(counts))
+	for count in counts:
+		body += _COUNT.pack(count)
+
+def _read_counts(buffer, offset):
+	try:
+		count, = _COUNT.unpack_from(buffer, offset)
+		counts = list(struct.unpack_from("<{}I".format(count), buffer, offset + _COUNT.size))
+	except struct.error:
+		raise LibraryError("Corrupt formula library")
+	return counts, offset + _COUNT.size * (count + 1)
+
+def _write_constants(body, constants):
+	body += _COUNT.pack(len(constants))
+	for value in constants:
+		if type(value) is float:
+			body += b"f" + _DOUBLE.pack(value)
+		elif type(value) is int:
+			if not -1 << 63 <= value < 1 << 63:
+				raise LibraryError("Integer constant {} does not fit into 64 bits".format(value))
+			body += b"i" + _INTEGER.pack(value)
+		elif type(value) is complex:
+			body += b"c" + _DOUBLE.pack(value.real) + _DOUBLE.pack(value.imag)
+		else:
+			raise LibraryError("Cannot store constant {!r}".format(value))
+
+def _read_constants(buffer, offset):
+	try:
+		count, = _COUNT.unpack_from(buffer, offset)
+		offset += _COUNT.size
+		constants = list()
+		for i in range(count):
+			tag = bytes(buffer[offset:offset + 1])
+			offset += 1
+			if tag == b"f":
+				constants.append(_DOUBLE.unpack_from(buffer, offset)[0])
+				offset += _DOUBLE.size
+			elif tag == b"i":
+				constants.append(_INTEGER.unpack_from(buffer, offset)[0])
+				offset += _INTEGER.size
+			elif tag == b"c":
+				real, = _DOUBLE.unpack_from(buffer, offset)
+				imag, = _DOUBLE.unpack_from(buffer, offset + _DOUBLE.size)
+				constants.append(complex(real, imag))
+				offset += 2 * _DOUBLE.size
+			else:
+				raise LibraryError("Corrupt formula library")
+	except struct.error:
+		raise LibraryError("Corrupt formula library")
+	return constants, offset
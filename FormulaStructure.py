@@ -10,6 +10,8 @@
 	Simplifications are marked with NOTE.
 """
 
+import operator
+
 from Lexer import LexerName, LexerValue, LexerSymbol, LexerParenthesis, LexerLexeme
 
 class ParserError(SyntaxError):
@@ -42,7 +44,8 @@ class FormulaElement:
 	def parse(lexemes):
 		""" Parses a list of lexemes into a class instance.
 			Uses a lot of recursion and removes lexemes from the list on its way.
-			This is the only supported way to construct a class instance (via private constructor) """
+			This is the only supported way to construct a class instance (via private constructor),
+			apart from Parser.Parser, which builds the same trees without removing lexemes. """
 		raise NotImplementedError
 	
 	def __str__(self):
@@ -107,9 +110,9 @@ class Sum(FormulaElement):
 		
 		for add in self.additional:
 			if add.operator == '+':
-				value += add.value.evaluate(context)
+				value = value + add.value.evaluate(context)
 			elif add.operator == '-':
-				value -= add.value.evaluate(context)
+				value = value - add.value.evaluate(context)
 			else:
 				#this. should. not. happen.
 				raise ParserError("Expected operator '+' or '-', but found '{}'".format(add.value))
@@ -149,13 +152,13 @@ class Product(FormulaElement):
 		
 		for add in self.additional:
 			if add.operator == '*':
-				value *= add.value.evaluate(context)
+				value = value * add.value.evaluate(context)
 			elif add.operator == '/':
-				value /= add.value.evaluate(context)
+				value = value / add.value.evaluate(context)
 			elif add.operator == '%':
-				value %= add.value.evaluate(context)
+				value = value % add.value.evaluate(context)
 			elif add.operator == '\\':
-				value //= add.value.evaluate(context)
+				value = value // add.value.evaluate(context)
 			else:
 				raise ParserError("Expected operator '*', '/', '%' or '\\', but found '{}'".format(add.value))
 		
@@ -262,7 +265,12 @@ class Toplevel(FormulaElement):
 		if len(lexemes) > 1 and isinstance(lexemes[0], LexerName):
 			if lexemes[1].value == '(':
 				#NOTE: grammar would require Sum(Function.parse(lexemes))
-				return Function.parse(lexemes)
+				function = Function.parse(lexemes)
+				
+				if len(lexemes) > 1 and lexemes[0].value == '=':
+					#definitions are parsed by parse_formula
+					raise ParserError("Function '{}' can only be defined at the top level of a formula".format(function.name))
+				return function
 		
 		if isinstance(lexemes[0], LexerName):
 			value = Variable.parse(lexemes)
@@ -282,6 +290,45 @@ class Toplevel(FormulaElement):
 	def __str__(self):
 		return "[{}: {} {}]".format(self.__class__.__name__, self.value, self.additional)
 
+class Definition(FormulaElement):
+	""" Function definition formula element, like f(x, y) = x^2 + y.
+		Evaluating it defines the function in the context, the body is evaluated on calls. """
+	
+	def __init__(self, name, parameters, body):
+		self.name = name
+		self.parameters = parameters
+		self.body = body
+	
+	def create(function, body):
+		""" Turns the parsed left side f(x, y) of a definition into a Definition """
+		parameters = list()
+		for argument in function.arguments:
+			if not isinstance(argument, Variable):
+				raise ParserError("Expected parameter name in definition of '{}', but found '{}'".format(
+									function.name, argument))
+			if argument.value in parameters:
+				raise ParserError("Duplicate parameter '{}' in definition of '{}'".format(argument.value, function.name))
+			parameters.append(argument.value)
+		return Definition(function.name, parameters, body)
+	
+	def evaluate(self, context):
+		return context.define_function(self.name, self.parameters, self.body)
+	
+	def parse(lexemes):
+		if len(lexemes) < 4:
+			raise ParserError("Too few lexemes for Definition")
+		
+		function = Function.parse(lexemes)
+		
+		if len(lexemes) == 0 or lexemes[0].value != '=':
+			raise ParserError("Expected '=' in definition of '{}'".format(function.name))
+		lexemes.pop(0)
+		
+		return Definition.create(function, Sum.parse(lexemes))
+	
+	def __str__(self):
+		return "[{}: {}({}) = {}]".format(self.__class__.__name__, self.name, ", ".join(self.parameters), self.body)
+
 class Decimal(FormulaElement):
 	""" Decimal value formula element """
 	
@@ -321,3 +368,163 @@ class Variable(FormulaElement):
 			return Variable(value)
 		else:
 			raise ParserError("Expected Variable, but found '{}'".format(lexemes))
+
+class Constant(FormulaElement):
+	""" Precomputed value formula element. Never parsed, created by the Optimizer """
+	
+	def __init__(self, value):
+		self.value = value
+	
+	def evaluate(self, context):
+		return self.value
+
+def parse_formula(lexemes):
+	""" Parses the lexemes of a whole formula, a definition or a Sum (see grammar.ebnf) """
+	if is_definition(lexemes):
+		return Definition.parse(lexemes)
+	return Sum.parse(lexemes)
+
+def is_definition(lexemes):
+	""" Returns True if a list of lexemes starts with the left side of a definition, f(...) = """
+	if len(lexemes) < 4 or not isinstance(lexemes[0], LexerName) or lexemes[1].value != '(':
+		return False
+	depth = 0
+	for index in range(1, len(lexemes) - 1):
+		if lexemes[index].value == '(':
+			depth += 1
+		elif lexemes[index].value == ')':
+			depth -= 1
+			if depth == 0:
+				return lexemes[index + 1].value == '='
+	return False
+
+def children(element):
+	""" Returns the child elements of a formula element """
+	if isinstance(element, (Sum, Product)):
+		return [element.value] + [add.value for add in element.additional]
+	if isinstance(element, Power):
+		return [element.value] if element.exponent is None else [element.value, element.exponent]
+	if isinstance(element, Toplevel):
+		if isinstance(element.additional, AdditionalElement):
+			return [element.additional.value]
+		return [element.value]
+	if isinstance(element, Function):
+		return list(element.arguments)
+	return []
+
+def free_variables(element):
+	""" Returns the names of the variables element reads or assigns, in order of appearance """
+	names = list()
+	pending = [element]
+	while pending:
+		current = pending.pop()
+		if isinstance(current, Variable) and current.value not in names:
+			names.append(current.value)
+		pending.extend(reversed(children(current)))
+	return names
+
+def has_assignment(element):
+	""" Returns True if element has an assignment anywhere, without recursion """
+	pending = [element]
+	while pending:
+		current = pending.pop()
+		if (isinstance(current, Toplevel) and isinstance(current.additional, AdditionalElement)
+				and current.additional.operator == '='):
+			return True
+		pending.extend(children(current))
+	return False
+
+def depth(element):
+	""" Returns the nesting depth of a formula element, without recursion """
+	deepest = 0
+	pending = [(element, 1)]
+	while pending:
+		element, level = pending.pop()
+		deepest = max(deepest, level)
+		pending.extend((child, level + 1) for child in children(element))
+	return deepest
+
+#functions applying the operators of Sum and Product
+BINARY_OPERATORS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv,
+						'%': operator.mod, '\\': operator.floordiv}
+
+def evaluate_iterative(element, context):
+	""" Evaluates element exactly like element.evaluate(context), in the same order,
+		but with an explicit stack instead of recursion, so deeply nested formulas
+		do not hit Python's recursion limit. """
+	stack = list() #frames: [element, evaluated children, accumulated value]
+	current = element
+	
+	while True:
+		#descend to the leftmost child that is not evaluated yet
+		while current is not None:
+			if isinstance(current, (Sum, Product)):
+				stack.append([current, 0, None])
+				current = current.value
+			elif isinstance(current, Power) and current.exponent is not None:
+				stack.append([current, 0, None])
+				current = current.value
+			elif isinstance(current, Power):
+				current = current.value
+			elif isinstance(current, Toplevel) and isinstance(current.additional, AdditionalElement):
+				stack.append([current, 0, None])
+				current = current.additional.value
+			elif isinstance(current, Toplevel):
+				current = current.value
+			elif isinstance(current, Function) and current.arguments:
+				stack.append([current, 0, list()])
+				current = current.arguments[0]
+			else:
+				#leaves and anything else evaluate themselves
+				value = current.evaluate(context)
+				current = None
+		
+		#pass values up until a frame needs another child
+		while current is None:
+			if not stack:
+				return value
+			
+			frame = stack[-1]
+			parent = frame[0]
+			
+			if isinstance(parent, (Sum, Product)):
+				if frame[1] == 0:
+					frame[2] = value
+				else:
+					add = parent.additional[frame[1] - 1]
+					if add.operator not in BINARY_OPERATORS:
+						raise ParserError("Unexpected operator '{}'".format(add.operator))
+					frame[2] = BINARY_OPERATORS[add.operator](frame[2], value)
+				
+				if frame[1] < len(parent.additional):
+					current = parent.additional[frame[1]].value
+					frame[1] += 1
+				else:
+					value = frame[2]
+					stack.pop()
+			
+			elif isinstance(parent, Power):
+				if frame[1] == 0:
+					frame[1] = 1
+					frame[2] = value
+					current = parent.exponent
+				else:
+					value = frame[2] ** value
+					stack.pop()
+			
+			elif isinstance(parent, Toplevel):
+				if parent.additional.operator == '=':
+					value = context.set_variable(parent.value.value, value)
+				elif parent.additional.operator == '-':
+					value = - value
+				else:
+					raise ParserError("Expected operator '-' or '=', but found '{}'".format(parent.additional.operator))
+				stack.pop()
+			
+			else: #Function
+				frame[2].append(value)
+				if len(frame[2]) < len(parent.arguments):
+					current = parent.arguments[len(frame[2])]
+				else:
+					value = context.call_function(parent.name, frame[2])
+					stack.pop()
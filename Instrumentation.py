@@ -0,0 +1,85 @@
+""" Opt-in instrumentation of lexing, parsing and evaluation
+
+	EvaluationStats is attached to an EvaluationContext by enable_stats. Nothing on
+	the evaluation hot path checks for it: function calls are timed by an instrumented
+	call_function that is only installed while statistics are enabled, and node counts
+	are derived from the shape of the syntax tree instead of being counted node by node.
+	They are therefore static counts: every successful evaluation adds all nodes of the
+	formula's tree once, evaluations raising errors add nothing, and the bodies of called
+	user defined functions are not included (their calls show up in the function statistics).
+	
+	NOTE: compiled formulas (see Compiler) call functions directly and are therefore
+	not included in the function statistics.
+"""
+
+import time
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+
+from FormulaStructure import children
+
+class EvaluationStats:
+	""" Per stage timers, per function call counts and times and per node type counts of evaluated trees """
+	
+	def __init__(self):
+		self.stages = dict()		#stage -> [count, seconds]
+		self.functions = dict()		#function name -> [calls, seconds]
+		self.nodes = Counter()		#node type -> nodes of evaluated trees, static counts
+		self.counters = Counter()	#other events, e.g. parse cache hits
+		self.shapes = weakref.WeakKeyDictionary()	#tree -> Counter of its node types
+	
+	@contextmanager
+	def time(self, stage):
+		""" Context manager adding the time spent in its block to a stage """
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			entry = self.stages.setdefault(stage, [0, 0.0])
+			entry[0] += 1
+			entry[1] += time.perf_counter() - start
+	
+	def record_function(self, name, seconds):
+		entry = self.functions.setdefault(name, [0, 0.0])
+		entry[0] += 1
+		entry[1] += seconds
+	
+	def record_evaluation(self, tree):
+		""" Adds the node types of tree, once per successful evaluation """
+		shape = self.shapes.get(tree)
+		if shape is None:
+			shape = Counter()
+			pending = [tree]
+			while pending:
+				element = pending.pop()
+				shape[element.__class__.__name__] += 1
+				pending.extend(children(element))
+			self.shapes[tree] = shape
+		self.nodes.update(shape)
+	
+	def reset(self):
+		self.stages.clear()
+		self.functions.clear()
+		self.nodes.clear()
+		self.counters.clear()
+	
+	def report(self):
+		""" Returns a human readable summary """
+		lines = ["Stages:"]
+		for stage, (count, seconds) in sorted(self.stages.items()):
+			lines.append("  {}: {} calls, {:.6f}s".format(stage, count, seconds))
+		lines.append("Functions:")
+		for name, (calls, seconds) in sorted(self.functions.items(), key=lambda item: -item[1][1]):
+			lines.append("  {}: {} calls, {:.6f}s".format(name, calls, seconds))
+		lines.append("Nodes of evaluated formulas (static counts):")
+		for name, count in self.nodes.most_common():
+			lines.append("  {}: {}".format(name, count))
+		if self.counters:
+			lines.append("Counters:")
+			for name, count in sorted(self.counters.items()):
+				lines.append("  {}: {}".format(name, count))
+		return "\n".join(lines)
+	
+	def __str__(self):
+		return self.report()
@@ -1,13 +1,21 @@
 """ Lexer module """
 
+OPERATORS = frozenset("+-*/%\\=^,")
+PARENTHESES = frozenset("()")
+DIGITS = frozenset("0123456789")
+DIGITS_DECIMAL_POINT = DIGITS | frozenset(".")
+CHARACTERS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+NAME_ELEMENTS = CHARACTERS | DIGITS
+
 class LexerError(SyntaxError):
 	pass
 
 class LexerLexeme:
 	""" Basic lexeme class """
 	
-	def __init__(self, value):
+	def __init__(self, value, position=None):
 		self.value = value
+		self.position = position #offset of the lexeme's first character in the source string
 	
 	def __str__(self):
 		return "[{}: {}]".format(self.__class__.__name__, self.value)
@@ -31,48 +39,66 @@ class Lexer:
 	""" Simple lexer """
 	
 	def __init__(self):
-		self.operators = ['+', '-', '*', '/', '%', '\\', '=', '^', ',']
-		self.digits = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
-		self.digits_decimal_point = ['.'] + self.digits
-		lower = ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l", "m",
-				"n", "o", "p", "q", "r", "s", "t", "u", "v", "w", "x", "y", "z"]
-		upper = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M",
-				"N", "O", "P", "Q", "R", "S", "T", "U", "V", "W", "X", "Y", "Z"]
-		self.characters = lower + upper
-		self.name_elements = self.characters + self.digits
-		
+		self.operators = OPERATORS
+		self.digits = DIGITS
+		self.digits_decimal_point = DIGITS_DECIMAL_POINT
+		self.characters = CHARACTERS
+		self.name_elements = NAME_ELEMENTS
+	
 	def lexe(self, string):
 		""" Lexes a string into ... well ... lexemes. """
-		string = string.replace(" ", "") #strip whitespaces.
-		lexemes = list()
+		return list(self.lexe_iter(string))
+	
+	def lexe_iter(self, string):
+		""" Generator version of lexe, yields lexemes one at a time while scanning
+			the string once with a cursor. """
+		length = len(string)
+		position = 0
 		
-		while len(string) > 0:
-			current = string[0]
-			string = string[1:]
+		while position < length:
+			current = string[position]
+			start = position
+			position += 1
 			
-			if current == '(' or current == ')':
-				lexemes.append(LexerParenthesis(current))
+			if current == ' ':
+				continue
+			
+			if current in PARENTHESES:
+				yield LexerParenthesis(current, start)
 				continue
 			
 			if current in self.operators:
-				lexemes.append(LexerSymbol(current))
+				yield LexerSymbol(current, start)
 				continue
 			
 			if current in self.digits_decimal_point:
 				#also lets stuff like .0.45 pass. will give ValueError later on.
-				while len(string) > 0 and string[0] in self.digits_decimal_point:
-					current += string[0]
-					string = string[1:]
-				lexemes.append(LexerValue(current))
+				position = self._scan(string, position, self.digits_decimal_point)
+				yield LexerValue(string[start:position].replace(" ", ""), start)
 				continue
 			
 			if current in self.characters:
-				while len(string) > 0 and string[0] in self.name_elements:
-					current += string[0]
-					string = string[1:]
-				lexemes.append(LexerName(current))
+				position = self._scan(string, position, self.name_elements)
+				yield LexerName(string[start:position].replace(" ", ""), start)
 				continue
 			
 			#unknown elements detected.
-			raise LexerError("Illegal input: '{}'".format(current))
-		return lexemes
+			raise LexerError("Illegal input: '{}' at position {}".format(current, start))
+	
+	def _scan(self, string, position, elements):
+		""" Returns the end offset of the run of elements starting at position.
+			Whitespaces inside a run are skipped, as lexe always ignored them. """
+		length = len(string)
+		end = position
+		
+		while position < length:
+			current = string[position]
+			if current in elements:
+				position += 1
+				end = position
+			elif current == ' ':
+				position += 1
+			else:
+				break
+		
+		return end
@@ -0,0 +1,165 @@
+""" Constant folding and algebraic simplification of formula elements
+
+	The optimizer never modifies the given tree, it builds a new one:
+	- decimal literals are converted to Constant elements once,
+	- constants of the EvaluationContext (pi, e, i, ...) are replaced by their values,
+	- constant subtrees and calls of pure functions with constant arguments are folded,
+	- with simplify set, identities x * 1, x / 1, x + 0, x - 0, 1 * x, 0 + x, x ^ 1 and
+	  - - x are removed.
+	
+	NOTE: Folding follows the left-to-right evaluation of Sum and Product, so only a
+	constant prefix like 2 * pi / 360 in 2 * pi / 360 * x is folded, and folded results
+	are bit-identical to unoptimized evaluation. Removing identities is not: x + 0 turns
+	-0.0 into 0.0 and x * 1 turns integer variables into floats. Simplifying is opt-in
+	for that reason.
+"""
+
+from collections import Counter
+
+from Evaluator import EvaluationError, EvaluationContext
+from FormulaStructure import (AdditionalElement, Function, Sum, Product, Power, Toplevel,
+								Decimal, Variable, Constant)
+
+class OptimizationReport:
+	""" Describes what an Optimizer changed in a formula """
+	
+	def __init__(self):
+		self.counts = Counter()
+		self.changes = list()
+	
+	def record(self, kind, description):
+		self.counts[kind] += 1
+		self.changes.append(description)
+	
+	def __bool__(self):
+		return len(self.changes) > 0
+	
+	def __str__(self):
+		if not self.changes:
+			return "No changes."
+		return "\n".join(self.changes)
+
+class Optimizer:
+	""" Builds optimized copies of formula element trees """
+	
+	def __init__(self, context=None, simplify=False):
+		#context providing the constants and (pure) functions to fold
+		self.context = context if context is not None else EvaluationContext()
+		self.simplify = simplify
+	
+	def optimize(self, element):
+		""" Returns the optimized element and an OptimizationReport """
+		report = OptimizationReport()
+		return self.visit(element, report), report
+	
+	def visit(self, element, report):
+		if isinstance(element, Decimal):
+			try:
+				value = float(element.value)
+			except ValueError:
+				return element #keep the ValueError at evaluation time
+			report.record("literal", "converted literal {} to {}".format(element.value, value))
+			return Constant(value)
+		
+		if isinstance(element, Variable):
+			if element.value in self.context.constants and element.value in self.context.variables:
+				value = self.context.get_variable(element.value)
+				report.record("constant", "replaced constant {} by {}".format(element.value, value))
+				return Constant(value)
+			return element
+		
+		if isinstance(element, Function):
+			arguments = [self.visit(argument, report) for argument in element.arguments]
+			function = self.context.functions.get(element.name)
+			optimized = Function(element.name, arguments)
+			
+			if function is not None and function.pure and all(isinstance(a, Constant) for a in arguments):
+				return self.fold(optimized, report)
+			return optimized
+		
+		if isinstance(element, (Sum, Product)):
+			return self.visit_chain(element, report)
+		
+		if isinstance(element, Power):
+			base = self.visit(element.value, report)
+			if element.exponent is None:
+				return base
+			exponent = self.visit(element.exponent, report)
+			
+			if isinstance(base, Constant) and isinstance(exponent, Constant):
+				return self.fold(Power(base, exponent), report)
+			if self.simplify and _is_constant(exponent, 1):
+				report.record("identity", "removed ^ 1")
+				return base
+			return Power(base, exponent)
+		
+		if isinstance(element, Toplevel):
+			if not isinstance(element.additional, AdditionalElement):
+				return self.visit(element.value, report)
+			
+			value = self.visit(element.additional.value, report)
+			if element.additional.operator == '=':
+				return Toplevel(element.value, AdditionalElement('=', value))
+			
+			if isinstance(value, Constant):
+				return self.fold(Toplevel("", AdditionalElement('-', value)), report)
+			if self.simplify and _is_negation(value):
+				report.record("identity", "removed double negation")
+				return value.additional.value
+			return Toplevel("", AdditionalElement(element.additional.operator, value))
+		
+		return element
+	
+	def visit_chain(self, element, report):
+		""" Optimizes Sum or Product elements """
+		value = self.visit(element.value, report)
+		additional = [AdditionalElement(add.operator, self.visit(add.value, report)) for add in element.additional]
+		
+		#fold the constant prefix, evaluation order is left to right
+		prefix = 0
+		while prefix < len(additional) and isinstance(additional[prefix].value, Constant):
+			prefix += 1
+		if prefix > 0 and isinstance(value, Constant):
+			folded = self.fold(element.__class__(value, additional[:prefix]), report)
+			if isinstance(folded, Constant):
+				value = folded
+				additional = additional[prefix:]
+		
+		if self.simplify:
+			if isinstance(element, Sum):
+				neutral, operators = 0, ['+', '-']
+			else:
+				neutral, operators = 1, ['*', '/']
+			
+			remaining = list()
+			for add in additional:
+				if add.operator in operators and _is_constant(add.value, neutral):
+					report.record("identity", "removed {} {}".format(add.operator, neutral))
+				else:
+					remaining.append(add)
+			additional = remaining
+			
+			if _is_constant(value, neutral) and additional and additional[0].operator == operators[0]:
+				report.record("identity", "removed leading {} {}".format(neutral, operators[0]))
+				value = additional[0].value
+				additional = additional[1:]
+		
+		if len(additional) == 0:
+			return value
+		return element.__class__(value, additional)
+	
+	def fold(self, element, report):
+		""" Evaluates an element with constant operands, returns it unchanged if that fails """
+		try:
+			value = element.evaluate(self.context)
+		except (EvaluationError, ArithmeticError, ValueError, TypeError):
+			return element #errors are raised on evaluation as before
+		report.record("fold", "folded {} to {}".format(element.__class__.__name__, value))
+		return Constant(value)
+
+def _is_constant(element, value):
+	return isinstance(element, Constant) and type(element.value) in (int, float) and element.value == value
+
+def _is_negation(element):
+	return (isinstance(element, Toplevel) and isinstance(element.additional, AdditionalElement) and
+			element.additional.operator == '-')
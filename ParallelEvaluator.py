@@ -0,0 +1,161 @@
+""" Evaluation of many formulas across worker processes
+
+	Formulas are parsed in the calling process, the parsed trees are sent to the
+	workers in chunks. Every worker rebuilds the EvaluationContext from the exported
+	state of the calling context once, and each formula is evaluated against a fresh
+	copy of the exported variables, so assignments do not leak between formulas.
+	User defined functions are sent as their definitions and defined again in the workers.
+"""
+
+import os
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+from Binder import UserFunction
+from Evaluator import EvaluationError, EvaluationContext
+from FormulaStructure import ParserError
+from Lexer import LexerError
+from Parser import default_cache
+
+class BatchResult:
+	""" Result of one formula of a batch, either a value or the error it raised """
+	
+	def __init__(self, index, formula, value=None, error=None):
+		self.index = index
+		self.formula = formula
+		self.value = value
+		self.error = error
+	
+	def __str__(self):
+		if self.error is not None:
+			return "[{}: {} -> {}: {}]".format(self.__class__.__name__, self.formula,
+												self.error.__class__.__name__, self.error)
+		return "[{}: {} -> {}]".format(self.__class__.__name__, self.formula, self.value)
+	
+	def __repr__(self):
+		return str(self)
+
+def export_state(context):
+	""" Returns the picklable state of an EvaluationContext, see import_state.
+		Unlike Snapshot.snapshot, this is a one-off copy meant to be sent to other processes. """
+	functions = dict()
+	definitions = list()
+	for name, function in context.functions.items():
+		if isinstance(function, UserFunction):
+			definitions.append((name, function.parameters, function.body))
+			continue
+		try:
+			pickle.dumps(function)
+		except (pickle.PicklingError, AttributeError, TypeError) as e:
+			raise EvaluationError("Function '{}' cannot be sent to worker processes: {}".format(name, e))
+		functions[name] = function
+	return (dict(context.variables), list(context.constants), functions, definitions)
+
+def import_state(state, context=None):
+	""" Builds an EvaluationContext from the state returned by export_state,
+		or replaces the variables and functions of context with it """
+	variables, constants, functions, definitions = state
+	if context is None:
+		context = EvaluationContext()
+	else:
+		context.generation += 1
+	context.variables = dict(variables)
+	context.constants = list(constants)
+	context.functions = dict(functions)
+	for name, parameters, body in definitions:
+		context.define_function(name, parameters, body)
+	return context
+
+#per process state of the workers
+_context = None
+_variables = None
+
+def _initialize(state):
+	global _context, _variables
+	_context = import_state(state)
+	_variables = state[0]
+
+def _evaluate_chunk(chunk):
+	""" Evaluates (index, tree) pairs in a worker, returns (index, value, error) triples """
+	results = list()
+	for index, tree in chunk:
+		_context.variables = dict(_variables)
+		try:
+			results.append((index, tree.evaluate(_context), None))
+		except (EvaluationError, ValueError, TypeError, ArithmeticError, RecursionError) as e:
+			results.append((index, None, e))
+	return results
+
+class _Chunk:
+	""" Formulas of one chunk, with results of formulas that did not parse """
+	
+	def __init__(self):
+		self.formulas = dict()
+		self.work = list()
+		self.results = list()
+		self.future = None
+	
+	def collect(self):
+		""" Returns the BatchResults of this chunk, sorted by index """
+		for index, value, error in self.future.result():
+			self.results.append(BatchResult(index, self.formulas[index], value, error))
+		self.results.sort(key=lambda result: result.index)
+		return self.results
+
+class ParallelEvaluator:
+	""" Evaluates iterables of formula strings in a ProcessPoolExecutor """
+	
+	def __init__(self, context=None, workers=None, chunksize=64, parse_cache=None):
+		self.context = context if context is not None else EvaluationContext()
+		self.workers = workers
+		self.chunksize = chunksize
+		self.parse_cache = parse_cache if parse_cache is not None else default_cache
+	
+	def evaluate(self, formulas, ordered=True):
+		""" Yields a BatchResult per formula, in input order or as chunks complete.
+			Errors of single formulas are captured in their results. """
+		state = export_state(self.context)
+		chunks = self._chunks(formulas)
+		
+		workers = self.workers if self.workers is not None else os.cpu_count() or 1
+		window = 2 * workers #chunks in flight, formulas are consumed lazily
+		
+		with ProcessPoolExecutor(workers, initializer=_initialize, initargs=(state,)) as executor:
+			pending = deque()
+			
+			while True:
+				while len(pending) < window:
+					chunk = next(chunks, None)
+					if chunk is None:
+						break
+					chunk.future = executor.submit(_evaluate_chunk, chunk.work)
+					pending.append(chunk)
+				
+				if not pending:
+					break
+				
+				if ordered:
+					yield from pending.popleft().collect()
+				else:
+					wait([chunk.future for chunk in pending], return_when=FIRST_COMPLETED)
+					for chunk in [chunk for chunk in pending if chunk.future.done()]:
+						pending.remove(chunk)
+						yield from chunk.collect()
+	
+	def _chunks(self, formulas):
+		""" Parses formulas and groups them into chunks """
+		formulas = enumerate(formulas)
+		while True:
+			chunk = _Chunk()
+			for index, formula in islice(formulas, self.chunksize):
+				chunk.formulas[index] = formula
+				try:
+					chunk.work.append((index, self.parse_cache.parse(formula)))
+				except (ParserError, LexerError) as e:
+					chunk.results.append(BatchResult(index, formula, error=e))
+			
+			if not chunk.formulas:
+				return
+			yield chunk
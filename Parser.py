@@ -0,0 +1,349 @@
+""" Cursor based parser module """
+
+import itertools
+import weakref
+from collections import deque, OrderedDict
+
+from FormulaStructure import (ParserError, AdditionalElement, Function, Sum, Product, Power,
+								Toplevel, Decimal, Variable, Definition)
+from Lexer import LexerName, LexerValue, LexerSymbol, LexerParenthesis, Lexer
+from Optimizer import Optimizer
+
+class LexemeStream:
+	""" Cursor over a list or iterator of lexemes with a small lookahead buffer.
+		Advancing is O(1), so lexemes can also be consumed lazily from Lexer.lexe_iter. """
+	
+	def __init__(self, lexemes):
+		self.lexemes = iter(lexemes)
+		self.lookahead = deque()
+	
+	def peek(self, offset=0):
+		""" Returns the lexeme offset positions ahead of the cursor or None at the end """
+		while len(self.lookahead) <= offset:
+			lexeme = next(self.lexemes, None)
+			if lexeme is None:
+				return None
+			self.lookahead.append(lexeme)
+		return self.lookahead[offset]
+	
+	def next(self):
+		""" Returns the lexeme at the cursor and moves forward """
+		if self.peek() is None:
+			raise ParserError("Unexpected end of formula")
+		return self.lookahead.popleft()
+	
+	def remaining(self):
+		return list(self.lookahead) + list(self.lexemes)
+
+class Parser:
+	""" Precedence climbing parser for the language defined by grammar.ebnf.
+		Produces the same simplified syntax trees as parse_formula, but walks the lexemes
+		with a cursor instead of removing them from the front of a list. """
+	
+	def __init__(self):
+		#operator: (precedence, right associative, formula element)
+		#operators of equal precedence are collected into one Sum / Product.
+		self.binary_operators = {	'+':	(1, False, Sum),
+									'-':	(1, False, Sum),
+									'*':	(2, False, Product),
+									'/':	(2, False, Product),
+									'%':	(2, False, Product),
+									'\\':	(2, False, Product),
+									'^':	(3, True, Power),
+								}
+	
+	def parse(self, lexemes):
+		""" Parses a list or iterator of lexemes into a formula element.
+			All lexemes have to be consumed. """
+		stream = LexemeStream(lexemes)
+		
+		if stream.peek() is None:
+			raise ParserError("Too few lexemes for Sum")
+		
+		element = self.parse_expression(stream, 1)
+		
+		if stream.peek() is not None:
+			raise ParserError("Formula did not parse completely," +
+								"remaining lexemes are: {}".format(stream.remaining()))
+		return element
+	
+	def parse_expression(self, stream, min_precedence):
+		""" Parses operators of at least min_precedence.
+			Nesting (parentheses, negations, '^' chains, arguments) is tracked with an explicit
+			stack of frames instead of recursion, so the depth of a formula is not limited
+			by Python's recursion limit. """
+		stack = [_ExpressionFrame(min_precedence)]
+		value = None
+		
+		while True:
+			if value is None:
+				#the frame on top of the stack needs an operand
+				value = self._begin_toplevel(stream, stack)
+				continue
+			
+			value = stack[-1].receive(self, stream, stack, value)
+			if not stack:
+				return value
+	
+	def _begin_toplevel(self, stream, stack):
+		""" Parses decimals and variables, or pushes frames for negations, parentheses,
+			functions and assignments. Returns the element or None if frames were pushed. """
+		lexeme = stream.peek()
+		
+		if lexeme is None:
+			raise ParserError("Too few lexemes for Toplevel")
+		
+		if isinstance(lexeme, LexerValue):
+			stream.next()
+			return Decimal(lexeme.value)
+		
+		if isinstance(lexeme, LexerSymbol) and lexeme.value == '-':
+			stream.next()
+			stack.append(_NegationFrame())
+			return None
+		
+		if isinstance(lexeme, LexerParenthesis) and lexeme.value == '(':
+			stream.next()
+			stack.append(_ParenthesisFrame())
+			stack.append(_ExpressionFrame(1))
+			return None
+		
+		if isinstance(lexeme, LexerName):
+			stream.next()
+			following = stream.peek()
+			
+			if following is not None and following.value == '(':
+				stream.next()
+				following = stream.peek()
+				if following is None or following.value == ')': #support arity of 0
+					self._expect(stream, ')')
+					return self._function_or_definition(stream, stack, Function(lexeme.value, []))
+				stack.append(_FunctionFrame(lexeme.value))
+				stack.append(_ExpressionFrame(1))
+				return None
+			
+			if following is not None and following.value == '=':
+				stream.next()
+				stack.append(_AssignmentFrame(lexeme.value))
+				stack.append(_ExpressionFrame(1))
+				return None
+			
+			return Variable(lexeme.value)
+		
+		raise ParserError("Expected Toplevel, but found '{}'".format(lexeme.value))
+	
+	def _function_or_definition(self, stream, stack, function):
+		""" Returns function, or pushes a frame for the body if it is the left side of a definition.
+			Definitions are only allowed as whole formulas, the first operand of the outermost frame. """
+		following = stream.peek()
+		if following is not None and following.value == '=':
+			if len(stack) != 1 or stack[0].value is not None:
+				raise ParserError("Function '{}' can only be defined at the top level of a formula".format(function.name))
+			stream.next()
+			stack.append(_DefinitionFrame(function))
+			stack.append(_ExpressionFrame(1))
+			return None
+		return function
+	
+	def _peek_operator(self, stream):
+		lexeme = stream.peek()
+		if isinstance(lexeme, LexerSymbol):
+			return self.binary_operators.get(lexeme.value)
+		return None
+	
+	def _expect(self, stream, value):
+		lexeme = stream.peek()
+		if lexeme is None:
+			raise ParserError("Expected '{}', but found nothing.".format(value))
+		if lexeme.value != value:
+			raise ParserError("Expected '{}', but found '{}'".format(value, lexeme.value))
+		stream.next()
+
+class _ExpressionFrame:
+	""" Operator loop of parse_expression: collects operands of operators with at least min_precedence """
+	
+	def __init__(self, min_precedence):
+		self.min_precedence = min_precedence
+		self.value = None
+		self.element = None			#Sum, Product or Power waiting for an operand
+		self.precedence = None
+		self.additional = None
+		self.symbol = None
+	
+	def receive(self, parser, stream, stack, operand):
+		if self.value is None:
+			self.value = operand
+		elif self.element is Power:
+			self.value = Power(self.value, operand)
+			self.element = None
+		else:
+			self.additional.append(AdditionalElement(self.symbol, operand))
+			operator = parser._peek_operator(stream)
+			if operator is not None and operator[0] == self.precedence:
+				self.symbol = stream.next().value
+				stack.append(_ExpressionFrame(self.precedence + 1))
+				return None
+			self.value = self.element(self.value, self.additional)
+			self.element = None
+		
+		operator = parser._peek_operator(stream)
+		if operator is None or operator[0] < self.min_precedence:
+			stack.pop()
+			return self.value
+		
+		precedence, right_associative, element = operator
+		self.element = element
+		self.symbol = stream.next().value
+		if right_associative:
+			stack.append(_ExpressionFrame(precedence))
+		else:
+			self.precedence = precedence
+			self.additional = list()
+			stack.append(_ExpressionFrame(precedence + 1))
+		return None
+
+class _NegationFrame:
+	def receive(self, parser, stream, stack, operand):
+		stack.pop()
+		#empty string is a trick to create a nice syntax tree
+		return Toplevel("", AdditionalElement('-', operand))
+
+class _ParenthesisFrame:
+	def receive(self, parser, stream, stack, operand):
+		parser._expect(stream, ')')
+		stack.pop()
+		return operand
+
+class _AssignmentFrame:
+	def __init__(self, name):
+		self.name = name
+	
+	def receive(self, parser, stream, stack, operand):
+		stack.pop()
+		return Toplevel(Variable(self.name), AdditionalElement('=', operand))
+
+class _FunctionFrame:
+	def __init__(self, name):
+		self.name = name
+		self.arguments = list()
+	
+	def receive(self, parser, stream, stack, operand):
+		self.arguments.append(operand)
+		following = stream.peek()
+		if following is not None and following.value == ',':
+			stream.next()
+			stack.append(_ExpressionFrame(1))
+			return None
+		parser._expect(stream, ')')
+		stack.pop()
+		return parser._function_or_definition(stream, stack, Function(self.name, self.arguments))
+
+class _DefinitionFrame:
+	def __init__(self, function):
+		self.function = function
+	
+	def receive(self, parser, stream, stack, operand):
+		stack.pop()
+		return Definition.create(self.function, operand)
+
+class ParseCache:
+	""" Bounded LRU cache from formula text to parsed formula elements.
+		Formulas are normalized the way Lexer.lexe does (whitespaces are ignored),
+		so equivalent inputs share an entry. Cached trees are shared and must not be modified.
+		Optimized trees are cached per context and generation of the context they were
+		folded against. """
+	
+	def __init__(self, maxsize=4096, optimizer=None):
+		self.maxsize = maxsize
+		self.lexer = Lexer()
+		self.parser = Parser()
+		self.optimizer = optimizer if optimizer is not None else Optimizer()
+		self.optimizers = weakref.WeakKeyDictionary() #context -> (number, Optimizer) of other contexts
+		self.numbers = itertools.count(1)
+		self.entries = OrderedDict()
+		self.reports = dict() #key of an optimized entry -> OptimizationReport
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def parse(self, formula, optimize=False, stats=None, context=None):
+		""" Returns the parsed formula element for a formula string.
+			With optimize set, the tree is optimized against context (by default the context
+			of the cache's Optimizer), see optimization_report for what it changed.
+			With an EvaluationStats given, lexing, parsing and optimizing are timed. """
+		if optimize:
+			optimizer, key = self._optimizer(formula, context)
+		else:
+			key = (formula.replace(" ", ""), None, None)
+		
+		element = self.entries.get(key)
+		if element is not None:
+			self.hits += 1
+			self.entries.move_to_end(key)
+			if stats is not None:
+				stats.counters["parse cache hits"] += 1
+			return element
+		
+		self.misses += 1
+		report = None
+		if stats is None:
+			element = self.parser.parse(self.lexer.lexe_iter(formula))
+			if optimize:
+				element, report = optimizer.optimize(element)
+		else:
+			stats.counters["parse cache misses"] += 1
+			with stats.time("lex"):
+				lexemes = self.lexer.lexe(formula)
+			with stats.time("parse"):
+				element = self.parser.parse(lexemes)
+			if optimize:
+				with stats.time("optimize"):
+					element, report = optimizer.optimize(element)
+		
+		if self.maxsize > 0:
+			self.entries[key] = element
+			if report is not None:
+				self.reports[key] = report
+			if len(self.entries) > self.maxsize:
+				evicted = self.entries.popitem(last=False)[0]
+				self.reports.pop(evicted, None)
+				self.evictions += 1
+		return element
+	
+	def optimization_report(self, formula, context=None):
+		""" Returns the OptimizationReport of the optimized tree of a formula string,
+			optimizing it first if the cache does not hold it """
+		optimizer, key = self._optimizer(formula, context)
+		report = self.reports.get(key)
+		if report is None:
+			element, report = optimizer.optimize(self.parser.parse(self.lexer.lexe_iter(formula)))
+		return report
+	
+	def _optimizer(self, formula, context):
+		""" Returns the Optimizer for context and the cache key of the formula optimized by it,
+			which changes with the generation of the context """
+		if context is None or context is self.optimizer.context:
+			number, optimizer = 0, self.optimizer
+		else:
+			entry = self.optimizers.get(context)
+			if entry is None:
+				entry = self.optimizers[context] = (next(self.numbers), Optimizer(context, self.optimizer.simplify))
+			number, optimizer = entry
+		return optimizer, (formula.replace(" ", ""), number, optimizer.context.generation)
+	
+	def clear(self):
+		self.entries.clear()
+		self.reports.clear()
+	
+	def __len__(self):
+		return len(self.entries)
+	
+	def __str__(self):
+		return "{}: {} of {} entries, {} hits, {} misses, {} evictions".format(self.__class__.__name__,
+					len(self.entries), self.maxsize, self.hits, self.misses, self.evictions)
+
+default_cache = ParseCache()
+
+def parse(formula, optimize=False, context=None):
+	""" Parses a formula string using the shared default ParseCache """
+	return default_cache.parse(formula, optimize, context=context)
@@ -0,0 +1,205 @@
+""" Dependency tracked, incremental recomputation of named formulas
+
+	A ReactiveContext works like a small spreadsheet: define("area", "w * h") registers
+	a formula whose value is available as variable 'area'. The variables a formula reads
+	are extracted from its syntax tree, and when one of them changes through
+	set_variable, only the formulas depending on it (directly or through other formulas)
+	are recomputed, in topological order: immediately if eager is set, otherwise on the
+	next read through get_variable.
+	Variables read in the bodies of user defined functions (see Binder.UserFunction)
+	count as dependencies of the formulas calling them. Defining, registering or
+	unregistering a function recomputes the formulas calling it.
+	
+	NOTE: in lazy mode, self.variables holds the last computed values of formulas,
+	code reading the dictionary directly (like compiled formulas) may see stale values.
+"""
+
+from Binder import UserFunction
+from Evaluator import EvaluationError, EvaluationContext
+from FormulaStructure import FormulaElement, Function, Toplevel, Variable, AdditionalElement, children
+from Parser import default_cache
+
+class ReactiveFormula:
+	""" Named formula of a ReactiveContext and its last result """
+	
+	def __init__(self, name, element, dependencies, calls):
+		self.name = name
+		self.element = element
+		self.dependencies = dependencies
+		self.calls = calls #names of the functions called, also by the user defined functions called
+		self.value = None
+		self.error = None
+		self.dirty = True
+	
+	def __str__(self):
+		return "[{}: {} = {}]".format(self.__class__.__name__, self.name, self.element)
+
+class ReactiveContext(EvaluationContext):
+	""" EvaluationContext recomputing named formulas when the variables they use change """
+	
+	def __init__(self, eager=False):
+		super().__init__()
+		self.eager = eager
+		self.formulas = dict()		#name -> ReactiveFormula
+		self.dependents = dict()	#variable or formula name -> names of formulas reading it
+		self.callers = dict()		#function name -> names of formulas calling it
+		self.evaluations = 0
+		self.evaluations_avoided = 0
+	
+	def define(self, name, formula):
+		""" Defines (or redefines) a named formula, given as string or parsed FormulaElement """
+		element = formula if isinstance(formula, FormulaElement) else default_cache.parse(formula)
+		dependencies, calls = _dependencies(element, self.functions)
+		
+		if name in self.constants:
+			raise EvaluationError("Assignment to constant '{}' not allowed".format(name))
+		cycle = self._find_cycle(name, dependencies)
+		if cycle is not None:
+			raise EvaluationError("Cyclic dependency: {}".format(" -> ".join(cycle)))
+		
+		if name in self.formulas:
+			self._unlink(self.formulas[name])
+		cell = ReactiveFormula(name, element, dependencies, calls)
+		self.formulas[name] = cell
+		for dependency in dependencies:
+			self.dependents.setdefault(dependency, set()).add(name)
+		for function in calls:
+			self.callers.setdefault(function, set()).add(name)
+		
+		self._changed(name, include_self=True)
+	
+	def undefine(self, name):
+		""" Removes a named formula, its last value stays as ordinary variable """
+		if name not in self.formulas:
+			raise EvaluationError("Formula '{}' not defined.".format(name))
+		self._unlink(self.formulas.pop(name))
+	
+	def get_variable(self, name):
+		cell = self.formulas.get(name)
+		if cell is None:
+			return super().get_variable(name)
+		
+		if cell.dirty:
+			self._recompute(cell)
+		if cell.error is not None:
+			raise cell.error
+		return cell.value
+	
+	def set_variable(self, name, value):
+		if name in self.formulas:
+			raise EvaluationError("Variable '{}' is defined by a formula".format(name))
+		
+		value = super().set_variable(name, value)
+		if name in self.dependents:
+			self._changed(name)
+		else:
+			self.evaluations_avoided += len(self.formulas)
+		return value
+	
+	def define_function(self, name, parameters, body):
+		function = super().define_function(name, parameters, body)
+		self._function_changed(name)
+		return function
+	
+	def register_function(self, name, *arguments, **keywords):
+		super().register_function(name, *arguments, **keywords)
+		self._function_changed(name)
+	
+	def unregister_function(self, name):
+		super().unregister_function(name)
+		self._function_changed(name)
+	
+	def _function_changed(self, name):
+		""" Defines the formulas calling a function again, a new body may read other variables """
+		for caller in sorted(self.callers.get(name, ())):
+			self.define(caller, self.formulas[caller].element)
+	
+	def _changed(self, name, include_self=False):
+		""" Invalidates the formulas affected by a change of name, recomputes them if eager """
+		affected = self._affected(name, include_self)
+		self.evaluations_avoided += len(self.formulas) - len(affected)
+		
+		for cell in affected:
+			cell.dirty = True
+		if self.eager:
+			for cell in affected:
+				if cell.dirty:
+					self._recompute(cell)
+	
+	def _affected(self, name, include_self):
+		""" Returns the formulas depending on name, in topological order """
+		order = list()
+		visited = set()
+		#iterative depth first search, a formula is appended after all its dependents
+		pending = [(name, False)]
+		while pending:
+			current, finished = pending.pop()
+			if finished:
+				if current in self.formulas and (current != name or include_self):
+					order.append(self.formulas[current])
+				continue
+			if current in visited:
+				continue
+			visited.add(current)
+			pending.append((current, True))
+			for dependent in self.dependents.get(current, ()):
+				if dependent not in visited:
+					pending.append((dependent, False))
+		order.reverse()
+		return order
+	
+	def _recompute(self, cell):
+		cell.dirty = False
+		self.evaluations += 1
+		try:
+			cell.value = cell.element.evaluate(self)
+			cell.error = None
+			self.variables[cell.name] = cell.value
+		except (EvaluationError, ValueError, TypeError, ArithmeticError) as e:
+			cell.value = None
+			cell.error = e
+	
+	def _find_cycle(self, name, dependencies):
+		""" Returns a dependency path leading from name back to name, or None """
+		pending = [(dependency, [name, dependency]) for dependency in dependencies]
+		visited = set()
+		while pending:
+			current, path = pending.pop()
+			if current == name:
+				return path
+			if current in visited or current not in self.formulas:
+				continue
+			visited.add(current)
+			pending.extend((dependency, path + [dependency]) for dependency in self.formulas[current].dependencies)
+		return None
+	
+	def _unlink(self, cell):
+		for dependency in cell.dependencies:
+			self.dependents[dependency].discard(cell.name)
+			if not self.dependents[dependency]:
+				del self.dependents[dependency]
+		for function in cell.calls:
+			self.callers[function].discard(cell.name)
+			if not self.callers[function]:
+				del self.callers[function]
+
+def _dependencies(element, functions):
+	""" Returns the names of the variables a formula reads and of the functions it calls,
+		following the bodies of the user defined functions it calls """
+	names = set()
+	calls = set()
+	pending = [(element, None)] #element and parameters of the function body it belongs to
+	while pending:
+		current, parameters = pending.pop()
+		if isinstance(current, Toplevel) and isinstance(current.additional, AdditionalElement) and current.additional.operator == '=':
+			if parameters is None:
+				raise EvaluationError("Assignments are not supported in reactive formulas")
+		if isinstance(current, Variable) and (parameters is None or current.value not in parameters):
+			names.add(current.value)
+		if isinstance(current, Function) and current.name not in calls:
+			calls.add(current.name)
+			function = functions.get(current.name)
+			if isinstance(function, UserFunction):
+				pending.append((function.body, tuple(function.parameters)))
+		pending.extend((child, parameters) for child in children(current))
+	return names, calls
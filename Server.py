@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+""" Asyncio evaluation server and load generator
+	
+	Every connection gets its own Calculator and therefore its own EvaluationContext,
+	so 'ans' and assignments are scoped to the session. A request is one formula, or
+	a batch of formulas separated by ';', evaluated in order. The response is the
+	formatted result or error of each formula, separated by '; ' for batches.
+	Requests are framed either as lines ("line") or as a 4 byte big endian length
+	followed by UTF-8 text ("length"). Clients may pipeline requests, responses come
+	back in request order. Batches of at least offload_threshold formulas are evaluated
+	in a process pool, so they run in parallel and do not stall the other connections'
+	requests. The session's state is exported to the worker and imported back afterwards
+	(see ParallelEvaluator), functions that cannot be pickled keep their batches in the
+	server process.
+	The request "stats" returns the server's throughput and latency percentiles.
+	
+	python3 Server.py serve --port 7000
+	python3 Server.py load --port 7000 --connections 8 --requests 10000
+"""
+
+import argparse
+import asyncio
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from Calculator import Calculator
+from Evaluator import EvaluationError
+from ParallelEvaluator import export_state, import_state
+from Parser import ParseCache
+
+class ProtocolError(RuntimeError):
+	pass
+
+class LineFraming:
+	""" One request or response per line """
+	
+	name = "line"
+	
+	def __init__(self, maximum=1 << 24):
+		self.maximum = maximum
+	
+	async def read(self, reader):
+		""" Returns the next payload or None at the end of the stream """
+		try:
+			line = await reader.readuntil(b"\n")
+		except asyncio.IncompleteReadError as e:
+			if not e.partial:
+				return None
+			line = e.partial #last line without newline
+		except asyncio.LimitOverrunError as e:
+			await self._discard(reader, e.consumed)
+			raise ProtocolError("Line exceeds the limit of {} bytes".format(self.maximum))
+		return line.rstrip(b"\r\n")
+	
+	async def _discard(self, reader, consumed):
+		""" Skips the rest of an overlong line, so the error reply is not lost to a reset connection """
+		while True:
+			await reader.readexactly(consumed)
+			try:
+				await reader.readuntil(b"\n")
+				return
+			except asyncio.IncompleteReadError:
+				return
+			except asyncio.LimitOverrunError as e:
+				consumed = e.consumed
+	
+	def encode(self, payload):
+		return payload.replace(b"\n", b" ") + b"\n"
+
+class LengthFraming:
+	""" 4 byte big endian payload length, followed by the payload """
+	
+	name = "length"
+	header = struct.Struct(">I")
+	
+	def __init__(self, maximum=1 << 24):
+		self.maximum = maximum
+	
+	async def read(self, reader):
+		try:
+			header = await reader.readexactly(self.header.size)
+		except asyncio.IncompleteReadError as e:
+			if not e.partial:
+				return None
+			raise ProtocolError("Truncated length prefix")
+		
+		length, = self.header.unpack(header)
+		if length > self.maximum:
+			await self._discard(reader, length)
+			raise ProtocolError("Payload of {} bytes exceeds the limit of {}".format(length, self.maximum))
+		try:
+			return await reader.readexactly(length)
+		except asyncio.IncompleteReadError:
+			raise ProtocolError("Truncated payload")
+	
+	async def _discard(self, reader, length):
+		""" Skips an oversized payload, so the error reply is not lost to a reset connection """
+		while length > 0:
+			chunk = await reader.read(min(length, 1 << 16))
+			if not chunk:
+				return
+			length -= len(chunk)
+	
+	def encode(self, payload):
+		return self.header.pack(len(payload)) + payload
+
+FRAMINGS = {"line": LineFraming, "length": LengthFraming}
+
+def percentiles(samples, points=(50, 90, 99)):
+	""" Returns {point: value} of the nearest rank percentiles of samples """
+	ordered = sorted(samples)
+	if not ordered:
+		return {point: 0.0 for point in points}
+	return {point: ordered[min(len(ordered) - 1, max(0, int(round(point / 100 * len(ordered))) - 1))]
+			for point in points}
+
+class ServerStats:
+	""" Request counts and latencies (from receiving a request to writing its response) """
+	
+	def __init__(self, samples=100000):
+		self.start = time.perf_counter()
+		self.requests = 0
+		self.formulas = 0
+		self.offloaded = 0
+		self.connections = 0
+		self.active = 0
+		self.latencies = deque(maxlen=samples) #most recent latencies, in seconds
+	
+	def record(self, latency, formulas):
+		self.requests += 1
+		self.formulas += formulas
+		self.latencies.append(latency)
+	
+	def report(self):
+		elapsed = time.perf_counter() - self.start
+		rate = self.requests / elapsed if elapsed > 0 else 0.0
+		latency = percentiles(self.latencies)
+		return ("{} requests ({} formulas, {} offloaded batches) in {:.1f}s, {:.0f} requests/s, "
+				"{} connections ({} active), latency p50 {:.3f}ms p90 {:.3f}ms p99 {:.3f}ms").format(
+					self.requests, self.formulas, self.offloaded, elapsed, rate, self.connections,
+					self.active, latency[50] * 1000, latency[90] * 1000, latency[99] * 1000)
+
+class EvaluationServer:
+	""" Asyncio server evaluating formulas in per-connection contexts """
+	
+	def __init__(self, framing="line", pipeline=64, offload_threshold=16, executor=None, cache_size=1024):
+		self.framing = FRAMINGS[framing]()
+		self.pipeline = pipeline					#requests read ahead per connection
+		self.offload_threshold = offload_threshold	#formulas per batch to use the executor
+		self.executor = executor if executor is not None else ProcessPoolExecutor()
+		self.cache_size = cache_size				#entries of each connection's ParseCache
+		self.stats = ServerStats()
+		self.servers = list()
+	
+	async def start_tcp(self, host="127.0.0.1", port=7000):
+		server = await asyncio.start_server(self.handle, host, port, limit=self.limit())
+		self.servers.append(server)
+		return server
+	
+	async def start_unix(self, path):
+		server = await asyncio.start_unix_server(self.handle, path, limit=self.limit())
+		self.servers.append(server)
+		return server
+	
+	async def serve_forever(self):
+		await asyncio.gather(*[server.serve_forever() for server in self.servers])
+	
+	def close(self):
+		for server in self.servers:
+			server.close()
+		self.executor.shutdown(wait=False)
+	
+	def limit(self):
+		""" Buffer limit of the streams, asyncio's default of 64 KiB would cut long lines """
+		return self.framing.maximum + 2 #line end, possibly \r\n
+	
+	def session(self):
+		""" Returns the Calculator of a new connection """
+		calculator = Calculator()
+		calculator.parse_cache = ParseCache(self.cache_size)
+		return calculator
+	
+	async def handle(self, reader, writer):
+		""" Connection handler: reads requests ahead while earlier ones are evaluated """
+		self.stats.connections += 1
+		self.stats.active += 1
+		calculator = self.session()
+		requests = asyncio.Queue(self.pipeline)
+		receiver = asyncio.ensure_future(self.receive(reader, requests))
+		
+		try:
+			while True:
+				request = await requests.get()
+				if request is None:
+					break
+				received, payload = request
+				
+				response, formulas = await self.respond(calculator, payload.decode("utf-8", "replace"))
+				writer.write(self.framing.encode(response.encode("utf-8")))
+				self.stats.record(time.perf_counter() - received, formulas)
+				if requests.empty():
+					await writer.drain()
+			await receiver #reports protocol errors
+		except ProtocolError as e:
+			writer.write(self.framing.encode("ProtocolError: {}".format(e).encode("utf-8")))
+		except ConnectionError:
+			pass
+		except asyncio.CancelledError:
+			pass #server shutdown, the connection is closed below
+		finally:
+			receiver.cancel()
+			self.stats.active -= 1
+			await _close(writer)
+	
+	async def receive(self, reader, requests):
+		try:
+			while True:
+				payload = await self.framing.read(reader)
+				if payload is None:
+					break
+				await requests.put((time.perf_counter(), payload))
+		finally:
+			await requests.put(None)
+	
+	async def respond(self, calculator, request):
+		""" Returns the response to a request and the number of evaluated formulas """
+		if request.strip() == "stats":
+			return self.stats.report(), 0
+		
+		formulas = [formula.strip() for formula in request.split(";")]
+		state = None
+		if len(formulas) >= self.offload_threshold:
+			try:
+				state = export_state(calculator.context)
+			except EvaluationError:
+				pass #unpicklable functions, evaluated here
+		
+		if state is None:
+			return "; ".join(_evaluate(calculator, formulas)), len(formulas)
+		
+		self.stats.offloaded += 1
+		loop = asyncio.get_running_loop()
+		results, state = await loop.run_in_executor(self.executor, _evaluate_state, state, formulas)
+		import_state(state, calculator.context)
+		return "; ".join(results), len(formulas)
+
+def _evaluate(calculator, formulas):
+	""" Formats one result or error per formula, empty formulas give empty results """
+	return [next(iter(calculator.evaluate_lines([formula])), "") for formula in formulas]
+
+def _evaluate_state(state, formulas):
+	""" Evaluates a batch in a worker process, returns the results and the session's new state """
+	calculator = Calculator()
+	import_state(state, calculator.context)
+	return _evaluate(calculator, formulas), export_state(calculator.context)
+
+async def _close(writer):
+	writer.close()
+	try:
+		await writer.wait_closed()
+	except ConnectionError:
+		pass
+
+class LoadGenerator:
+	""" Client opening several connections, each keeping up to pipeline requests in flight """
+	
+	def __init__(self, formulas, framing="line", connections=8, requests=10000, pipeline=32):
+		self.formulas = formulas
+		self.framing = FRAMINGS[framing]()
+		self.connections = connections
+		self.requests = requests
+		self.pipeline = pipeline
+		self.latencies = list()
+		self.errors = 0
+	
+	async def run(self, host="127.0.0.1", port=7000, path=None):
+		""" Sends the requests, returns a report of throughput and client side latencies """
+		start = time.perf_counter()
+		share, extra = divmod(self.requests, self.connections)
+		await asyncio.gather(*[self.connection(host, port, path, share + (1 if index < extra else 0))
+								for index in range(self.connections)])
+		elapsed = time.perf_counter() - start
+		
+		latency = percentiles(self.latencies)
+		return ("{} requests over {} connections in {:.3f}s, {:.0f} requests/s, {} errors, "
+				"latency p50 {:.3f}ms p90 {:.3f}ms p99 {:.3f}ms").format(len(self.latencies),
+					self.connections, elapsed, len(self.latencies) / elapsed if elapsed > 0 else 0.0,
+					self.errors, latency[50] * 1000, latency[90] * 1000, latency[99] * 1000)
+	
+	async def connection(self, host, port, path, count):
+		if path is not None:
+			reader, writer = await asyncio.open_unix_connection(path, limit=self.framing.maximum + 2)
+		else:
+			reader, writer = await asyncio.open_connection(host, port, limit=self.framing.maximum + 2)
+		
+		sent = deque() #send times of requests in flight
+		window = asyncio.Semaphore(self.pipeline)
+		
+		async def send():
+			for index in range(count):
+				await window.acquire()
+				sent.append(time.perf_counter())
+				writer.write(self.framing.encode(self.formulas[index % len(self.formulas)].encode("utf-8")))
+				await writer.drain()
+		
+		sender = asyncio.ensure_future(send())
+		try:
+			for index in range(count):
+				response = await self.framing.read(reader)
+				if response is None:
+					raise ProtocolError("Connection closed with {} requests outstanding".format(count - index))
+				self.latencies.append(time.perf_counter() - sent.popleft())
+				if b"Error: " in response:
+					self.errors += 1
+				window.release()
+			await sender
+		finally:
+			sender.cancel()
+			await _close(writer)
+
+async def _serve(arguments):
+	server = EvaluationServer(arguments.framing, arguments.pipeline, arguments.offload_threshold)
+	if arguments.unix is not None:
+		await server.start_unix(arguments.unix)
+	if arguments.port is not None or arguments.unix is None:
+		await server.start_tcp(arguments.host, arguments.port if arguments.port is not None else 7000)
+	
+	async def report():
+		while True:
+			await asyncio.sleep(arguments.report_interval)
+			print(server.stats.report(), file=sys.stderr)
+	
+	reporter = asyncio.ensure_future(report()) if arguments.report_interval > 0 else None
+	try:
+		await server.serve_forever()
+	finally:
+		if reporter is not None:
+			reporter.cancel()
+		server.close()
+
+async def _load(arguments):
+	formulas = arguments.formulas or ["x = 2", "x * sin(x) + 1", "ans ^ 2 - x", "max(1, 2, x) % 3"]
+	if arguments.batch > 1:
+		formulas = ["; ".join(formulas[(index + offset) % len(formulas)] for offset in range(arguments.batch))
+					for index in range(len(formulas))]
+	generator = LoadGenerator(formulas, arguments.framing, arguments.connections,
+								arguments.requests, arguments.pipeline)
+	print(await generator.run(arguments.host, arguments.port, arguments.unix))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Formula evaluation server and load generator")
+	parser.add_argument("mode", choices=["serve", "load"])
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=None, help="TCP port (default: 7000 unless --unix is given)")
+	parser.add_argument("--unix", metavar="PATH", help="Unix socket path")
+	parser.add_argument("--framing", choices=sorted(FRAMINGS), default="line")
+	parser.add_argument("--pipeline", type=int, default=32, help="requests in flight per connection")
+	parser.add_argument("--offload-threshold", type=int, default=16, help="batch size evaluated in the process pool")
+	parser.add_argument("--report-interval", type=float, default=10.0, help="seconds between stats reports, 0 disables")
+	parser.add_argument("--connections", type=int, default=8)
+	parser.add_argument("--requests", type=int, default=10000)
+	parser.add_argument("--batch", type=int, default=1, help="formulas per request")
+	parser.add_argument("formulas", nargs="*", help="formulas sent by the load generator")
+	arguments = parser.parse_args()
+	
+	if arguments.mode == "load" and arguments.port is None and arguments.unix is None:
+		arguments.port = 7000
+	
+	try:
+		asyncio.run(_serve(arguments) if arguments.mode == "serve" else _load(arguments))
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+""" Immutable EvaluationContext snapshots and copy-on-write forks
+	
+	A ContextSnapshot freezes the variables, constants and functions of a context.
+	Its dictionaries are never modified again, so any number of threads can read them
+	without locking. snapshot.fork() returns a ForkedContext, an ordinary
+	EvaluationContext sharing the snapshot's dictionaries until its first write:
+	assignments (including Calculator's 'ans') and function registrations copy the
+	affected dictionary once and stay private to the fork. Reads always go to a plain
+	dictionary, so forks evaluate (and compile or bind) exactly as fast as the original.
+	
+	Give every thread its own fork: a fork is cheap, but like EvaluationContext
+	it is not safe to write to from several threads. Forks of contexts with memoized or
+	user defined functions copy the functions right away: memo caches are private to a
+	fork and user defined functions read the variables of the fork calling them.
+	
+	python3 Snapshot.py runs a stress test with concurrent forks and writers,
+	tests/test_snapshot.py runs it as part of the test suite.
+"""
+
+import argparse
+import random
+import threading
+from types import MappingProxyType
+
+from Binder import UserFunction
+from Evaluator import EvaluationError, EvaluationContext, MemoizedFunction
+
+class ContextSnapshot:
+	""" Read-only state of an EvaluationContext """
+	
+	def __init__(self, variables, constants, functions):
+		#callers hand over dictionaries nobody modifies anymore
+		self._variables = variables
+		self._functions = functions
+		self.variables = MappingProxyType(variables)
+		self.functions = MappingProxyType(functions)
+		self.constants = tuple(constants)
+	
+	def fork(self):
+		""" Returns a new writable context based on this snapshot """
+		return ForkedContext(self)
+	
+	def __str__(self):
+		return "[{}: {} variables, {} functions]".format(self.__class__.__name__,
+					len(self.variables), len(self.functions))
+
+def snapshot(context):
+	""" Returns a ContextSnapshot of any EvaluationContext """
+	if isinstance(context, ForkedContext):
+		return context.snapshot()
+	return ContextSnapshot(dict(context.variables), context.constants, _private_functions(context.functions))
+
+def _private_functions(functions, context=None):
+	""" Copies a function dictionary, memoized functions get their own caches and
+		user defined functions are bound to context """
+	private = dict()
+	for name, function in functions.items():
+		if isinstance(function, MemoizedFunction):
+			function = MemoizedFunction(function, function.maxsize)
+		elif isinstance(function, UserFunction) and context is not None:
+			function = function.bound_to(context)
+		private[name] = function
+	return private
+
+def _stateful(functions):
+	return any(isinstance(function, (MemoizedFunction, UserFunction)) for function in functions.values())
+
+class ForkedContext(EvaluationContext):
+	""" EvaluationContext sharing the dictionaries of a ContextSnapshot until it writes to them """
+	
+	def __init__(self, snapshot):
+		#no super().__init__(), the snapshot provides variables, constants and functions
+		self.variables = snapshot._variables
+		self.constants = snapshot.constants
+		self.functions = snapshot._functions
+		self.shared_variables = True
+		self.shared_functions = True
+		self.stats = None
+		self.generation = 0
+		self.copies = 0 #dictionaries copied on write
+		
+		#memo caches are not thread safe and user defined functions are bound to a context
+		if _stateful(self.functions):
+			self._own_functions()
+	
+	def _own_variables(self):
+		if self.shared_variables:
+			self.variables = dict(self.variables)
+			self.shared_variables = False
+			self.copies += 1
+	
+	def _own_functions(self):
+		if self.shared_functions:
+			self.functions = _private_functions(self.functions, self)
+			self.shared_functions = False
+			self.copies += 1
+			self.generation += 1
+	
+	def set_variable(self, name, value):
+		if name in self.constants:
+			raise EvaluationError("Assignment to constant '{}' not allowed".format(name))
+		self._own_variables()
+		return super().set_variable(name, value)
+	
+	def set_constant(self, name, value):
+		self._own_variables()
+		self.constants = list(self.constants) #the snapshot's tuple
+		return super().set_constant(name, value)
+	
+	def register_function(self, name, arity, function, description, vectorized=None, pure=False, derivative=None):
+		self._own_functions()
+		super().register_function(name, arity, function, description, vectorized, pure, derivative)
+	
+	def unregister_function(self, name):
+		self._own_functions()
+		super().unregister_function(name)
+	
+	def memoize(self, name, maxsize=128):
+		self._own_functions()
+		return super().memoize(name, maxsize)
+	
+	def define_function(self, name, parameters, body):
+		self._own_functions()
+		return super().define_function(name, parameters, body)
+	
+	def snapshot(self):
+		""" Returns a snapshot of the current state in O(1): the dictionaries are handed to
+			the snapshot and this context copies them again on its next write """
+		self.shared_variables = True
+		if self.shared_functions or not _stateful(self.functions):
+			self.shared_functions = True
+			return ContextSnapshot(self.variables, self.constants, self.functions)
+		return ContextSnapshot(self.variables, self.constants, _private_functions(self.functions))
+	
+	def fork(self):
+		return self.snapshot().fork()
+
+def stress(threads=8, iterations=2000, seed=0):
+	""" Evaluates formulas in many threads against forks of one shared snapshot, while
+		other threads keep writing to their own forks and the original context.
+		Returns the number of wrong results (0 expected). """
+	from Parser import ParseCache
+	
+	base = EvaluationContext()
+	for index in range(100):
+		base.set_variable("v{}".format(index), float(index))
+	shared = snapshot(base)
+	
+	formulas = ["x * v{} + y".format(index) for index in range(100)]
+	errors = list()
+	start = threading.Barrier(threads + 1)
+	
+	def worker(number):
+		cache = ParseCache() #parse caches are not thread safe either
+		generator = random.Random(seed + number)
+		wrong = 0
+		start.wait()
+		for iteration in range(iterations):
+			context = shared.fork()
+			x, y = generator.randrange(1, 1000) / 8, float(number) #exact and without exponent
+			cache.parse("x = {!r}".format(x)).evaluate(context)
+			context.set_variable("y", y)
+			index = generator.randrange(len(formulas))
+			result = cache.parse(formulas[index]).evaluate(context)
+			if result != x * index + y:
+				wrong += 1
+			
+			#nested fork: sees the parent's assignments, its own do not leak back
+			nested = context.fork()
+			nested.set_variable("x", -1.0)
+			if context.get_variable("x") != x or nested.get_variable("v1") != 1.0:
+				wrong += 1
+			
+			#writes to the original context never reach existing snapshots
+			if "x" in shared.variables or shared.variables["v{}".format(index)] != index:
+				wrong += 1
+		errors.append(wrong)
+	
+	def writer():
+		start.wait()
+		for iteration in range(iterations):
+			base.set_variable("v{}".format(iteration % 100), -1.0)
+			base.set_variable("x", float(iteration))
+	
+	pool = [threading.Thread(target=worker, args=(number,)) for number in range(threads - 1)]
+	pool.append(threading.Thread(target=writer))
+	for thread in pool:
+		thread.start()
+	start.wait()
+	for thread in pool:
+		thread.join()
+	return sum(errors)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Stress test of concurrent context snapshots")
+	parser.add_argument("--threads", type=int, default=8)
+	parser.add_argument("--iterations", type=int, default=2000)
+	arguments = parser.parse_args()
+	
+	wrong = stress(arguments.threads, arguments.iterations)
+	print("{} threads, {} iterations: {} wrong results".format(arguments.threads, arguments.iterations, wrong))
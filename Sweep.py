@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+""" Parallel parameter sweeps of one formula over a grid of variable values
+	
+	The grid is the cartesian product of the values given per variable, the last
+	variable varying fastest. Its flat index range is split into chunks, which worker
+	processes evaluate with a compiled formula (see Compiler), writing the results
+	straight into a multiprocessing.shared_memory buffer of doubles. Only the chunk
+	bounds and error counts travel between the processes, results are never pickled.
+	
+	Points raising an EvaluationError, ValueError or ArithmeticError (e.g. sqrt(-1) or
+	1/0) result in nan, and so do complex results with an imaginary part.
+	
+	python3 Sweep.py "sin(x) * y" x=0:6.28:1000 y=1:2:1000 runs a sweep from the
+	command line and reports its progress and throughput.
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+from Compiler import Compiler
+from Evaluator import EvaluationError, EvaluationContext
+from FormulaStructure import has_assignment
+from ParallelEvaluator import export_state, import_state
+
+DOUBLE = array('d').itemsize
+
+def linspace(start, stop, count):
+	""" Returns count evenly spaced values from start to stop (both included) """
+	if count < 2:
+		return [float(start)] * count
+	step = (stop - start) / (count - 1)
+	return [start + index * step for index in range(count - 1)] + [float(stop)]
+
+def _rows(sizes, start, stop):
+	""" Splits the flat index range [start, stop) of a grid into rows of the last axis.
+		Yields the indices of the outer axes with the first and last index in the row. """
+	inner = sizes[-1]
+	while start < stop:
+		row, first = divmod(start, inner)
+		last = min(inner, first + stop - start)
+		
+		outer = list()
+		for size in reversed(sizes[:-1]):
+			row, index = divmod(row, size)
+			outer.append(index)
+		outer.reverse()
+		
+		yield outer, first, last
+		start += last - first
+
+#per process state of the workers
+_context = None
+_compiled = None
+_axes = None
+_results = None
+_memory = None
+_base = None
+
+def _initialize(state, element, axes, name):
+	global _context, _compiled, _axes, _results, _memory, _base
+	_context = import_state(state)
+	_compiled = Compiler(_context).compile(element)
+	_axes = axes
+	_memory = shared_memory.SharedMemory(name)
+	_results = _memory.buf.cast('d')
+	#formulas with assignments start from the same variables at every point
+	_base = dict(_context.variables) if has_assignment(element) else None
+
+def _sweep_chunk(start, stop):
+	""" Evaluates the grid points [start, stop) in a worker, returns the number of errors """
+	inner_name, inner_values = _axes[-1]
+	sizes = [len(values) for name, values in _axes]
+	evaluate = _compiled.evaluate
+	context = _context
+	results = _results
+	errors = 0
+	
+	index = start
+	for outer, first, last in _rows(sizes, start, stop):
+		row = [(name, values[position]) for position, (name, values) in zip(outer, _axes)]
+		variables = context.variables
+		variables.update(row)
+		
+		for value in inner_values[first:last]:
+			if _base is not None:
+				variables = context.variables = dict(_base)
+				variables.update(row)
+			variables[inner_name] = value
+			
+			try:
+				result = evaluate(context)
+				if isinstance(result, complex):
+					result = result.real if result.imag == 0 else math.nan
+				results[index] = result
+			except (EvaluationError, ValueError, TypeError, ArithmeticError, RecursionError):
+				results[index] = math.nan
+				errors += 1
+			index += 1
+	return errors
+
+class SweepChunk:
+	""" Completed chunk of a sweep: values of the flat grid indices [start, stop) """
+	
+	def __init__(self, start, stop, values, errors):
+		self.start = start
+		self.stop = stop
+		self.values = values
+		self.errors = errors
+	
+	def __str__(self):
+		return "[{}: {}..{}, {} errors]".format(self.__class__.__name__, self.start, self.stop, self.errors)
+	
+	def __repr__(self):
+		return str(self)
+
+class SweepResult:
+	""" Values of a whole sweep, index with one index per variable, e.g. result[i, j] """
+	
+	def __init__(self, names, shape, values, errors, seconds):
+		self.names = names
+		self.shape = shape
+		self.values = values
+		self.errors = errors
+		self.seconds = seconds
+	
+	def flat_index(self, indices):
+		flat = 0
+		for index, size in zip(indices, self.shape):
+			if not 0 <= index < size:
+				raise IndexError("Grid index {} out of range".format(tuple(indices)))
+			flat = flat * size + index
+		return flat
+	
+	def __getitem__(self, indices):
+		if not isinstance(indices, tuple):
+			indices = (indices,)
+		if len(indices) != len(self.shape):
+			raise IndexError("Expected {} grid indices, got {}".format(len(self.shape), len(indices)))
+		return self.values[self.flat_index(indices)]
+	
+	def __len__(self):
+		return len(self.values)
+	
+	def __str__(self):
+		return "[{}: {} over {}, {} points, {} errors, {:.0f} points/s]".format(self.__class__.__name__,
+					" x ".join(map(str, self.shape)), ", ".join(self.names), len(self.values), self.errors,
+					len(self.values) / self.seconds if self.seconds > 0 else 0.0)
+
+class ParameterSweep:
+	""" Evaluates a parsed formula over a grid of variable values in worker processes.
+		Axes are (name, values) pairs (or a dictionary), the first one is the outermost. """
+	
+	def __init__(self, element, context=None, workers=None, chunksize=16384):
+		self.element = element
+		self.context = context if context is not None else EvaluationContext()
+		self.workers = workers
+		self.chunksize = chunksize
+	
+	def _axes(self, axes):
+		if isinstance(axes, dict):
+			axes = axes.items()
+		axes = [(name, tuple(values)) for name, values in axes]
+		
+		if not axes:
+			raise EvaluationError("A sweep needs at least one variable")
+		for name, values in axes:
+			if name in self.context.constants:
+				raise EvaluationError("Assignment to constant '{}' not allowed".format(name))
+			if not values:
+				raise EvaluationError("No values given for variable '{}'".format(name))
+		return axes
+	
+	def _execute(self, axes, memory, total):
+		""" Evaluates all chunks into memory, yields (start, stop, errors) as chunks complete """
+		workers = self.workers if self.workers is not None else os.cpu_count() or 1
+		state = export_state(self.context)
+		with ProcessPoolExecutor(workers, initializer=_initialize,
+									initargs=(state, self.element, axes, memory.name)) as executor:
+			futures = dict()
+			for start in range(0, total, self.chunksize):
+				stop = min(total, start + self.chunksize)
+				futures[executor.submit(_sweep_chunk, start, stop)] = (start, stop)
+			
+			for future in as_completed(futures):
+				start, stop = futures[future]
+				yield start, stop, future.result()
+	
+	def _memory(self, axes):
+		total = 1
+		for name, values in axes:
+			total *= len(values)
+		return shared_memory.SharedMemory(create=True, size=max(1, total * DOUBLE)), total
+	
+	def run(self, axes, progress=None):
+		""" Returns the SweepResult of the whole grid. progress(done, total) is called with
+			the number of evaluated points whenever a chunk completes. """
+		axes = self._axes(axes)
+		memory, total = self._memory(axes)
+		begin = time.perf_counter()
+		try:
+			done = errors = 0
+			for start, stop, count in self._execute(axes, memory, total):
+				done += stop - start
+				errors += count
+				if progress is not None:
+					progress(done, total)
+			
+			values = array('d')
+			values.frombytes(memory.buf[:total * DOUBLE])
+		finally:
+			memory.close()
+			memory.unlink()
+		
+		shape = tuple(len(values) for name, values in axes)
+		return SweepResult([name for name, values in axes], shape, values, errors, time.perf_counter() - begin)
+	
+	def stream(self, axes):
+		""" Yields a SweepChunk with copied values as each chunk completes, in any order """
+		axes = self._axes(axes)
+		memory, total = self._memory(axes)
+		try:
+			for start, stop, errors in self._execute(axes, memory, total):
+				values = array('d')
+				values.frombytes(memory.buf[start * DOUBLE:stop * DOUBLE])
+				yield SweepChunk(start, stop, values, errors)
+		finally:
+			memory.close()
+			memory.unlink()
+
+def _axis(text):
+	""" Parses name=start:stop:count or name=value,value,... """
+	name, separator, values = text.partition("=")
+	if not separator:
+		raise argparse.ArgumentTypeError("Expected name=start:stop:count or name=value,..., got '{}'".format(text))
+	try:
+		if ":" in values:
+			start, stop, count = values.split(":")
+			return name, linspace(float(start), float(stop), int(count))
+		return name, [float(value) for value in values.split(",")]
+	except ValueError as e:
+		raise argparse.ArgumentTypeError(str(e))
+
+if __name__ == '__main__':
+	from Parser import default_cache
+	
+	parser = argparse.ArgumentParser(description="Evaluates a formula over a grid of variable values")
+	parser.add_argument("formula")
+	parser.add_argument("axes", nargs="+", type=_axis, metavar="name=start:stop:count")
+	parser.add_argument("--workers", type=int)
+	parser.add_argument("--chunksize", type=int, default=16384)
+	arguments = parser.parse_args()
+	
+	def progress(done, total):
+		print("\r{}/{} points ({:.0%})".format(done, total, done / total), end="", file=sys.stderr)
+	
+	sweep = ParameterSweep(default_cache.parse(arguments.formula), workers=arguments.workers,
+							chunksize=arguments.chunksize)
+	result = sweep.run(arguments.axes, progress)
+	print(file=sys.stderr)
+	print(result)
@@ -0,0 +1,157 @@
+""" Adaptive tiered execution of hot formulas
+	
+	Most formulas are evaluated once, so optimizing them up front does not pay off.
+	TieredEvaluator counts the evaluations of every parsed formula and promotes it to
+	the next tier once its count reaches the tier's threshold:
+	
+	- tree:			the parsed tree, evaluated as it is
+	- optimized:	literals converted and constants folded (see Optimizer)
+	- bound:		the optimized tree with variables and functions resolved (see Binder)
+	- compiled:		the optimized tree compiled into a Python function (see Compiler)
+	
+	Optimized forms depend on the functions and constants of the context. Whenever its
+	generation changes (register_function, unregister_function, set_constant, ...), a
+	formula is demoted to the tree and has to earn its promotions again.
+	Formulas with assignments stop at the optimized tier. Formulas reading unknown
+	variables or calling unknown functions or functions with the wrong number of
+	arguments stop at the bound tier, also if only the bodies of user defined functions
+	they call do so. Compiled formulas look them up before evaluating anything and would
+	raise a different error. Definitions of functions are always
+	evaluated as trees.
+"""
+
+import weakref
+from collections import Counter
+
+from Binder import BoundFormula, UserFunction
+from Compiler import Compiler
+from Evaluator import EvaluationError, EvaluationContext
+from FormulaStructure import ParserError, Function, Variable, Definition, has_assignment, children
+from Optimizer import Optimizer
+
+TREE = "tree"
+OPTIMIZED = "optimized"
+BOUND = "bound"
+COMPILED = "compiled"
+TIERS = (TREE, OPTIMIZED, BOUND, COMPILED)
+
+#evaluations after which a formula is promoted to optimized, bound and compiled
+THRESHOLDS = (2, 16, 256)
+
+def _resolvable(element, context):
+	""" Returns True if every variable element reads exists in context and every
+		function it calls exists and accepts its arguments, also in the bodies of the
+		user defined functions it calls, which compiled formulas inline """
+	variables = context.variables
+	functions = context.functions
+	visited = set()
+	pending = [(element, ())] #element and parameters of the function body it belongs to
+	while pending:
+		current, parameters = pending.pop()
+		if isinstance(current, Variable) and current.value not in parameters and current.value not in variables:
+			return False
+		if isinstance(current, Function):
+			function = functions.get(current.name)
+			if function is None:
+				return False
+			count = len(current.arguments)
+			if not (function.arity == count or (function.arity < 0 and abs(function.arity) - 1 <= count)):
+				return False
+			if isinstance(function, UserFunction) and current.name not in visited:
+				visited.add(current.name)
+				pending.append((function.body, tuple(function.parameters)))
+		pending.extend((child, parameters) for child in children(current))
+	return True
+
+class _Profile:
+	""" Evaluation count and current form of one formula """
+	
+	__slots__ = ("count", "tier", "ceiling", "optimized", "evaluate", "generation")
+	
+	def __init__(self, element, generation):
+		self.count = 0
+		self.tier = 0
+		self.ceiling = len(TIERS) - 1 if not isinstance(element, Definition) else 0
+		self.optimized = None
+		self.evaluate = element.evaluate
+		self.generation = generation
+
+class TieredEvaluator:
+	""" Evaluates formulas in a context, promoting hot ones, see module documentation """
+	
+	def __init__(self, context=None, thresholds=THRESHOLDS):
+		self.context = context if context is not None else EvaluationContext()
+		self.thresholds = tuple(thresholds)
+		self.optimizer = Optimizer(self.context)
+		self.compiler = Compiler(self.context)
+		self.profiles = weakref.WeakKeyDictionary() #formula element -> _Profile
+		self.transitions = Counter() #(from tier, to tier) -> count
+		self.failures = 0 #promotions that raised, the formula stays in its tier
+	
+	def evaluate(self, element):
+		""" Evaluates element like element.evaluate(context), in its current tier """
+		context = self.context
+		if context.stats is not None:
+			return element.evaluate(context) #statistics measure the tree
+		
+		profile = self.profiles.get(element)
+		if profile is None:
+			profile = _Profile(element, context.generation)
+			self.profiles[element] = profile
+		elif profile.generation != context.generation:
+			self._demote(element, profile)
+		
+		profile.count += 1
+		if profile.tier < profile.ceiling and profile.count >= self.thresholds[profile.tier]:
+			self._promote(element, profile)
+		return profile.evaluate(context)
+	
+	def tier(self, element):
+		""" Returns the name of the tier element is evaluated in """
+		profile = self.profiles.get(element)
+		return TIERS[profile.tier] if profile is not None else TREE
+	
+	def _promote(self, element, profile):
+		tier = profile.tier + 1
+		try:
+			if tier == 1:
+				profile.optimized = self.optimizer.optimize(element)[0]
+				if has_assignment(element):
+					profile.ceiling = 1
+				elif not _resolvable(element, self.context):
+					profile.ceiling = 2
+				evaluate = profile.optimized.evaluate
+			elif tier == 2:
+				evaluate = BoundFormula(profile.optimized, self.context).evaluate
+			else:
+				evaluate = self.compiler.compile(profile.optimized).evaluate
+		except (EvaluationError, ParserError, RecursionError):
+			profile.ceiling = profile.tier
+			self.failures += 1
+			return
+		
+		self.transitions[TIERS[profile.tier], TIERS[tier]] += 1
+		profile.tier = tier
+		profile.evaluate = evaluate
+	
+	def _demote(self, element, profile):
+		if profile.tier > 0:
+			self.transitions[TIERS[profile.tier], TREE] += 1
+		profile.__init__(element, self.context.generation)
+	
+	def counts(self):
+		""" Returns the number of formulas per tier """
+		counts = Counter({tier: 0 for tier in TIERS})
+		for profile in self.profiles.values():
+			counts[TIERS[profile.tier]] += 1
+		return counts
+	
+	def __str__(self):
+		counts = self.counts()
+		lines = ["{}: {} formulas ({})".format(self.__class__.__name__, len(self.profiles),
+					", ".join("{} {}".format(counts[tier], tier) for tier in TIERS))]
+		for (source, target), count in sorted(self.transitions.items()):
+			lines.append("{} -> {}: {}".format(source, target, count))
+		if self.failures:
+			lines.append("failed promotions: {}".format(self.failures))
+		return "\n".join(lines)
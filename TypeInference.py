@@ -0,0 +1,269 @@
+""" Real-only fast path with complex promotion on demand
+	
+	infer() proves whether a formula only ever sees real numbers, given the types of
+	the variables it reads. TypedEvaluator compiles every formula (see Compiler) once
+	and caches the chosen path per formula and variable types:
+	
+	- real formulas, where no node computes with a complex number, run with a function
+	  table of plain math functions, where conj, real and imag do not wrap their
+	  arguments in complex(...) anymore.
+	- all other formulas run with a cmath backed table, so that e.g. sqrt(-1) results
+	  in 1i instead of raising a ValueError.
+	
+	Each path has its own compiled code and its own versions of the user defined
+	functions (see Binder.UserFunction), whose bodies call the functions of the path.
+	
+	A real formula can still leave the reals at runtime (sqrt(x) with x < 0, or a
+	negative base raised to a fractional power). The resulting ValueError or TypeError
+	promotes the formula to the complex path for good, and it is evaluated again.
+	Formulas that would repeat side effects that way (assignments below the root,
+	calls of impure functions, also inside the bodies of user defined functions)
+	always take the complex path. Definitions of functions are evaluated as trees.
+"""
+
+import cmath
+import math
+import weakref
+
+import Evaluator
+from Binder import UserFunction
+from Compiler import Compiler
+from Evaluator import EvaluationContext
+from FormulaStructure import (Function, Toplevel, Variable, Constant, Definition, AdditionalElement,
+								children, free_variables)
+
+REAL = "real"
+COMPLEX = "complex"
+
+def _promoting(real_function, complex_function):
+	""" Uses the math version for real arguments inside its domain, the cmath version otherwise.
+		The math functions raise a TypeError for complex arguments, no type is checked. """
+	def promoting(*arguments):
+		try:
+			return real_function(*arguments)
+		except (ValueError, TypeError):
+			return complex_function(*arguments)
+	return promoting
+
+def _complex_log(a, base=None):
+	return cmath.log(a) if base is None else cmath.log(a, base)
+
+def _complex_power(a, b):
+	return a ** b
+
+def _complex_builtins():
+	""" Maps the scalar builtins of EvaluationContext to versions accepting complex numbers """
+	return {	math.fabs:		abs,
+				math.exp:		_promoting(math.exp, cmath.exp),
+				math.log:		_promoting(math.log, _complex_log),
+				math.log10:		_promoting(math.log10, cmath.log10),
+				math.log2:		_promoting(math.log2, lambda a: cmath.log(a) / math.log(2)),
+				math.sqrt:		_promoting(math.sqrt, cmath.sqrt),
+				math.pow:		_promoting(math.pow, _complex_power),
+				math.sin:		_promoting(math.sin, cmath.sin),
+				math.cos:		_promoting(math.cos, cmath.cos),
+				math.tan:		_promoting(math.tan, cmath.tan),
+				math.asin:		_promoting(math.asin, cmath.asin),
+				math.acos:		_promoting(math.acos, cmath.acos),
+				math.atan:		_promoting(math.atan, cmath.atan),
+				math.degrees:	lambda a: a * (180 / math.pi),
+				math.radians:	lambda a: a * (math.pi / 180),
+			}
+
+def _real_imag(a):
+	float(a) #raises a TypeError for complex numbers, which promotes the formula
+	return 0.0
+
+def _real_builtins():
+	""" Maps the builtins wrapping their arguments in complex(...) to real versions,
+		which raise a TypeError for complex arguments like the math functions """
+	return {	Evaluator.conjugate:	float,
+				Evaluator.real:			float,
+				Evaluator.imag:			_real_imag,
+			}
+
+def _type(value):
+	return COMPLEX if isinstance(value, complex) else REAL
+
+def infer(element, types):
+	""" Returns REAL if element only computes with real numbers, given types, a mapping
+		of variable names to REAL or COMPLEX (unknown variables count as REAL, they raise
+		an EvaluationError anyway). A function applied to a complex argument makes the
+		element COMPLEX, even if it returns a real number like imag. """
+	results = dict() #id of element -> type
+	pending = [(element, False)]
+	while pending:
+		current, visited = pending.pop()
+		if not visited:
+			pending.append((current, True))
+			pending.extend((child, False) for child in children(current))
+			continue
+		
+		operands = [results[id(child)] for child in children(current)]
+		if isinstance(current, Variable):
+			result = types.get(current.value, REAL)
+		elif isinstance(current, Constant):
+			result = _type(current.value)
+		else:
+			result = COMPLEX if COMPLEX in operands else REAL
+		results[id(current)] = result
+	return results[id(element)]
+
+def _side_effects(element, functions):
+	""" Returns True if evaluating element twice could differ from evaluating it once:
+		it assigns below its root, defines functions or calls impure functions, directly
+		or in the bodies of the user defined functions it calls """
+	pending = [element]
+	visited = set()
+	while pending:
+		current = pending.pop()
+		if isinstance(current, Definition):
+			return True
+		if (current is not element and isinstance(current, Toplevel) and isinstance(current.additional, AdditionalElement)
+				and current.additional.operator == '='):
+			return True
+		if isinstance(current, Function):
+			function = functions.get(current.name)
+			if isinstance(function, UserFunction):
+				if current.name not in visited:
+					visited.add(current.name)
+					pending.append(function.body) #its root may assign as well
+			elif function is not None and not function.pure:
+				return True
+		pending.extend(children(current))
+	return False
+
+class _TypedContext(EvaluationContext):
+	""" Context sharing variables and constants with another one, with the function
+		table of one path """
+	
+	def __init__(self, context, functions):
+		self.context = context
+		self.functions = functions
+		self.stats = None
+		self.generation = 0 #tables are rebuilt when the generation of context changes
+	
+	@property
+	def variables(self):
+		return self.context.variables
+	
+	@property
+	def constants(self):
+		return self.context.constants
+	
+	def set_variable(self, name, value):
+		return self.context.set_variable(name, value)
+	
+	def define_function(self, name, parameters, body):
+		return self.context.define_function(name, parameters, body)
+
+class _Plan:
+	""" Compiled code of a formula per path and the path chosen for each combination
+		of variable types """
+	
+	def __init__(self, element, functions):
+		self.variables = free_variables(element)
+		self.always_complex = _side_effects(element, functions)
+		self.paths = dict()		#tuple of variable types -> REAL or COMPLEX
+		self.compiled = dict()	#REAL or COMPLEX -> CompiledFormula
+
+class TypedEvaluator:
+	""" Evaluates formulas in a context on a real or a complex path, see module documentation """
+	
+	def __init__(self, context=None):
+		self.context = context if context is not None else EvaluationContext()
+		self.plans = weakref.WeakKeyDictionary() #formula element -> _Plan
+		self.generation = None
+		self.evaluations = {REAL: 0, COMPLEX: 0}
+		self.promotions = 0
+	
+	def _tables(self):
+		""" Builds the contexts of both paths, again whenever the context's functions changed """
+		functions = self.context.functions
+		self.contexts = dict()
+		self.compilers = dict()
+		for path, table in ((REAL, _real_builtins()), (COMPLEX, _complex_builtins())):
+			context = _TypedContext(self.context, {name: _replace(function, table) for name, function in functions.items()})
+			user = [name for name, function in functions.items() if isinstance(function, UserFunction)]
+			for name in user:
+				context.functions[name] = functions[name].bound_to(context)
+			for name in user:
+				context.functions[name].bound.bind() #sees the other user defined functions of the path
+			self.contexts[path] = context
+			self.compilers[path] = Compiler(context)
+		self.plans = weakref.WeakKeyDictionary() #compiled against the old functions
+		self.generation = self.context.generation
+	
+	def path(self, element):
+		""" Returns the path element is evaluated on with the current variables """
+		plan = self._plan(element)
+		return self._path(element, plan, self._key(plan))
+	
+	def _plan(self, element):
+		if self.generation != self.context.generation:
+			self._tables()
+		plan = self.plans.get(element)
+		if plan is None:
+			plan = _Plan(element, self.context.functions)
+			self.plans[element] = plan
+		return plan
+	
+	def _key(self, plan):
+		variables = self.context.variables
+		return tuple(_type(variables[name]) if name in variables else REAL for name in plan.variables)
+	
+	def _path(self, element, plan, key):
+		path = plan.paths.get(key)
+		if path is None:
+			if plan.always_complex:
+				path = COMPLEX
+			else:
+				path = infer(element, dict(zip(plan.variables, key)))
+			plan.paths[key] = path
+		return path
+	
+	def _compiled(self, element, plan, path):
+		compiled = plan.compiled.get(path)
+		if compiled is None:
+			compiled = plan.compiled[path] = self.compilers[path].compile(element)
+		return compiled
+	
+	def evaluate(self, element):
+		""" Evaluates element like element.evaluate(context), except that results leaving
+			the reals are returned as complex numbers instead of raising errors """
+		if isinstance(element, Definition):
+			return element.evaluate(self.context)
+		
+		plan = self._plan(element)
+		key = self._key(plan)
+		path = plan.paths.get(key)
+		if path is None:
+			path = self._path(element, plan, key)
+		
+		if path == REAL:
+			try:
+				self.evaluations[REAL] += 1
+				return self._compiled(element, plan, REAL).evaluate(self.contexts[REAL])
+			except (ValueError, TypeError):
+				self.evaluations[REAL] -= 1 #counted once, as a complex evaluation
+				plan.paths[key] = COMPLEX
+				self.promotions += 1
+		
+		self.evaluations[COMPLEX] += 1
+		return self._compiled(element, plan, COMPLEX).evaluate(self.contexts[COMPLEX])
+	
+	def __str__(self):
+		return "{}: {} formulas, {} real and {} complex evaluations, {} promotions".format(
+					self.__class__.__name__, len(self.plans), self.evaluations[REAL],
+					self.evaluations[COMPLEX], self.promotions)
+
+def _replace(function, table):
+	""" Returns function with its callable replaced according to table """
+	replacement = table.get(function.function)
+	if replacement is None:
+		return function
+	replaced = Evaluator.EvaluationFunction(function.arity, replacement, function.description,
+											function.vectorized, function.pure, function.derivative)
+	if isinstance(function, Evaluator.MemoizedFunction):
+		return Evaluator.MemoizedFunction(replaced, function.maxsize)
+	return replaced
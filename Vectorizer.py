@@ -0,0 +1,117 @@
+""" Vectorized evaluation of formulas over NumPy arrays
+
+	Variables of a VectorizedContext can be bound to NumPy arrays. The arithmetic
+	operators of Sum, Product and Power work on arrays as they are, and the builtin
+	functions are replaced by their ufunc equivalents, so a formula is evaluated
+	once for all rows instead of once per row.
+	
+	NOTE: NumPy does not raise on domain errors, e.g. sqrt(-1) results in nan
+	(with a RuntimeWarning) instead of a ValueError.
+"""
+
+import functools
+import math
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+import Evaluator
+from Binder import UserFunction
+from Evaluator import EvaluationError, EvaluationFunction, EvaluationContext
+
+def _log(a, base=None):
+	if base is None:
+		return numpy.log(a)
+	return numpy.log(a) / numpy.log(base)
+
+def _minimum(*arguments):
+	return functools.reduce(numpy.minimum, arguments)
+
+def _maximum(*arguments):
+	return functools.reduce(numpy.maximum, arguments)
+
+def _vectorized_builtins():
+	""" Maps the scalar builtins of EvaluationContext to their NumPy equivalents """
+	return {	math.fabs:			numpy.absolute,
+				math.exp:			numpy.exp,
+				math.log:			_log,
+				math.log10:			numpy.log10,
+				math.log2:			numpy.log2,
+				math.sqrt:			numpy.sqrt,
+				math.pow:			numpy.power,
+				math.sin:			numpy.sin,
+				math.cos:			numpy.cos,
+				math.tan:			numpy.tan,
+				math.asin:			numpy.arcsin,
+				math.acos:			numpy.arccos,
+				math.atan:			numpy.arctan,
+				math.atan2:			numpy.arctan2,
+				math.degrees:		numpy.degrees,
+				math.radians:		numpy.radians,
+				min:				_minimum,
+				max:				_maximum,
+				math.floor:			numpy.floor,
+				math.ceil:			numpy.ceil,
+				Evaluator.conjugate:	numpy.conjugate,
+				Evaluator.real:		numpy.real,
+				Evaluator.imag:		numpy.imag,
+			}
+
+class VectorizedContext(EvaluationContext):
+	""" EvaluationContext whose variables may be NumPy arrays and whose functions are ufuncs.
+		Functions without a vectorized form are applied element by element through
+		numpy.vectorize if fallback is set, otherwise calling them raises an EvaluationError. """
+	
+	def __init__(self, context=None, fallback=False):
+		if numpy is None:
+			raise EvaluationError("Vectorized evaluation requires NumPy")
+		
+		super().__init__()
+		self.fallback = fallback
+		self.builtins = _vectorized_builtins()
+		
+		if context is not None:
+			self.variables = dict(context.variables)
+			self.constants = list(context.constants)
+			functions = context.functions
+		else:
+			functions = self.functions
+		
+		self.functions = {name: self.vectorize_function(name, function) for name, function in functions.items()}
+		self.generation += 1 #user defined functions were bound before the functions were replaced
+	
+	def vectorize_function(self, name, function):
+		""" Returns an EvaluationFunction that accepts NumPy arrays """
+		if isinstance(function, UserFunction) and function.vectorized is None:
+			return function.bound_to(self) #the body works on arrays as it is
+		
+		if function.vectorized is not None:
+			vectorized = function.vectorized
+		elif function.function in self.builtins:
+			vectorized = self.builtins[function.function]
+		elif self.fallback:
+			vectorized = numpy.vectorize(function.function)
+		else:
+			vectorized = functools.partial(_not_vectorized, name)
+		
+		return EvaluationFunction(function.arity, vectorized, function.description, vectorized, function.pure)
+	
+	def register_function(self, name, arity, function, description, vectorized=None, pure=False, derivative=None):
+		super().register_function(name, arity, function, description, vectorized, pure, derivative)
+		self.functions[name] = self.vectorize_function(name, self.functions[name])
+	
+	def set_arrays(self, **arrays):
+		""" Binds variables to arrays (or anything numpy.asarray accepts) """
+		for name, values in arrays.items():
+			self.set_variable(name, numpy.asarray(values))
+
+def _not_vectorized(name, *arguments):
+	raise EvaluationError("Function '{}' has no vectorized form.".format(name))
+
+def evaluate_vectorized(element, context=None, fallback=False, **arrays):
+	""" Evaluates a formula element once for whole arrays of variable values """
+	vectorized = VectorizedContext(context, fallback)
+	vectorized.set_arrays(**arrays)
+	return element.evaluate(vectorized)
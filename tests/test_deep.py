@@ -0,0 +1,71 @@
+""" Formulas nested 100k levels deep parse and evaluate without recursion """
+
+import math
+import random
+
+import pytest
+
+from Evaluator import EvaluationContext
+from FormulaStructure import evaluate_iterative
+from Lexer import Lexer
+from Parser import Parser
+
+DEPTH = 100000
+
+def parentheses(levels):
+	return "(" * levels + "x" + ")" * levels, lambda x: x
+
+def negations(levels):
+	return "-" * levels + "x", lambda x: x if levels % 2 == 0 else -x
+
+def powers(levels):
+	#x^1^1^...^1 nests to the right
+	return "x" + "^1" * levels, lambda x: x
+
+def calls(levels):
+	def expected(x):
+		for level in range(levels):
+			x = math.sin(x)
+		return x
+	return "sin(" * levels + "x" + ")" * levels, expected
+
+BUILDERS = [parentheses, negations, powers, calls]
+
+def parse(formula):
+	return Parser().parse(Lexer().lexe_iter(formula))
+
+def context(x):
+	context = EvaluationContext()
+	context.set_variable("x", x)
+	return context
+
+@pytest.mark.parametrize("builder", BUILDERS)
+def test_deep_formulas(builder):
+	formula, expected = builder(DEPTH)
+	element = parse(formula)
+	assert evaluate_iterative(element, context(0.75)) == expected(0.75)
+
+@pytest.mark.parametrize("builder", BUILDERS)
+@pytest.mark.parametrize("levels", [1, 2, 10, 50])
+def test_iterative_matches_recursive(builder, levels):
+	formula, expected = builder(levels)
+	element = parse(formula)
+	assert evaluate_iterative(element, context(0.75)) == element.evaluate(context(0.75))
+
+def random_formula(generator, levels):
+	if levels == 0:
+		return generator.choice(["1", "2.5", "x", "pi"])
+	inner = random_formula(generator, levels - 1)
+	return generator.choice(["({})", "-{}", "2^{}", "{}^2", "max({}, 1)", "sin({})", "1+{}*3", "(y={})"]).format(inner)
+
+def test_random_nesting_matches_recursive():
+	generator = random.Random(12)
+	for index in range(500):
+		element = parse(random_formula(generator, generator.randrange(1, 40)))
+		try:
+			expected = element.evaluate(context(0.5))
+		except (ArithmeticError, ValueError, TypeError) as e:
+			with pytest.raises(type(e)):
+				evaluate_iterative(element, context(0.5))
+			continue
+		assert evaluate_iterative(element, context(0.5)) == expected
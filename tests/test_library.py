@@ -0,0 +1,40 @@
+""" Formula libraries round trip and reject corrupt files with a LibraryError """
+
+import pytest
+
+from Evaluator import EvaluationContext
+from FormulaLibrary import write_library, FormulaLibrary, LibraryError
+from FormulaStructure import Constant
+from Parser import parse
+
+FORMULAS = {"a": "x * sin(y) + 2.5", "b": "z = max(1, 2, x) ^ 2", "c": "2 - e"}
+
+@pytest.fixture
+def library(tmp_path):
+	path = tmp_path / "formulas.mpfl"
+	write_library(str(path), {name: parse(formula) for name, formula in FORMULAS.items()})
+	return path
+
+def test_round_trip(library):
+	context = EvaluationContext()
+	context.set_variable("x", 1.5)
+	context.set_variable("y", 0.5)
+	with FormulaLibrary(str(library), context) as loaded:
+		for name, formula in FORMULAS.items():
+			assert loaded[name].evaluate(context) == parse(formula).evaluate(context)
+
+def test_truncated_files(library, tmp_path):
+	data = library.read_bytes()
+	truncated = tmp_path / "truncated.mpfl"
+	for size in range(len(data)):
+		truncated.write_bytes(data[:size])
+		with pytest.raises(LibraryError):
+			with FormulaLibrary(str(truncated)) as loaded:
+				for name in loaded:
+					loaded[name]
+
+def test_integer_range(tmp_path):
+	path = str(tmp_path / "integers.mpfl")
+	write_library(path, {"a": Constant(2 ** 63 - 1)})
+	with pytest.raises(LibraryError):
+		write_library(path, {"a": Constant(2 ** 63)})
@@ -0,0 +1,31 @@
+""" Memoized functions keep a bounded cache """
+
+import pytest
+
+from Evaluator import EvaluationContext, MemoizedFunction
+from Parser import parse
+
+@pytest.mark.parametrize("maxsize", [-1, -100, 1.5, "8", None, True])
+def test_invalid_sizes(maxsize):
+	context = EvaluationContext()
+	with pytest.raises(ValueError):
+		context.memoize("sqrt", maxsize)
+	assert not isinstance(context.functions["sqrt"], MemoizedFunction)
+	
+	function = context.memoize("sqrt", 4)
+	with pytest.raises(ValueError):
+		function.resize(maxsize)
+	assert function.maxsize == 4
+
+def test_sizes_bound_the_cache():
+	context = EvaluationContext()
+	function = context.memoize("sqrt", 0)
+	assert parse("sqrt(4) + sqrt(4)").evaluate(context) == 4.0
+	assert len(function.cache) == 0
+	
+	context.memoize("sqrt", 2)
+	for value in range(5):
+		parse("sqrt({})".format(value)).evaluate(context)
+	assert len(function.cache) == 2
+	context.memoize("sqrt", 1)
+	assert list(function.cache) == [((float, 4.0, 1.0),)]
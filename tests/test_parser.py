@@ -0,0 +1,115 @@
+""" Parser builds the same trees as the recursive parse_formula """
+
+import random
+import time
+
+import pytest
+
+from Evaluator import EvaluationContext
+from FormulaStructure import ParserError, parse_formula
+from Lexer import Lexer, LexerError
+from Parser import Parser, ParseCache
+
+EDGE_CASES = [
+	"1", "x", "-x", "--x", "---1", "(1)", "((x))", "-(x)",
+	"1+2-3+4", "1*2/3%4\\5", "1+2*3-4/5", "1*2+3*4",
+	"2^3^4", "-2^2", "2^-2", "(2^3)^4", "2^(3^4)", "x^-y^z",
+	"x=1", "x=-1", "x=(y=2)", "x=y=3",
+	"f()", "sin(x)", "max(1,2,3)", "atan2(y, x)", "max(-1, -(2), 3^4)", "sin(cos(tan(x)))",
+	"-sin(x)^2", "1-(2-(3-(4-5)))", "pi*2.5e", ".5+1.", "1.2.3",
+	"f(x)=x^2", "g()=42", "h(a, b)=a*b+c",
+	#invalid formulas have to be rejected by both parsers
+	"", "(", ")", "1+", "*1", "(1", "1)", "sin(", "sin(1,", "max(,)", "1 2", "x=", "f(x)=", "f(1)=x", "f(x,x)=x",
+	"1+f(x)=x", "-f(x)=x", "(f(x)=x)", "g(f(x)=x)", "y=f(x)=x", "f(x)=g(y)=1", "2*f()=1", "f(x)^2=1",
+]
+
+def reference(formula):
+	""" Tree of the recursive parser or the error class it raises """
+	lexemes = Lexer().lexe(formula)
+	try:
+		element = parse_formula(lexemes)
+	except (ParserError, IndexError):
+		return ParserError
+	if lexemes:
+		return ParserError #parse_formula leaves unparsed lexemes behind
+	return str(element)
+
+def cursor(formula):
+	try:
+		return str(Parser().parse(Lexer().lexe(formula)))
+	except ParserError:
+		return ParserError
+
+def random_formula(generator, depth=0):
+	choice = generator.randrange(8) if depth < 5 else 0
+	if choice == 0:
+		return generator.choice(["1", "2.5", "x", "y", "pi", "0"])
+	if choice == 1:
+		return "({})".format(random_formula(generator, depth + 1))
+	if choice == 2:
+		return "-" + random_formula(generator, depth + 1)
+	if choice == 3:
+		arguments = [random_formula(generator, depth + 1) for index in range(generator.randrange(4))]
+		return "{}({})".format(generator.choice(["sin", "max", "f"]), ", ".join(arguments))
+	if choice == 4:
+		return "x={}".format(random_formula(generator, depth + 1))
+	return "{}{}{}".format(random_formula(generator, depth + 1), generator.choice("+-*/%\\^"),
+							random_formula(generator, depth + 1))
+
+@pytest.mark.parametrize("formula", EDGE_CASES)
+def test_edge_cases(formula):
+	try:
+		expected = reference(formula)
+	except LexerError:
+		pytest.skip("not a valid lexeme sequence")
+	assert cursor(formula) == expected
+
+def test_random_formulas():
+	generator = random.Random(2)
+	for index in range(3000):
+		formula = random_formula(generator)
+		assert cursor(formula) == reference(formula), formula
+
+def test_iterator_input():
+	""" Lexemes may be consumed lazily """
+	formula = "max(1, -2^x, (y = 3)) * 2"
+	assert str(Parser().parse(Lexer().lexe_iter(formula))) == reference(formula)
+
+def parse_time(tokens):
+	lexemes = Lexer().lexe("+".join(["x"] * (tokens // 2 + 1)))
+	best = None
+	for repeat in range(3):
+		start = time.perf_counter()
+		Parser().parse(lexemes)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def test_linear_time():
+	""" 100k tokens take about four times as long as 25k tokens (16 times if quadratic) """
+	small = parse_time(25000)
+	large = parse_time(100000)
+	assert large < 8 * small
+
+def test_optimized_entries_follow_the_context():
+	cache = ParseCache()
+	first = EvaluationContext()
+	first.set_constant("k", 2.0)
+	second = EvaluationContext()
+	second.set_constant("k", 5.0)
+	assert cache.parse("k * 2", True, context=first).value == 4.0
+	assert cache.parse("k * 2", True, context=second).value == 10.0
+	
+	first.set_constant("k", 3.0)
+	assert cache.parse("k * 2", True, context=first).value == 6.0
+	assert "k by 3.0" in str(cache.optimization_report("k * 2", context=first))
+
+def test_optimizing_keeps_values():
+	cache = ParseCache()
+	context = EvaluationContext()
+	context.set_variable("x", -0.0)
+	context.set_variable("n", 3)
+	for formula in ["x + 0", "0 + x", "n * 1", "n / 1", "n ^ 1"]:
+		value = cache.parse(formula, True).evaluate(context)
+		expected = cache.parse(formula).evaluate(context)
+		assert (type(value), str(value)) == (type(expected), str(expected))
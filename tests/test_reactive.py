@@ -0,0 +1,41 @@
+""" Reactive formulas follow the bodies of the user defined functions they call """
+
+import pytest
+
+from Parser import parse
+from Reactive import ReactiveContext
+
+@pytest.mark.parametrize("eager", [False, True])
+def test_function_bodies_are_dependencies(eager):
+	context = ReactiveContext(eager)
+	context.set_variable("y", 1.0)
+	context.define_function("g", [], parse("y"))
+	context.define("a", "g() + 1")
+	assert context.get_variable("a") == 2.0
+	
+	context.set_variable("y", 10.0)
+	assert context.get_variable("a") == 11.0
+
+@pytest.mark.parametrize("eager", [False, True])
+def test_redefinitions_invalidate_callers(eager):
+	context = ReactiveContext(eager)
+	context.set_variable("y", 1.0)
+	context.set_variable("w", 5.0)
+	context.define_function("g", [], parse("y"))
+	context.define("a", "g() + 1")
+	context.define("b", "a * 2")
+	assert context.get_variable("b") == 4.0
+	
+	context.define_function("g", [], parse("w * 2"))
+	assert context.get_variable("b") == 22.0
+	context.set_variable("w", 1.0)
+	assert context.get_variable("b") == 6.0
+
+def test_functions_defined_later():
+	context = ReactiveContext(eager=True)
+	context.set_variable("w", 3.0)
+	context.define("b", "h(2)")
+	assert context.formulas["b"].error is not None
+	
+	context.define_function("h", ["q"], parse("q * w"))
+	assert context.get_variable("b") == 6.0
@@ -0,0 +1,36 @@
+""" Sessions keep their state across offloaded batches, overlong requests get an error reply """
+
+import asyncio
+
+from Server import EvaluationServer
+
+def exchange(server, requests):
+	""" Sends requests over one connection, returns the response lines """
+	async def run():
+		await server.start_tcp(port=0)
+		port = server.servers[0].sockets[0].getsockname()[1]
+		reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=server.limit())
+		responses = list()
+		for request in requests:
+			writer.write(request + b"\n")
+			await writer.drain()
+			responses.append((await reader.readline()).rstrip(b"\n").decode())
+		writer.close()
+		await writer.wait_closed()
+		server.close()
+		return responses
+	return asyncio.run(run())
+
+def test_offloaded_batches_keep_the_session():
+	server = EvaluationServer(offload_threshold=4)
+	responses = exchange(server, [b"f(x) = x^2 + y; y = 1; 2; 3", b"f(3) + ans", b"g(x) = 2 * x",
+									b"g(f(2)); y = 2; ans; g(f(2))", b"y"])
+	assert responses == ["Defined f(x); 1.0; 2.0; 3.0", "13.0", "Defined g(x)",
+							"10.0; 2.0; 2.0; 12.0", "2.0"]
+	assert server.stats.offloaded == 2
+
+def test_overlong_line():
+	server = EvaluationServer()
+	server.framing.maximum = 1 << 16
+	responses = exchange(server, [b"1+" * (1 << 22) + b"1"])
+	assert responses == ["ProtocolError: Line exceeds the limit of 65536 bytes"]
@@ -0,0 +1,63 @@
+""" Snapshots stay unchanged and forks stay isolated, also under concurrency """
+
+from Evaluator import EvaluationContext
+from Parser import parse
+from Snapshot import snapshot, stress
+
+def test_concurrent_forks_and_writers():
+	assert stress(threads=8, iterations=500) == 0
+
+def test_fork_writes_stay_private():
+	context = EvaluationContext()
+	context.set_variable("x", 1.0)
+	shared = snapshot(context)
+	first = shared.fork()
+	second = shared.fork()
+	
+	first.set_variable("x", 2.0)
+	first.register_function("twice", 1, lambda a: 2 * a, "twice", pure=True)
+	first.define_function("f", ["a"], parse("a^2 + 1"))
+	first.set_constant("k", 3.0)
+	
+	assert parse("f(3) + twice(x) + k").evaluate(first) == 17.0
+	assert shared.variables["x"] == 1.0
+	assert "twice" not in shared.functions and "f" not in shared.functions
+	assert "k" not in shared.constants
+	assert second.get_variable("x") == 1.0
+	assert "f" not in second.functions and "k" not in second.variables
+
+def test_writes_to_the_original_do_not_reach_snapshots():
+	context = EvaluationContext()
+	context.set_variable("x", 1.0)
+	shared = snapshot(context)
+	context.set_variable("x", 5.0)
+	context.define_function("g", [], parse("42"))
+	assert shared.variables["x"] == 1.0
+	assert "g" not in shared.functions
+	assert shared.fork().get_variable("x") == 1.0
+
+def test_forks_copy_on_first_write():
+	context = EvaluationContext()
+	context.set_variable("x", 1.0)
+	shared = snapshot(context)
+	fork = shared.fork()
+	assert fork.variables is shared._variables and fork.functions is shared._functions
+	
+	assert parse("x + 1").evaluate(fork) == 2.0
+	assert fork.variables is shared._variables and fork.copies == 0
+	
+	fork.set_variable("x", 2.0)
+	assert fork.variables is not shared._variables and fork.copies == 1
+	assert fork.functions is shared._functions
+	fork.set_variable("y", 3.0)
+	assert fork.copies == 1
+	
+	fork.register_function("twice", 1, lambda a: 2 * a, "twice")
+	assert fork.functions is not shared._functions and fork.copies == 2
+	
+	#a snapshot of a fork takes over its dictionaries, the fork copies them again on its next write
+	again = fork.snapshot()
+	variables = fork.variables
+	assert again._variables is variables
+	fork.set_variable("x", 4.0)
+	assert fork.variables is not variables and again.variables["x"] == 2.0 and fork.copies == 3
@@ -0,0 +1,61 @@
+""" Tiered evaluation gives the results and errors of the tree in every tier """
+
+import pytest
+
+from Evaluator import EvaluationContext
+from Parser import parse
+from Tiering import TieredEvaluator, TREE, BOUND, COMPILED
+
+def outcome(evaluate):
+	try:
+		return evaluate()
+	except Exception as e:
+		return type(e), str(e)
+
+@pytest.mark.parametrize("formula", ["(1000/0)-z", "(3.5^1000)-z", "sin(1, 2) + x", "y + x * 2", "max(x, 1) ^ 2"])
+def test_tiers_match_tree(formula):
+	element = parse(formula)
+	tree = EvaluationContext()
+	tree.set_variable("x", 1.5)
+	context = EvaluationContext()
+	context.set_variable("x", 1.5)
+	tiered = TieredEvaluator(context, (1, 2, 3))
+	for index in range(6):
+		assert outcome(lambda: tiered.evaluate(element)) == outcome(lambda: element.evaluate(tree))
+
+def test_unknown_variables_stop_at_bound():
+	context = EvaluationContext()
+	tiered = TieredEvaluator(context, (1, 2, 3))
+	element = parse("x + 1")
+	for index in range(5):
+		outcome(lambda: tiered.evaluate(element))
+	assert tiered.tier(element) == BOUND
+	
+	context.set_variable("x", 1.0) #new variable, demotes
+	for index in range(5):
+		assert tiered.evaluate(element) == 2.0
+	assert tiered.tier(element) == COMPILED
+
+def test_constant_changes_demote():
+	context = EvaluationContext()
+	context.set_constant("k", 2.0)
+	tiered = TieredEvaluator(context, (1, 2, 3))
+	element = parse("k * 3")
+	for index in range(5):
+		assert tiered.evaluate(element) == 6.0
+	assert tiered.tier(element) == COMPILED
+	
+	context.set_constant("k", 3.0)
+	assert tiered.evaluate(element) == 9.0
+	assert tiered.transitions[COMPILED, TREE] == 1
+
+def test_unknown_variables_in_function_bodies_stop_at_bound():
+	tree = EvaluationContext()
+	context = EvaluationContext()
+	for each in (tree, context):
+		each.define_function("g", [], parse("z"))
+	tiered = TieredEvaluator(context, (1, 2, 3))
+	element = parse("(1000/0) + g()")
+	for index in range(6):
+		assert outcome(lambda: tiered.evaluate(element)) == outcome(lambda: element.evaluate(tree))
+	assert tiered.tier(element) == BOUND
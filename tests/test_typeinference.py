@@ -0,0 +1,62 @@
+""" Typed evaluation gives the results of the tree, promoting formulas leaving the reals """
+
+import pytest
+
+from Evaluator import EvaluationContext
+from Parser import parse
+from TypeInference import TypedEvaluator, REAL, COMPLEX
+
+def contexts():
+	tree = EvaluationContext()
+	typed = EvaluationContext()
+	for context in (tree, typed):
+		context.set_variable("z", 3 + 4j)
+		context.set_variable("x", 2.0)
+	return tree, TypedEvaluator(typed)
+
+@pytest.mark.parametrize("formula", ["imag(z)", "imag(z) + 1", "imag(i)", "real(z) * x", "conj(z) - z",
+										"imag(x) + real(x)", "imag((-8)^(1/3))"])
+def test_complex_arguments_match_tree(formula):
+	tree, typed = contexts()
+	element = parse(formula)
+	for index in range(3):
+		assert typed.evaluate(element) == element.evaluate(tree)
+
+def test_path_depends_on_argument_types():
+	tree, typed = contexts()
+	assert typed.path(parse("imag(z)")) == COMPLEX
+	assert typed.path(parse("imag(x) + 1")) == REAL
+
+def test_promotion_counts_once():
+	tree, typed = contexts()
+	typed.context.set_variable("x", -4.0)
+	assert typed.evaluate(parse("sqrt(x)")) == 2j
+	assert typed.evaluations == {REAL: 0, COMPLEX: 1}
+	assert typed.promotions == 1
+
+def test_side_effects_run_once():
+	tree, typed = contexts()
+	calls = list()
+	def tick():
+		calls.append(None)
+		return -1.0
+	typed.context.register_function("tick", 0, tick, "impure")
+	typed.evaluate(parse("g(a) = sqrt(a) + tick()"))
+	
+	assert typed.evaluate(parse("sqrt(tick())")) == 1j
+	assert len(calls) == 1
+	assert typed.evaluate(parse("g(-4)")) == 2j - 1
+	assert len(calls) == 2
+	assert typed.promotions == 0
+
+def test_definitions():
+	tree, typed = contexts()
+	typed.evaluate(parse("g(a) = sqrt(a)"))
+	assert typed.evaluate(parse("g(4)")) == 2.0
+	assert typed.evaluate(parse("g(-4)")) == 2j
+
+def test_user_functions_use_the_path_functions():
+	tree, typed = contexts()
+	typed.evaluate(parse("h(a) = sqrt(a)"))
+	typed.evaluate(parse("g(a) = h(a) + y = 1")) #assigns, never inlined
+	assert typed.evaluate(parse("g(-4)")) == 2j + 1